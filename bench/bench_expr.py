@@ -0,0 +1,78 @@
+""" Expression resolve benchmark
+
+Resolve the REQ/RES/SET payloads of the showcase files, plus a large mostly static payload,
+with compiled resolvers and with the previous copy-and-derive-every-leaf resolve.
+
+python bench/bench_expr.py [iterations]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from runner import APT, APTEnv
+
+ROOT = os.path.join(os.path.dirname(__file__), "..", "tests")
+FILES = [
+    os.path.join(ROOT, "unit-test", "showcase.apitest"),
+    os.path.join(ROOT, "project-test", "testcase", "echo", "echo.apitest"),
+]
+
+def LegacyResolve(expr, env):
+    """ Resolve as before compiled resolvers: deep copy and derive the type of every string leaf on each call """
+    if isinstance(expr, APT.Expr.Object):
+        def do(data):
+            if isinstance(data, dict):  return {k: do(data[k]) for k in data}
+            if isinstance(data, list):  return [do(d) for d in data]
+            if isinstance(data, str):   return LegacyResolve(APT.Expr.StringLit(data).deriveType(), env)
+            return data
+        return do(expr.val)
+    if isinstance(expr, APT.Expr.BinOp):
+        left, right = LegacyResolve(expr.left, env), LegacyResolve(expr.right, env)
+        if isinstance(left, dict) and isinstance(right, dict):
+            data = dict(left)
+            data.update(right)
+            return data
+        return left + right
+    if isinstance(expr, APT.Expr.Var):
+        return env.getVar(expr.val)
+    return expr.val
+
+def Payloads():
+    exprs = []
+    for path in FILES:
+        with open(path, "r") as f:
+            for stmt in APT(f):
+                data = getattr(stmt, "data", None)
+                if isinstance(data, (APT.Expr.Object, APT.Expr.BinOp)) and "@" not in str(data): # No template files
+                    exprs.append(data)
+    large = {"id": "$id", "items": [{"sku": "SKU-%d" % i, "qty": i, "tags": ["a", "b"], "meta": {"k": "v"}} for i in range(200)]}
+    exprs.append(APT.Expr.Object(large))
+    return exprs
+
+def Measure(name, iterations, exprs, resolve, env):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for expr in exprs:
+            resolve(expr, env)
+    elapsed = time.perf_counter() - start
+    rate = iterations * len(exprs) / elapsed
+    print("%-32s %10.0f resolves/s" % (name, rate))
+    return rate
+
+def main(argv):
+    iterations = int(argv[1]) if len(argv) > 1 else 2000
+    env = APTEnv()
+    for name, val in {"$id": 1, "$data": {"data": "XXX"}, "$BASE_REQ": {"$header": {"A": "B"}}, "$base_data": {"a": 1}, "$street": "S", "$id2": 2}.items():
+        env.setVar(name, val)
+    exprs = Payloads()
+    for expr in exprs: # Same results
+        assert expr.resolve(env) == LegacyResolve(expr, env)
+
+    legacy = Measure("copy and derive (previous)", iterations, exprs, LegacyResolve, env)
+    compiled = Measure("compiled resolvers", iterations, exprs, lambda expr, env: expr.resolve(env), env)
+    print("Speedup: %.1fx over %d payloads" % (compiled / legacy, len(exprs)))
+
+if __name__ == "__main__":
+    main(sys.argv)
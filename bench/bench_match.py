@@ -0,0 +1,83 @@
+""" Assertion matcher benchmark
+
+Match a response with thousands of records and list items with the compiled APTMatcher and with the
+previous recursive check that split every dotted key again on each access. Unordered list matching is
+compared with a nested scan, which is how it had to be written before $unordered.
+
+python bench/bench_match.py [iterations] [items]
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from runner import APTMatcher
+
+def LegacyAccess(obj, accessor):
+    def access(obj, fields):
+        if obj is None:             return None
+        if fields[0] not in obj:    return None
+        if len(fields) == 1:        return obj[fields[0]]
+        return access(obj[fields[0]], fields[1:])
+    return access(obj, accessor.split("."))
+
+def LegacyCheck(obj, expect, kPrefix, mismatches):
+    for k in expect:
+        actual = LegacyAccess(obj, k)
+        if isinstance(expect[k], dict):
+            LegacyCheck(actual, expect[k], kPrefix + k + ".", mismatches)
+        elif actual != expect[k]:
+            mismatches.append((kPrefix + k, expect[k], actual))
+    return mismatches
+
+def NestedScanUnordered(actual, expected):
+    remaining = list(actual)
+    for item in expected:
+        for i, candidate in enumerate(remaining):
+            if candidate == item:
+                del remaining[i]
+                break
+        else:
+            return False
+    return len(remaining) == 0
+
+def Measure(name, iterations, call):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        call()
+    elapsed = time.perf_counter() - start
+    print("%-36s %10.1f matches/s" % (name, iterations / elapsed))
+    return elapsed
+
+def main(argv):
+    iterations = int(argv[1]) if len(argv) > 1 else 50
+    items = int(argv[2]) if len(argv) > 2 else 2000
+    response = {
+        "$status": 200,
+        "records": {"r%d" % i: {"id": i, "owner": {"name": "user%d" % i}} for i in range(items)},
+        "items": [{"sku": "SKU-%d" % i, "qty": i % 7} for i in range(items)],
+    }
+    expect = {"$status": 200}
+    for i in range(items):
+        expect["records.r%d.id" % i] = i
+        expect["records.r%d.owner" % i] = {"name": "user%d" % i}
+    shuffled = list(response["items"])
+    random.seed(1)
+    random.shuffle(shuffled)
+
+    assert LegacyCheck(response, expect, "", []) == APTMatcher(expect).Match(response) == []
+    legacy = Measure("recursive check (previous)", iterations, lambda: LegacyCheck(response, expect, "", []))
+    matcher = APTMatcher(expect)
+    compiled = Measure("compiled matcher", iterations, lambda: matcher.Match(response))
+    print("Speedup: %.1fx over %d paths" % (legacy / compiled, len(expect)))
+
+    unordered = APTMatcher({"items": {"$unordered": shuffled}})
+    assert NestedScanUnordered(response["items"], shuffled) and unordered.Match(response) == []
+    scan = Measure("nested scan, unordered", max(1, iterations // 10), lambda: NestedScanUnordered(response["items"], shuffled))
+    hashed = Measure("$unordered, hashed", max(1, iterations // 10), lambda: unordered.Match(response))
+    print("Speedup: %.1fx over %d items" % (scan / hashed, items))
+
+if __name__ == "__main__":
+    main(sys.argv)
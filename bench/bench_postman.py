@@ -0,0 +1,65 @@
+""" Postman converter benchmark
+
+Generate collections of growing size (folders of 100 requests with tests) and report the time and peak memory of
+converting them to .apitest files and back. Each conversion runs in its own process.
+Peak memory should stay flat as the collection grows.
+
+python bench/bench_postman.py [requests, default 1000,10000,100000] [jobs]
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+CONVERTER = os.path.join(os.path.dirname(__file__), "..", "postman_collection.py")
+
+def Request(n:int) -> dict:
+    return {"name": "Echo %d" % n, "event": [{"listen": "test", "script": {"type": "text/javascript", "exec": [
+                "pm.test(\"Status code is 200\", function () {", "    pm.response.to.have.status(200);", "});",
+                "var jsonData = pm.response.json();", "pm.expect(jsonData.id).to.eql(%d);" % n,
+                "pm.collectionVariables.set(\"lastUser\", jsonData.user);"]}}],
+            "request": {"method": "POST", "header": [{"key": "Content-Type", "value": "application/json"}],
+                        "url": {"raw": "{{baseUrl}}/full-echo"},
+                        "body": {"mode": "raw", "raw": json.dumps({"id": n, "user": "user%d" % n, "items": [1, 2, 3]}, indent=2)}},
+            "response": []}
+
+def Generate(path:str, count:int):
+    """ Written folder by folder, so the generator doesn't hold the collection either """
+    with open(path, "w") as f:
+        f.write('{"info": {"name": "Generated", "schema": "https://schema.getpostman.com/json/collection/v2.1.0/collection.json"}, "item": [')
+        for folder in range(0, count, 100):
+            f.write((", " if folder > 0 else "") + json.dumps({"name": "Folder %d" % (folder // 100),
+                "item": [Request(n) for n in range(folder, min(folder + 100, count))]}, indent=2))
+        f.write('], "variable": [{"key": "baseUrl", "value": "http://127.0.0.1:8080"}]}')
+
+def Measure(args:list) -> dict:
+    """ Seconds and peak RSS of the converter, its worker processes included """
+    start = time.perf_counter()
+    out = subprocess.run([sys.executable, "-c", "import resource, runpy, sys; sys.argv = %r; "
+        "code = 0\ntry: runpy.run_path(sys.argv[0], run_name='__main__')\nexcept SystemExit as e: code = e.code\n"
+        "print(max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss))\n"
+        "sys.exit(code)" % ([CONVERTER] + args)], capture_output=True, text=True)
+    if out.returncode != 0:
+        raise Exception(out.stderr)
+    return {"seconds": time.perf_counter() - start, "maxrss": int(out.stdout.split()[-1]) * 1024}
+
+def main(argv):
+    counts = [int(n) for n in (argv[1] if len(argv) > 1 else "1000,10000,100000").split(",")]
+    jobs = ["-j", argv[2]] if len(argv) > 2 else []
+    print("%-10s %10s %8s %12s %12s %12s" % ("direction", "requests", "MB", "seconds", "requests/s", "peak RSS"))
+    for count in counts:
+        with tempfile.TemporaryDirectory() as tmp:
+            collection, folder = os.path.join(tmp, "generated.postman_collection.json"), os.path.join(tmp, "suite")
+            Generate(collection, count)
+            size = os.path.getsize(collection) / 1048576
+            for direction, args in [("to-apitest", [collection, folder]), ("to-postman", [folder, os.path.join(tmp, "back.json")])]:
+                result = Measure([direction] + args + jobs)
+                print("%-10s %10d %8.1f %12.2f %12.0f %10.1fMB" % (direction, count, size, result["seconds"],
+                      count / result["seconds"], result["maxrss"] / 1048576))
+                sys.stdout.flush()
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,61 @@
+""" Scanner benchmark
+
+Parse generated .apitest scripts of growing size and report time per statement.
+Linear scaling shows as a flat us/stmt column.
+
+python bench/bench_scanner.py [max statements]
+"""
+
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from runner import APT
+
+BLOCK = """/* Generated case %d */
+SECT    Case %d
+SET     $id     %d
+REQ     POST    http://127.0.0.1:8080/full-echo     {
+    id: $id
+    name: Case %d
+    tags: [a, b, c]
+}
+RES     {
+    $status: 200
+    id: %d
+}
+PRINT   $id
+"""
+STATEMENTS_PER_BLOCK = 5
+
+def Generate(statements:int) -> str:
+    return "".join(BLOCK % ((i,) * 5) for i in range(statements // STATEMENTS_PER_BLOCK))
+
+def Parse(data:str) -> int:
+    """ Parse every statement and look up its line number, as failures and PRINT do """
+    apt = APT(io.StringIO(data))
+    count = 0
+    for stmt in apt:
+        if not isinstance(stmt, str): # Trailing whitespace yields an empty unknown statement
+            apt.scanner.GetLineNumber(stmt.pos)
+        count += 1
+    return count
+
+def main(argv):
+    maxStatements = int(argv[1]) if len(argv) > 1 else 100000
+    sizes, n = [], 1000
+    while n <= maxStatements:
+        sizes.append(n)
+        n *= 4
+    print("%10s %10s %10s %10s" % ("stmts", "bytes", "seconds", "us/stmt"))
+    for size in sizes:
+        data = Generate(size)
+        start = time.perf_counter()
+        count = Parse(data)
+        elapsed = time.perf_counter() - start
+        print("%10d %10d %10.3f %10.2f" % (count, len(data), elapsed, elapsed / count * 1000000))
+
+if __name__ == "__main__":
+    main(sys.argv)
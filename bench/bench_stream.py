@@ -0,0 +1,85 @@
+""" Streaming scanner benchmark
+
+Generate .apitest files of growing size and report the peak memory of scanning them (REQ/RES pairs) and of
+running them (SET/ASSERT pairs, no network), streamed and read whole. Each measurement runs in its own process.
+Streamed peak memory should stay flat as the file grows.
+
+python bench/bench_stream.py [sizes in MB, default 16,64,256] [folder for the files]
+python bench/bench_stream.py 1024,4096 /mnt/scratch     # Multi-GB
+"""
+
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+BLOCKS = {
+    "scan": """SECT    Replay %d
+REQ     POST    http://127.0.0.1:8080/full-echo     {{"id": %d, "user": "user%d", "items": [1, 2, 3]}}
+RES     {{"$status": 200, "id": %d, "$elapsed_ms": {"$lt": 1000}}}
+""",
+    "run": """SET     $case   {{"id": %d, "user": "user%d", "items": [1, 2, 3]}}
+ASSERT  $case.id >= 0
+ASSERT  $case.items  {[1, 2, 3]}
+""",
+}
+
+def Generate(path:str, mode:str, size:int):
+    block, written, i = BLOCKS[mode], 0, 0
+    with open(path, "w") as f:
+        while written < size:
+            chunk = "".join(block % ((n,) * block.count("%d")) for n in range(i, i + 10000))
+            f.write(chunk)
+            written += len(chunk)
+            i += 10000
+
+def Child(mode:str, path:str, stream:bool):
+    import runner
+    runner.APT.STREAM_SIZE = 0 if stream else float("inf")
+    start, count = time.perf_counter(), 0
+    with open(path, "r") as f:
+        if mode == "scan":
+            for stmt in runner.APT(f):
+                count += 1
+        else:
+            class Null():
+                def write(self, s): return len(s)
+                def flush(self): pass
+            r = runner.APTRunner(f, out=Null())
+            r.Run()
+            count = r.APT.scanner.GetLastStatementLineNumber() # Lines run
+            if r.testFailed: raise Exception(r.failures[:3])
+    print(json.dumps({"count": count, "seconds": time.perf_counter() - start,
+                      "maxrss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}))
+
+def Measure(mode:str, path:str, stream:bool) -> dict:
+    out = subprocess.run([sys.executable, __file__, "--child", mode, path, "1" if stream else "0"], capture_output=True, text=True)
+    if out.returncode != 0:
+        raise Exception(out.stderr)
+    return json.loads(out.stdout)
+
+def main(argv):
+    if len(argv) > 1 and argv[1] == "--child":
+        return Child(argv[2], argv[3], argv[4] == "1")
+    sizes = [int(mb) for mb in (argv[1] if len(argv) > 1 else "16,64,256").split(",")]
+    folder = argv[2] if len(argv) > 2 else None
+    print("%-5s %8s %12s %10s %12s %14s %14s" % ("mode", "MB", "stmts", "seconds", "stmts/s", "streamed RSS", "whole RSS"))
+    for mode in ["scan", "run"]:
+        for mb in sizes:
+            with tempfile.TemporaryDirectory(dir=folder) as tmp:
+                path = os.path.join(tmp, "generated.apitest")
+                Generate(path, mode, mb * 1024 * 1024)
+                streamed = Measure(mode, path, True)
+                whole = Measure(mode, path, False) if mb <= 64 else None # Read whole, larger files take many GB
+                print("%-5s %8d %12d %10.1f %12.0f %12.1fMB %12sMB" % (mode, mb, streamed["count"], streamed["seconds"],
+                      streamed["count"] / streamed["seconds"], streamed["maxrss"] / 1048576,
+                      "%.1f" % (whole["maxrss"] / 1048576) if whole != None else "-"))
+                sys.stdout.flush()
+
+if __name__ == "__main__":
+    main(sys.argv)
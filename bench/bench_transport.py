@@ -0,0 +1,41 @@
+""" Transport benchmark
+
+Compare per-call requests.request with the pooled APTTransport.
+Start the stand-in server first: python tests/test_server.py
+
+python bench/bench_transport.py [count] [url]
+"""
+
+import os
+import sys
+import time
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from runner import APTTransport
+
+def Measure(name, count, call):
+    start = time.perf_counter()
+    for _ in range(count):
+        call()
+    elapsed = time.perf_counter() - start
+    print("%-30s %6d req  %8.3fs  %10.1f req/s" % (name, count, elapsed, count / elapsed))
+    return count / elapsed
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 500
+    url = argv[2] if len(argv) > 2 else "http://127.0.0.1:8080/ping"
+
+    perCall = Measure("requests.request", count, lambda: requests.request("GET", url, verify=False))
+    transport = APTTransport()
+    pooled = Measure("APTTransport (pooled)", count, lambda: transport.Request("GET", url, verify=False))
+    noKeepAlive = APTTransport(keepAlive=False)
+    Measure("APTTransport (no keep-alive)", count, lambda: noKeepAlive.Request("GET", url, verify=False))
+
+    print("Speedup: %.2fx" % (pooled / perCall))
+    print("Pool:", transport.Stats())
+    transport.Close()
+    noKeepAlive.Close()
+
+if __name__ == "__main__":
+    main(sys.argv)
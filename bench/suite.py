@@ -0,0 +1,212 @@
+""" Benchmark suite
+
+Measure the scanner, expression resolve, assertion matching, APTRunner.Run requests against an in-process
+stand-in server (tests/test_server.py) and peak memory on large generated files and payloads.
+Results are written as JSON and compared with a stored baseline. Exits with 1 if a result is worse than
+the baseline by more than the tolerance.
+
+python bench/suite.py                                   # Compare with bench/baseline.json
+python bench/suite.py --save-baseline                   # Record the baseline, on the machine that will compare with it
+python bench/suite.py --only scanner,run --tolerance 0.3
+
+Throughputs are the median of --repeat runs, each repeating the operation for at least MIN_SECONDS like
+timeit's autorange. Peak memory is measured in a process of its own.
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "tests"))
+from runner import APTEnv, APTMatcher, APTRunner, APTTransport
+import bench_expr
+import bench_scanner
+import bench_stream
+import test_server
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+RESULTS = os.path.join(os.path.dirname(__file__), "results.json")
+MIN_SECONDS = 0.2 # Shortest timed run, so timer resolution and scheduling noise stay small
+
+class Null():
+    def write(self, s): return len(s)
+    def flush(self): pass
+
+def Timed(number:int, call) -> float:
+    start = time.perf_counter()
+    for _ in range(number):
+        call()
+    return time.perf_counter() - start
+
+def Rate(repeat:int, count:int, call) -> float:
+    """ Median rate of count operations per second over repeat runs of call, each run lasting at least MIN_SECONDS """
+    number = 1
+    while True: # Calibrate, like timeit.Timer.autorange
+        elapsed = Timed(number, call)
+        if elapsed >= MIN_SECONDS:
+            break
+        number = max(number * 2, int(number * MIN_SECONDS / max(elapsed, 1e-9)) + 1)
+    rates = [count * number / elapsed] + [count * number / Timed(number, call) for _ in range(repeat - 1)]
+    return statistics.median(rates)
+
+def Scanner(repeat:int) -> float:
+    data = bench_scanner.Generate(20000)
+    count = bench_scanner.Parse(data)
+    return Rate(repeat, count, lambda: bench_scanner.Parse(data))
+
+def Resolve(repeat:int) -> float:
+    exprs, env = bench_expr.Payloads(), APTEnv()
+    for name, val in {"$id": 1, "$data": {"data": "XXX"}, "$BASE_REQ": {"$header": {"A": "B"}}, "$base_data": {"a": 1}, "$street": "S", "$id2": 2}.items():
+        env.setVar(name, val) # The $vars of the payloads, see bench_expr.py
+    def run():
+        for _ in range(200):
+            for expr in exprs: expr.resolve(env)
+    return Rate(repeat, 200 * len(exprs), run)
+
+def Match(repeat:int) -> float:
+    items = 2000
+    response = {"$status": 200,
+                "records": {"r%d" % i: {"id": i, "owner": {"name": "user%d" % i}} for i in range(items)},
+                "items": [{"sku": "SKU-%d" % i, "qty": i % 7} for i in range(items)]}
+    expect = {"$status": 200, "items": {"$unordered": list(reversed(response["items"]))}}
+    for i in range(items):
+        expect["records.r%d.id" % i] = i
+    matcher = APTMatcher(expect)
+    assert matcher.Match(response) == []
+    return Rate(repeat, 50, lambda: [matcher.Match(response) for _ in range(50)])
+
+def Run(repeat:int, url:str) -> float:
+    """ Requests per second of APTRunner.Run over REQ/RES pairs, on one pooled transport """
+    count = 500
+    script = "".join("""SECT    Case %d
+REQ     POST    %s/full-echo     {{"id": %d, "name": "user%d"}}
+RES     {{"$status": 200, "id": %d}}
+REQ     GET     %s/ping
+RES     {{"$status": 200, "status": "OK"}}
+""" % (i, url, i, i, i, url) for i in range(count // 2))
+    transport = APTTransport()
+    def run():
+        runner = APTRunner(io.StringIO(script), out=Null(), transport=transport)
+        runner.Run()
+        if runner.testFailed: raise Exception(runner.failures[:3])
+    try:
+        return Rate(repeat, count, run)
+    finally:
+        transport.Close()
+
+def Payload(path:str) -> dict:
+    """ Post a large body from an @file template to the stand-in server and check fields of the echoed response """
+    server = test_server.start()
+    items = [{"sku": "SKU-%d" % i, "qty": i, "tags": ["a", "b", "c"], "note": "x" * 100} for i in range(100000)]
+    with open(os.path.join(path, "payload.json"), "w") as f:
+        json.dump({"data": {"items": items}}, f)
+    del items
+    with open(os.path.join(path, "payload.apitest"), "w") as f:
+        f.write("""REQ     POST    http://127.0.0.1:%d/full-echo     @payload.json:data
+RES     {{"$status": 200, "items[0].sku": "SKU-0", "items[99999].qty": 99999}}
+""" % server.server_address[1])
+    start = time.perf_counter()
+    with open(os.path.join(path, "payload.apitest"), "r") as f:
+        runner = APTRunner(f, out=Null(), transport=APTTransport(maxBodySize=1024 * 1024 * 1024))
+        runner.Run()
+    if runner.testFailed: raise Exception(runner.failures)
+    return {"seconds": time.perf_counter() - start, "maxrss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+
+def Child(argv):
+    print(json.dumps(Payload(argv[2])))
+
+def PayloadMemory() -> float:
+    with tempfile.TemporaryDirectory() as tmp:
+        out = subprocess.run([sys.executable, __file__, "--child", tmp], capture_output=True, text=True)
+        if out.returncode != 0:
+            raise Exception(out.stderr)
+        return json.loads(out.stdout)["maxrss"] / 1048576
+
+def StreamMemory() -> float:
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "generated.apitest")
+        bench_stream.Generate(path, "scan", 64 * 1024 * 1024)
+        return bench_stream.Measure("scan", path, True)["maxrss"] / 1048576
+
+BENCHMARKS = { # name -> (unit, higher is better, measure(repeat, url))
+    "scanner":          ("stmts/s", True, lambda repeat, url: Scanner(repeat)),
+    "resolve":          ("resolves/s", True, lambda repeat, url: Resolve(repeat)),
+    "match":            ("matches/s", True, lambda repeat, url: Match(repeat)),
+    "run":              ("req/s", True, Run),
+    "payload_memory":   ("MB", False, lambda repeat, url: PayloadMemory()), # 16MB body, posted and echoed
+    "stream_memory":    ("MB", False, lambda repeat, url: StreamMemory()),  # 64MB file, streamed scan
+}
+
+def Compare(results:dict, baseline:dict, tolerance:float) -> list:
+    """ Print results against the baseline. Returns the names of regressed results """
+    regressions = []
+    print("\n%-16s %14s %14s %9s" % ("benchmark", "baseline", "result", "change"))
+    for name, result in results.items():
+        base = baseline.get("results", {}).get(name)
+        if base == None:
+            print("%-16s %14s %14.1f %9s" % (name, "-", result["value"], "new"))
+            continue
+        change = result["value"] / base["value"] - 1 if base["value"] else 0.0
+        regressed = change < -tolerance if result["higher"] else change > tolerance
+        if regressed: regressions.append(name)
+        print("%-16s %14.1f %14.1f %+8.1f%% %s" % (name, base["value"], result["value"], change * 100, "REGRESSED" if regressed else ""))
+    return regressions
+
+def Machine() -> dict:
+    return {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()}
+
+def main(argv):
+    if len(argv) > 1 and argv[1] == "--child":
+        return Child(argv)
+    parser = argparse.ArgumentParser(prog=os.path.basename(argv[0]), description="APT benchmark suite")
+    parser.add_argument("--only", default=None, help="Comma separated benchmarks: %s" % ", ".join(BENCHMARKS))
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of each throughput benchmark, the median is kept")
+    parser.add_argument("--output", default=RESULTS, help="Results JSON file")
+    parser.add_argument("--baseline", default=BASELINE, help="Baseline JSON file to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed regression, as a fraction of the baseline")
+    parser.add_argument("--save-baseline", action="store_true", help="Write the results as the baseline instead of comparing")
+    args = parser.parse_args(argv[1:])
+
+    names = args.only.split(",") if args.only else list(BENCHMARKS)
+    server = test_server.start()
+    url = "http://127.0.0.1:%d" % server.server_address[1]
+    results = {}
+    for name in names:
+        unit, higher, measure = BENCHMARKS[name]
+        value = measure(args.repeat, url)
+        results[name] = {"value": round(value, 1), "unit": unit, "higher": higher}
+        print("%-16s %14.1f %s" % (name, value, unit))
+        sys.stdout.flush()
+    server.shutdown()
+
+    report = {"machine": Machine(), "created": time.strftime("%Y-%m-%dT%H:%M:%S"), "results": results}
+    with open(args.baseline if args.save_baseline else args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    if args.save_baseline:
+        print("\nBaseline written to %s" % args.baseline)
+        return 0
+    if not os.path.exists(args.baseline):
+        print("\nNo baseline at %s, record one with --save-baseline" % args.baseline)
+        return 0
+    with open(args.baseline, "r") as f:
+        baseline = json.load(f)
+    if baseline.get("machine") != report["machine"]:
+        print("\nBaseline was recorded on another machine (%s), results may not be comparable" % json.dumps(baseline.get("machine")))
+    regressions = Compare(results, baseline, args.tolerance)
+    if len(regressions) > 0:
+        print("\n%d benchmark(s) regressed by more than %d%%: %s" % (len(regressions), args.tolerance * 100, ", ".join(regressions)))
+        return 1
+    print("\nNo regression over %d%%" % (args.tolerance * 100))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
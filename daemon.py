@@ -0,0 +1,148 @@
+""" Runner daemon
+
+Keeps the interpreter, imported modules, parsed files, templates and HTTP pools warm between runs,
+serving them on a Unix socket. runner.py forwards its command line to a running daemon and streams
+the output back, or runs in-process when there is none.
+
+python runner.py --daemon               # Serve on $APT_DAEMON_SOCKET, default ~/.cache/apt/daemon.sock
+python runner.py tests/                 # Runs on the daemon if it is running
+python runner.py --no-daemon tests/     # Always in-process
+
+Only the standard library is imported by the client side, the runner is imported when the daemon starts.
+Runs are executed one at a time, in the client's working directory.
+"""
+
+import json
+import os
+import socket
+import sys
+import time
+import typing
+
+LOCAL_FLAGS = {"--daemon", "--no-daemon", "--watch", "--coordinator", "--worker"} # Never forwarded
+
+def socketPath() -> str:
+    if os.environ.get("APT_DAEMON_SOCKET"):
+        return os.environ["APT_DAEMON_SOCKET"]
+    root = os.environ.get("APT_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "apt"))
+    return os.path.join(root, "daemon.sock")
+
+def connect(path:str) -> typing.Optional[socket.socket]:
+    if not hasattr(socket, "AF_UNIX") or not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        return sock
+    except OSError: # Stale socket file
+        sock.close()
+        return None
+
+def forward(argv:list) -> typing.Optional[int]:
+    """ Run a command line on the daemon, printing its output. Returns the exit code, None if no daemon ran it """
+    if len(LOCAL_FLAGS & set(argv)) > 0 or os.environ.get("APT_NO_DAEMON"):
+        return None
+    sock = connect(socketPath())
+    if sock == None:
+        return None
+    with sock:
+        sock.sendall((json.dumps({"argv": argv, "cwd": os.getcwd()}) + "\n").encode("utf-8"))
+        for line in sock.makefile("r", encoding="utf-8"):
+            msg = json.loads(line)
+            if "out" in msg:
+                sys.stdout.write(msg["out"])
+                sys.stdout.flush()
+            elif "exit" in msg:
+                return msg["exit"]
+    print("Daemon closed the connection before the run finished", file=sys.stderr)
+    return 1
+
+
+class Output():
+    """ stdout/stderr of a forwarded run. Writes are sent to the client in batches """
+    MAX_DELAY, MAX_SIZE = 0.05, 16 * 1024
+    class ClientGone(Exception): pass
+
+    def __init__(self, conn:socket.socket):
+        self.conn = conn
+        self.buffer, self.size, self.sentAt = [], 0, time.monotonic()
+
+    def write(self, s:str) -> int:
+        self.buffer.append(s)
+        self.size += len(s)
+        if self.size >= self.MAX_SIZE or time.monotonic() - self.sentAt >= self.MAX_DELAY:
+            self.flush()
+        return len(s)
+
+    def flush(self):
+        if self.size > 0:
+            self.Send({"out": "".join(self.buffer)})
+            self.buffer, self.size = [], 0
+        self.sentAt = time.monotonic()
+
+    def Send(self, msg:dict):
+        try:
+            self.conn.sendall((json.dumps(msg) + "\n").encode("utf-8"))
+        except OSError as e: # Told apart from the OSErrors of the run itself
+            raise self.ClientGone(e)
+
+
+def serve(path:str = None) -> int:
+    import contextlib, signal, threading, traceback
+    import runner # The imports the daemon keeps warm
+
+    path = socketPath() if path == None else path
+    existing = connect(path)
+    if existing != None:
+        existing.close()
+        print("A daemon is already listening on %s" % path)
+        return 1
+    if os.path.exists(path):
+        os.unlink(path)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    os.chmod(path, 0o600)
+    server.listen(16)
+    lock = threading.Lock() # Runs change the working directory and sys.stdout
+
+    def handle(conn:socket.socket):
+        with conn:
+            try:
+                request = json.loads(conn.makefile("r", encoding="utf-8").readline())
+            except ValueError:
+                return
+            out, code = Output(conn), 1
+            with lock:
+                cwd = os.getcwd()
+                try:
+                    os.chdir(request["cwd"])
+                    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+                        code = runner.main(request["argv"], warm=True)
+                except SystemExit as e: # argparse --help and errors
+                    code = e.code if isinstance(e.code, int) else (0 if e.code == None else 1)
+                except Output.ClientGone:
+                    return
+                except Exception: # Including the run's own OSErrors, e.g. a missing PREREQ or a bad cwd
+                    code = 1
+                    try:                        out.write(traceback.format_exc())
+                    except Output.ClientGone:   return
+                finally:
+                    os.chdir(cwd)
+            try:
+                out.flush()
+                out.Send({"exit": code})
+            except Output.ClientGone: pass
+
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0)) # Remove the socket on kill too
+    print("Runner daemon listening on %s" % path)
+    sys.stdout.flush()
+    try:
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        server.close()
+        os.unlink(path)
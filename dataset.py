@@ -0,0 +1,105 @@
+""" Data-driven runs
+
+Run an .apitest file once per row of a CSV or JSON-lines dataset
+
+The file is parsed once. Each row runs on a fork of the runner with a fresh APTEnv holding the row's columns as $vars,
+at most --data-concurrency rows at a time. CSV cells are bound as strings, JSON-lines values keep their JSON type.
+The dataset is read as rows are run, so its size doesn't matter. A row that raises an error fails on its own.
+
+The output of the first row is shown. Failed rows are listed with their failures, in row order.
+
+python runner.py --data rows.csv contract.apitest
+python runner.py --data rows.jsonl --data-concurrency 32 contract.apitest
+
+"""
+
+import csv
+import io
+import itertools
+import json
+import os
+import time
+import typing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from runner import APTEnv, APTRunner, APTTransport
+
+MAX_LISTED = 50 # Failed rows listed in full, the others are only counted
+
+def Rows(f:typing.TextIO, path:str) -> typing.Iterator[dict]:
+    """ Rows of a .csv (with a header line) or .jsonl dataset """
+    if os.path.splitext(path)[1].lower() == ".csv":
+        for row in csv.DictReader(f):
+            yield {k: v for k, v in row.items() if k != None}
+    else:
+        for line in f:
+            if line.strip() != "":
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    yield line.strip() # Fails as a row that is not an object
+
+def Describe(row:dict) -> str:
+    text = json.dumps(row, ensure_ascii=False, default=str)
+    return text if len(text) <= 100 else text[:97] + "..."
+
+def runRow(base:APTRunner, statements:list, row:dict) -> APTRunner:
+    runner = base.Fork(io.StringIO())
+    runner.env = APTEnv()
+    try:
+        if not isinstance(row, dict):
+            raise ValueError("Row is not an object: %s" % Describe(row))
+        for name, val in row.items():
+            runner.env.setVar(name, val)
+        for stmt in statements:
+            if not runner.Exec(stmt):
+                break
+    except Exception as e: # Only this row fails, like a file in runCaptured
+        runner.Log("    [ERROR] %s" % e)
+        runner.testFailed = True
+        runner.failures.append("[ERROR] %s" % e)
+    finally:
+        runner.EndSection()
+        runner.ReleaseResponse()
+    return runner
+
+def runDataset(filepath:str, dataPath:str, concurrency:int = 10, transport:APTTransport = None, parseCache = None, prereqCache = None) -> bool:
+    """ Run a file for each row of a dataset and print the failed rows. Returns False if any row failed """
+    if transport == None:
+        transport = APTTransport(poolSize=max(10, concurrency))
+    print("\n\n%s" % filepath)
+    print("===========================")
+    with open(filepath, "r") as f:
+        base = APTRunner(f, transport=transport, parseCache=parseCache, prereqCache=prereqCache)
+        statements = list(base.APT)
+
+    start = time.monotonic()
+    count, failed = 0, 0
+    with open(dataPath, "r", newline="") as data, ThreadPoolExecutor(max_workers=concurrency) as executor:
+        rows = enumerate(Rows(data, dataPath), 1)
+        window = deque() # Rows in flight, reported in order
+        while True:
+            for number, row in itertools.islice(rows, 2 * concurrency - len(window)):
+                window.append((number, row, executor.submit(runRow, base, statements, row)))
+            if len(window) == 0:
+                break
+            number, row, future = window.popleft()
+            runner = future.result()
+            count += 1
+            if number == 1:
+                print("Row 1 %s" % Describe(row))
+                print(runner.out.getvalue(), end="")
+            if runner.testFailed:
+                failed += 1
+                if number != 1 and failed <= MAX_LISTED:
+                    print("Row %d %s" % (number, Describe(row)))
+                    for line in runner.failures:
+                        print("    " + line)
+    elapsed = time.monotonic() - start
+
+    if failed > MAX_LISTED:
+        print("... %d more failed row(s)" % (failed - MAX_LISTED))
+    print("\nRows: %d in %.1fs (%.1f rows/s), %d passed, %d failed" % (count, elapsed, count / max(elapsed, 1e-9), count - failed, failed))
+    print("All test passed!" if failed == 0 else "Test failed. See logs for error")
+    return failed == 0
@@ -0,0 +1,152 @@
+""" Distributed runs
+
+A coordinator collects the .apitest files like main() does and serves them over TCP to worker processes,
+which can run on other machines with the same checkout. Workers ask for one file at a time, so a fast worker
+takes more files than a slow one. Files are handed out longest known duration first, from the run history (APTHistory);
+unknown files go first. If a worker disconnects while running a file, the file is queued again.
+The protocol is unauthenticated, only use it on a trusted network.
+
+python runner.py --coordinator 0.0.0.0:7000 tests/
+python runner.py --worker coordinator-host:7000         # On each node, from the same folder
+
+Messages are JSON lines:
+    worker -> coordinator   {"hello": name}, {"result": {...}}
+    coordinator -> worker   {"run": file}, {"done": true}
+"""
+
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+import typing
+
+from runner import APTHistory, printSummary, runCaptured
+
+def address(hostport:str, defaultHost:str) -> typing.Tuple[str, int]:
+    host, _, port = hostport.rpartition(":")
+    return host or defaultHost, int(port)
+
+def send(f, msg:dict):
+    f.write((json.dumps(msg) + "\n").encode("utf-8"))
+    f.flush()
+
+def receive(f) -> typing.Optional[dict]:
+    line = f.readline()
+    return json.loads(line) if line else None
+
+
+class Coordinator(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    MAX_ATTEMPTS = 3 # A file that takes down this many workers is reported as failed
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            server:Coordinator = self.server
+            hello = receive(self.rfile)
+            if hello == None: return
+            name = hello.get("hello", "%s:%d" % self.client_address)
+            server.Joined(name)
+            while True:
+                f = server.Take()
+                if f == None:
+                    send(self.wfile, {"done": True})
+                    return
+                try:
+                    send(self.wfile, {"run": f})
+                    msg = receive(self.rfile)
+                except (OSError, ValueError):
+                    msg = None
+                if msg == None or "result" not in msg:
+                    server.Requeue(f, name)
+                    return
+                server.Complete(f, msg["result"])
+
+    def __init__(self, hostport:str, files:typing.List[str], history:APTHistory = None, failFast = False):
+        super().__init__(address(hostport, "127.0.0.1"), self.Handler)
+        self.files, self.failFast = files, failFast
+        self.queue = history.Longest(files) if history != None else list(files)
+        self.running, self.results, self.attempts = set(), {}, {}
+        self.workers, self.requeued = set(), 0
+        self.cond = threading.Condition()
+
+    def Joined(self, name:str):
+        with self.cond:
+            self.workers.add(name)
+            print("Worker %s joined" % name)
+
+    def Take(self) -> typing.Optional[str]:
+        """ Next file to run. Waits while others are running, as they may be requeued. None when all are done """
+        with self.cond:
+            while len(self.queue) == 0 and len(self.running) > 0:
+                self.cond.wait()
+            if len(self.queue) == 0:
+                return None
+            f = self.queue.pop(0)
+            self.running.add(f)
+            return f
+
+    def Requeue(self, f:str, name:str):
+        with self.cond:
+            self.running.discard(f)
+            self.attempts[f] = self.attempts.get(f, 0) + 1
+            print("Worker %s lost while running %s" % (name, f))
+            if self.attempts[f] >= self.MAX_ATTEMPTS:
+                self.Finish(f, {"file": f, "passed": False, "duration": 0, "output": "",
+                                "failures": ["[ERROR] Worker lost %d times while running this file" % self.attempts[f]]})
+            else:
+                self.requeued += 1
+                self.queue.insert(0, f)
+            self.cond.notify_all()
+
+    def Complete(self, f:str, result:dict):
+        with self.cond:
+            self.running.discard(f)
+            self.Finish(f, result)
+            self.cond.notify_all()
+
+    def Finish(self, f:str, result:dict):
+        self.results[f] = result
+        sys.stdout.write(result.get("output", ""))
+        sys.stdout.flush()
+        if self.failFast and not result["passed"]:
+            self.queue.clear() # Running files still report
+        if len(self.queue) == 0 and len(self.running) == 0:
+            threading.Thread(target=self.shutdown, daemon=True).start()
+
+
+def coordinate(hostport:str, files:typing.List[str], history:APTHistory = None, failFast = False) -> int:
+    """ Serve files to workers until every file has a result, then print the merged report """
+    with Coordinator(hostport, files, history, failFast) as server:
+        host, port = server.server_address[:2]
+        print("Coordinating %d file(s) on %s:%d" % (len(files), host, port))
+        sys.stdout.flush()
+        start = time.time()
+        if len(files) > 0:
+            server.serve_forever()
+        results = [server.results[f] for f in files if f in server.results]
+    printSummary(results)
+    print("%d worker(s), %d requeued, %.2fs" % (len(server.workers), server.requeued, time.time() - start))
+    if len(results) < len(files):
+        print("Stopped after the first failure, %d file(s) not run" % (len(files) - len(results)))
+    if history != None:
+        history.Record([r for r in results if r["duration"] > 0])
+        history.Close()
+    return 0 if all(r["passed"] for r in results) else 1
+
+def work(hostport:str, options:dict, transportOptions:dict) -> int:
+    """ Run files from a coordinator until it has no more """
+    name = "%s:%d" % (socket.gethostname(), os.getpid())
+    with socket.create_connection(address(hostport, "127.0.0.1")) as sock:
+        f = sock.makefile("rwb")
+        send(f, {"hello": name})
+        while True:
+            msg = receive(f)
+            if msg == None or msg.get("done"):
+                return 0
+            result = runCaptured(msg["run"], transportOptions, **options)
+            result.pop("trace", None)
+            send(f, {"result": result})
@@ -0,0 +1,194 @@
+""" Load testing
+
+Run an .apitest file as a scenario with virtual users (VU)
+
+Each VU runs the file's statements in a loop with its own APTEnv. RES assertions are still checked,
+failures are counted by kind. Latencies are recorded per REQ in log-linear (HDR style) histograms.
+
+python runner.py --load --users 50 --duration 30 --ramp-up 5 scenario.apitest
+python runner.py --load --users 50 --rate 200 --duration 30 scenario.apitest
+
+"""
+
+import time
+import threading
+from collections import Counter
+
+from runner import APT, APTEnv, APTRunner, APTTransport
+
+class Null():
+    """ Output of the VUs, shared. Opening os.devnull per VU would use a file descriptor each """
+    def write(self, s): return len(s)
+    def flush(self): pass
+
+NULL = Null()
+
+class LatencyHistogram():
+    """ Log-linear histogram of latencies in microseconds, ~1% precision """
+    SUB_BITS = 7
+    HALF = 1 << SUB_BITS        # Linear sub-buckets per power of 2
+    LINEAR = HALF << 1          # Values below this are recorded exactly
+
+    def __init__(self):
+        self.counts = Counter()
+        self.count, self.total, self.min, self.max = 0, 0, None, 0
+
+    @classmethod
+    def Index(cls, v:int) -> int:
+        if v < cls.LINEAR: return v
+        shift = v.bit_length() - cls.SUB_BITS - 1
+        return cls.LINEAR + (shift - 1) * cls.HALF + ((v >> shift) - cls.HALF)
+
+    @classmethod
+    def Value(cls, index:int) -> int:
+        """ Middle of the bucket """
+        if index < cls.LINEAR: return index
+        shift = (index - cls.LINEAR) // cls.HALF + 1
+        sub = (index - cls.LINEAR) % cls.HALF + cls.HALF
+        return (sub << shift) + (1 << (shift - 1))
+
+    def Record(self, seconds:float):
+        v = max(0, int(seconds * 1000000))
+        self.counts[self.Index(v)] += 1
+        self.count += 1
+        self.total += v
+        self.min = v if self.min == None else min(self.min, v)
+        self.max = max(self.max, v)
+
+    def Merge(self, other:'LatencyHistogram'):
+        self.counts.update(other.counts)
+        self.count += other.count
+        self.total += other.total
+        if other.min != None:
+            self.min = other.min if self.min == None else min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def Percentile(self, p:float) -> float:
+        """ Latency in ms at percentile p (0-100) """
+        if self.count == 0: return 0.0
+        rank, seen = max(1, int(p / 100 * self.count + 0.5)), 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self.Value(index), self.max) / 1000
+        return self.max / 1000
+
+    def Mean(self) -> float:
+        return self.total / self.count / 1000 if self.count > 0 else 0.0
+
+
+class VirtualUserRunner(APTRunner):
+    """ Runner for one VU. Failures are counted by kind instead of being logged
+
+    REQs are timed here, so those run by REPEAT iterations (forks of this runner) are recorded too.
+    """
+    vu = None               # VirtualUser recording the latencies
+    requestFailed = False
+
+    def Fail(self, msg, kind = "assert"):
+        self.testFailed = True
+        self.requestFailed = self.requestFailed or kind == "request"
+        with self.vu.lock: # Shared with the REPEAT iterations of the VU
+            self.errors[kind] += 1
+
+    def Exec(self, stmt) -> bool:
+        if self.vu == None or not isinstance(stmt, APT.Statement.Request):
+            return super().Exec(stmt)
+        self.requestFailed = False
+        start = time.perf_counter()
+        try:     return super().Exec(stmt)
+        finally: self.vu.Record(stmt, time.perf_counter() - start, self.requestFailed)
+
+
+class VirtualUser():
+    def __init__(self, base:APTRunner, statements:list, labels:dict):
+        self.runner = base.Fork(NULL)
+        self.runner.env = APTEnv() # Own $vars, $_UID and $_RANDOM per user
+        self.statements, self.labels = statements, labels
+        self.latencies = {label: LatencyHistogram() for label in labels.values()}
+        self.requestErrors = Counter()  # label -> failed requests
+        self.iterations, self.requests = 0, 0
+        self.lock = threading.Lock()
+        self.runner.errors = Counter()
+        self.runner.vu = self
+
+    def Record(self, stmt:APT.Statement.Request, elapsed:float, failed:bool):
+        label = self.labels[id(stmt)]
+        with self.lock:
+            self.latencies[label].Record(elapsed)
+            self.requests += 1
+            if failed:
+                self.requestErrors[label] += 1
+
+    def Iterate(self):
+        runner = self.runner
+        runner.ReleaseResponse()
+        runner.lastRes = None
+        for stmt in self.statements:
+            if isinstance(stmt, APT.Statement.Request):
+                runner.Exec(stmt)
+            elif not runner.Exec(stmt):
+                break
+        self.iterations += 1
+
+    def Run(self, startAt:float, endAt:float, interval:float):
+        """ Closed loop when interval is 0, otherwise start an iteration every interval seconds """
+        now = time.monotonic()
+        if startAt > now: time.sleep(startAt - now)
+        nextAt = time.monotonic()
+        while time.monotonic() < endAt:
+            self.Iterate()
+            if interval > 0:
+                nextAt += interval
+                delay = nextAt - time.monotonic()
+                if delay > 0:   time.sleep(min(delay, max(0, endAt - time.monotonic())))
+                else:           nextAt = time.monotonic() # Behind schedule, don't burst to catch up
+
+
+def Label(runner:APTRunner, stmt:APT.Statement.Request) -> str:
+    return "line %d: REQ %s %s" % (runner.APT.scanner.StatementLineNumber(stmt), stmt.method, stmt.url)
+
+def runLoad(filepath:str, users:int, duration:float, rampUp:float = 0, rate:float = 0, transport:APTTransport = None) -> bool:
+    """ Run a file as a load scenario and print a report. Returns False if any failure was seen """
+    if transport == None:
+        transport = APTTransport(poolSize=max(10, users))
+    with open(filepath, "r") as f:
+        base = VirtualUserRunner(f, transport=transport)
+        statements = list(base.APT)
+    labels = {id(stmt): Label(base, stmt) for stmt in APT.Statement.Walk(statements) if isinstance(stmt, APT.Statement.Request)}
+
+    vus = [VirtualUser(base, statements, labels) for _ in range(users)]
+    interval = users / rate if rate > 0 else 0
+    start = time.monotonic() + 0.1
+    endAt = start + rampUp + duration
+    threads = []
+    for i, vu in enumerate(vus):
+        t = threading.Thread(target=vu.Run, args=(start + rampUp * i / users, endAt, interval), daemon=True)
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - start
+
+    # Merge VU results
+    latencies = {label: LatencyHistogram() for label in labels.values()}
+    errors, requestErrors = Counter(), Counter()
+    for vu in vus:
+        for label, h in vu.latencies.items():
+            latencies[label].Merge(h)
+        errors.update(vu.runner.errors)
+        requestErrors.update(vu.requestErrors)
+    iterations = sum(vu.iterations for vu in vus)
+    requests = sum(vu.requests for vu in vus)
+
+    print("\n\n%s" % filepath)
+    print("===========================")
+    print("Users: %d, ramp-up: %.1fs, duration: %.1fs, mode: %s" % (users, rampUp, duration, "%.1f it/s" % rate if rate > 0 else "closed loop"))
+    print("Iterations: %d (%.1f it/s), requests: %d (%.1f req/s)" % (iterations, iterations / elapsed, requests, requests / elapsed))
+    print("\n%-50s %8s %7s %9s %9s %9s %9s %9s %9s" % ("Request", "count", "errors", "mean", "p50", "p90", "p99", "p999", "max"))
+    for label, h in latencies.items():
+        print("%-50s %8d %7d %8.2fms %8.2fms %8.2fms %8.2fms %8.2fms %8.2fms" % (
+            label[:50], h.count, requestErrors[label], h.Mean(),
+            h.Percentile(50), h.Percentile(90), h.Percentile(99), h.Percentile(99.9), h.max / 1000))
+    print("\nErrors: %s" % (", ".join("%s=%d" % (k, v) for k, v in sorted(errors.items())) if errors else "none"))
+    return len(errors) == 0
@@ -1,19 +1,35 @@
 """ Postman collection
 
-Export postman collection into files and folders
+Convert a postman collection into .apitest files and folders that runner.py can run, and back
 
-Import postman collection from folder into a postman collection file
+python postman_collection.py to-apitest "Test Collection.postman_collection.json" test_collection
+python postman_collection.py to-postman test_collection test_output.postman_collection.json
 
+Folders become directories and requests become .apitest files, numbered to keep the collection order.
+{{var}} becomes $var, tests and saved examples become RES, collection variables are SET in collection.subtest
+which every file runs as a PREREQ. Test script lines that can't be converted are kept in a comment.
+The collection is stream-parsed and files are written by worker processes, so memory stays bounded by a single request.
+
+Export postman collection into files and folders (JSON per item), and import it back
+
+python postman_collection.py split "Test Collection.postman_collection.json" test_collection
+python postman_collection.py join test_collection test_output.postman_collection.json
 """
 
+import argparse
+import collections
+import itertools
 import json
 import os
+import re
+import sys
+import typing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 
 def LoadPostmanCollection(postmanCollectionFile: str, outputDir: str) :
     def WriteJSON(filepath:str, filename:str, data:dict):
         os.makedirs(filepath, exist_ok=True)
         fullpath = os.path.join(filepath, filename)
-        print(fullpath, json.dumps(data, indent=2), "\n")
         with open(fullpath, "w+") as f:
             f.write(json.dumps(data, indent=2))
 
@@ -56,6 +72,513 @@ def SavePostmanCollection(postmanCollectionFile: str, inputDir: str):
     with open(postmanCollectionFile, "w+") as f:
         f.write(json.dumps(ReadDir(inputDir), indent=2))
 
-# LoadPostmanCollection("Test Collection.postman_collection.json", "test_collection")
 
-SavePostmanCollection("test_output.postman_collection.json", "test_collection")
\ No newline at end of file
+class JSONStream():
+    """ Pull reader for a JSON document too large to load
+
+    Containers are entered with Entries() and Items(), anything else is decoded whole with Value().
+    Text is read in chunks and dropped once decoded.
+    """
+    CHUNK = 1024 * 1024
+    WHITESPACE = re.compile(r"[ \t\n\r]*")
+    decoder = json.JSONDecoder()
+
+    def __init__(self, f: typing.TextIO):
+        self.f, self.buf, self.pos, self.done = f, "", 0, False
+
+    def Fill(self, size: int = CHUNK):
+        chunk = self.f.read(size)
+        self.done = chunk == ""
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+
+    def Peek(self) -> str:
+        """ Next non-whitespace character, "" at the end """
+        while True:
+            self.pos = self.WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) or self.done:
+                return self.buf[self.pos:self.pos + 1]
+            self.Fill()
+
+    def Expect(self, c: str):
+        if self.Peek() != c:
+            raise ValueError("Expected %r at %r" % (c, self.buf[self.pos:self.pos + 40]))
+        self.pos += 1
+
+    def Value(self):
+        self.Peek()
+        while True:
+            try:
+                val, end = self.decoder.raw_decode(self.buf, self.pos)
+                if end < len(self.buf) or self.done: # A number may go on in the next chunk
+                    self.pos = end
+                    return val
+            except json.JSONDecodeError:
+                if self.done: raise
+            self.Fill(max(self.CHUNK, len(self.buf) - self.pos)) # Grows geometrically for large values
+
+    def Entries(self) -> typing.Iterator[str]:
+        """ Keys of an object. The value of each key has to be read before the next one """
+        self.Expect("{")
+        if self.Peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.Value()
+            self.Expect(":")
+            yield key
+            if self.Peek() == ",":
+                self.pos += 1
+                continue
+            self.Expect("}")
+            return
+
+    def Items(self) -> typing.Iterator[None]:
+        """ Steps through an array. Each item has to be read before the next one """
+        self.Expect("[")
+        if self.Peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield
+            if self.Peek() == ",":
+                self.pos += 1
+                continue
+            self.Expect("]")
+            return
+
+
+# Postman -> .apitest
+POSTMAN_VAR = re.compile(r"\{\{([^{}]+)\}\}")
+SUBTEST = "collection.subtest"
+
+def FileName(index: int, name: str) -> str:
+    name = re.sub(r"[^\w\- .]+", "_", name or "").strip(" .")[:80]
+    return "%03d-%s" % (index, name or "unnamed")
+
+def Literal(val) -> str:
+    """ Object literal resolving to val. Backslashes and braces in strings are escaped for the scanner """
+    text, out, inString, i = json.dumps(val, ensure_ascii=False), [], False, 0
+    while i < len(text):
+        c = text[i]
+        if c == "\\":
+            out.append("\\\\" + ("\\\\" if text[i + 1] == "\\" else text[i + 1]))
+            i += 2
+            continue
+        if c == '"': inString = not inString
+        out.append("\\" + c if inString and c in "{}" else c)
+        i += 1
+    return "{" + "".join(out) + "}"
+
+def Text(text: str) -> str:
+    """ text as a parameter, a literal if the scanner would read it as something else """
+    safe = re.match(r"[^$@+\-{\s]", text) and text == text.strip() and not text.startswith("/*") and not re.search(r"\s\s|\t|\n", text)
+    return text if safe else Literal(text)
+
+def StringExpr(text: str) -> str:
+    """ Expression for a string with {{var}} parts, e.g. $baseUrl  +  /users/  +  $id """
+    parts = [("$" + part.strip()) if i % 2 == 1 else Text(part) for i, part in enumerate(POSTMAN_VAR.split(text)) if part != ""]
+    return "  +  ".join(parts) if len(parts) > 0 else Literal("")
+
+def Vars(val, warnings: list):
+    """ Values with "{{var}}" strings as "$var". Other {{...}} can't be resolved and are kept with a warning """
+    if isinstance(val, dict):   return {k: Vars(v, warnings) for k, v in val.items()}
+    if isinstance(val, list):   return [Vars(v, warnings) for v in val]
+    if isinstance(val, str) and "{{" in val:
+        whole = POSTMAN_VAR.fullmatch(val.strip())
+        if whole:
+            return "$" + whole.group(1).strip()
+        warnings.append("%s: {{var}} inside a string is kept as is" % val)
+    elif isinstance(val, str) and val.strip()[:1] in ["$", "@"]:
+        warnings.append("%s: read as a $var or @template by the runner" % val)
+    return val
+
+JS_PATH = r"((?:\.\w+|\[\d+\]|\[[\"'][^\"']+[\"']\])*)"
+JS_COMPARE = {"eql": None, "equal": None, "eq": None, "below": "$lt", "lessThan": "$lt", "above": "$gt", "greaterThan": "$gt",
+              "most": "$lte", "least": "$gte"}
+
+def JSPath(path: str) -> str:
+    """ .data[0]["a b"] -> data[0].a b """
+    path = re.sub(r"\[[\"']([^\"']+)[\"']\]", r".\1", path)
+    return path.lstrip(".")
+
+def JSValue(text: str):
+    text = text.strip().rstrip(";").strip()
+    try:
+        return json.loads(text)
+    except ValueError:
+        import yaml # JS literals with unquoted keys or single quotes
+        return yaml.safe_load(text.replace("'", '"'))
+
+def ScriptToRes(lines: typing.List[str], expect: dict, sets: list) -> typing.List[str]:
+    """ Fill expect from Postman test script lines. Returns the lines that were not converted """
+    aliases = set(re.findall(r"(?:var|let|const)\s+(\w+)\s*=\s*pm\.response\.json\(\)", "\n".join(lines)))
+    json_ = r"(?:pm\.response\.json\(\)%s)" % "".join("|" + a for a in aliases)
+    compare = r"\.to\.(?:be\.|deep\.|have\.|at\.)*(\w+)\((.*?)\)\s*;?\s*(?:\}\);?)?$"
+    left = []
+    for line in lines:
+        s = line.strip()
+        if s == "" or s.startswith("//") or re.match(r"pm\.test\(.*function\s*\(\)\s*\{$|\}\);?$|(?:var|let|const)\s+\w+\s*=\s*pm\.response\.json\(\);?$", s):
+            continue
+        try:
+            m = re.search(r"pm\.response\.to\.have\.status\((\d+)\)", s) or re.search(r"pm\.expect\(pm\.response\.code\)\.to\.(?:be\.)?(?:eql|equal)\((\d+)\)", s) \
+                or re.search(r"tests\[.*\]\s*=\s*responseCode\.code\s*===?\s*(\d+)", s)
+            if m:
+                expect["$status"] = int(m.group(1))
+                continue
+            m = re.search(r"pm\.expect\(pm\.response\.responseTime\)" + compare, s)
+            if m and JS_COMPARE.get(m.group(1)):
+                expect.setdefault("$elapsed_ms", {})[JS_COMPARE[m.group(1)]] = JSValue(m.group(2))
+                continue
+            m = re.search(r"pm\.expect\(pm\.response\.headers\.get\([\"']([^\"']+)[\"']\)\)" + compare, s)
+            if m and m.group(2) in JS_COMPARE and JS_COMPARE[m.group(2)] == None:
+                expect.setdefault("$header", {})[m.group(1)] = JSValue(m.group(3))
+                continue
+            m = re.search(r"pm\.expect\(" + json_ + JS_PATH + r"\)" + compare, s)
+            if m and m.group(2) in JS_COMPARE and m.group(1) != "":
+                op, val = JS_COMPARE[m.group(2)], JSValue(m.group(3))
+                expect[JSPath(m.group(1))] = val if op == None else {op: val}
+                continue
+            m = re.search(r"pm\.(?:environment|collectionVariables|globals|variables)\.set\([\"'](\w+)[\"']\s*,\s*" + json_ + JS_PATH + r"\)", s)
+            if m and m.group(1) != "":
+                sets.append("%s -> $%s" % (JSPath(m.group(2)), m.group(1)))
+                continue
+        except Exception: pass # Unparsable value
+        left.append(line)
+    return left
+
+def ScriptToSet(lines: typing.List[str]) -> typing.Tuple[typing.List[str], typing.List[str]]:
+    """ SET statements for the variables set to literals by a pre-request script, and the lines not converted """
+    statements, left = [], []
+    for line in lines:
+        s = line.strip()
+        m = re.match(r"pm\.(?:environment|collectionVariables|globals|variables)\.set\([\"'](\w+)[\"']\s*,\s*(.+)\)\s*;?$", s)
+        if m:
+            try:
+                statements.append("SET     $%s  %s" % (m.group(1), Literal(JSValue(m.group(2)))))
+                continue
+            except Exception: pass
+        if s != "" and not s.startswith("//"):
+            left.append(line)
+    return statements, left
+
+def Comment(title: str, lines: typing.List[str]) -> str:
+    return "/* %s\n%s\n*/\n" % (title, "\n".join(l.replace("*/", "* /") for l in lines))
+
+def RenderRequest(item: dict, depth: int) -> typing.Tuple[str, typing.List[str]]:
+    """ .apitest text of a request item, and conversion warnings """
+    warnings = []
+    request = item.get("request", {})
+    if isinstance(request, str): request = {"url": request}
+    url = request.get("url", "")
+    url = url.get("raw", "") if isinstance(url, dict) else url
+    scripts = {e.get("listen"): e.get("script", {}).get("exec", []) for e in item.get("event", [])}
+    scripts = {k: v.split("\n") if isinstance(v, str) else v for k, v in scripts.items()}
+
+    data = {}
+    headers = {h["key"]: h.get("value", "") for h in request.get("header", []) if not h.get("disabled")}
+    if len(headers) > 0:
+        data["$header"] = Vars(headers, warnings)
+    body = request.get("body") or {}
+    if body.get("mode") == "raw" and body.get("raw", "").strip() != "":
+        try:
+            raw = json.loads(re.sub(r"([:\[,]\s*)(\{\{[^{}]+\}\})", r'\1"\2"', body["raw"])) # Unquoted {{var}} values
+            if isinstance(raw, dict): data.update(Vars(raw, warnings))
+            else: warnings.append("non-object JSON body not converted")
+        except ValueError:
+            warnings.append("non-JSON raw body not converted")
+    elif body.get("mode") in ["urlencoded", "formdata"]:
+        data.update(Vars({p["key"]: p.get("value", "") for p in body.get(body["mode"], []) if not p.get("disabled")}, warnings))
+        warnings.append("%s body is sent as JSON" % body["mode"])
+    elif body.get("mode") not in [None, "raw"]:
+        warnings.append("%s body not converted" % body.get("mode"))
+
+    expect, sets = {}, []
+    left = ScriptToRes(scripts.get("test", []), expect, sets)
+    if "$status" not in expect and len(item.get("response", [])) > 0 and item["response"][0].get("code"):
+        expect["$status"] = item["response"][0]["code"] # Saved example
+    if len(sets) > 0:
+        expect["$set"] = sets
+    preSets, preLeft = ScriptToSet(scripts.get("prerequest", []))
+
+    name = item.get("name", "")
+    lines = ["/* Converted from Postman: %s */" % name.replace("*/", "* /"), "PREREQ  %s" % "/".join([".."] * depth + [SUBTEST]),
+             "SECT    %s" % Text(name)] + preSets
+    req = "REQ     %s  %s" % (request.get("method", "GET"), StringExpr(url))
+    lines.append(req + ("  " + Literal(data) if len(data) > 0 else ""))
+    if len(expect) > 0:
+        lines.append("RES     %s" % Literal(expect))
+    text = "\n".join(lines) + "\n"
+    if len(preLeft) > 0:
+        text += Comment("Postman pre-request script lines not converted:", preLeft)
+        warnings.append("%d pre-request script line(s) not converted" % len(preLeft))
+    if len(left) > 0:
+        text += Comment("Postman test script lines not converted:", left)
+        warnings.append("%d test script line(s) not converted" % len(left))
+    return text, warnings
+
+def WriteRequests(batch: typing.List[tuple]) -> typing.List[str]:
+    warnings = []
+    for path, item, depth in batch:
+        text, itemWarnings = RenderRequest(item, depth)
+        with open(path, "w") as f:
+            f.write(text)
+        warnings += ["%s: %s" % (path, w) for w in itemWarnings]
+    return warnings
+
+
+class ApitestWriter():
+    """ Writes request files on worker processes in batches, with a bounded number of batches in flight """
+    BATCH = 64
+
+    def __init__(self, pool: ProcessPoolExecutor, limit: int):
+        self.pool, self.limit = pool, limit
+        self.batch, self.pending, self.warnings, self.requests = [], set(), [], 0
+
+    def Submit(self, path: str, item: dict, depth: int):
+        self.batch.append((path, item, depth))
+        self.requests += 1
+        if len(self.batch) >= self.BATCH:
+            self.Flush()
+
+    def Flush(self):
+        if len(self.pending) >= self.limit:
+            done, self.pending = wait(self.pending, return_when=FIRST_COMPLETED)
+            for future in done: self.warnings += future.result()
+        self.pending.add(self.pool.submit(WriteRequests, self.batch))
+        self.batch = []
+
+    def Finish(self):
+        if len(self.batch) > 0: self.Flush()
+        for future in self.pending: self.warnings += future.result()
+        self.pending = set()
+
+def ReadItems(stream: JSONStream, directory: str, depth: int, writer: ApitestWriter):
+    """ Convert the items of a folder as they are parsed """
+    os.makedirs(directory, exist_ok=True)
+    for index, _ in enumerate(stream.Items(), 1):
+        item, folder = {}, None
+        for key in stream.Entries():
+            if key == "item": # Folder. Postman writes its name first
+                folder = os.path.join(directory, FileName(index, item.get("name", "")))
+                ReadItems(stream, folder, depth + 1, writer)
+            else:
+                item[key] = stream.Value()
+        if folder != None:
+            with open(os.path.join(folder, "_folder.json"), "w") as f:
+                json.dump(item, f, indent=2)
+        else:
+            writer.Submit(os.path.join(directory, FileName(index, item.get("name", "")) + ".apitest"), item, depth)
+
+def ToApitest(postmanCollectionFile: str, outputDir: str, jobs: int = None) -> dict:
+    """ Convert a collection into .apitest files under outputDir. Returns counters and warnings """
+    collection = {}
+    with open(postmanCollectionFile, "r", encoding="utf-8") as f, ProcessPoolExecutor(max_workers=jobs) as pool:
+        writer = ApitestWriter(pool, 2 * (jobs or os.cpu_count() or 1))
+        stream = JSONStream(f)
+        for key in stream.Entries():
+            if key == "item":
+                ReadItems(stream, outputDir, 0, writer)
+            else:
+                collection[key] = stream.Value()
+        writer.Finish()
+    os.makedirs(outputDir, exist_ok=True)
+    with open(os.path.join(outputDir, "_collection.json"), "w") as f:
+        json.dump({k: v for k, v in collection.items() if k != "variable"}, f, indent=2)
+    with open(os.path.join(outputDir, SUBTEST), "w") as f:
+        f.write("/* Postman collection variables */\n")
+        for var in collection.get("variable", []):
+            if not var.get("disabled"):
+                f.write("SET     $%s  %s\n" % (var["key"], Literal(var.get("value", ""))))
+    for k in ["auth", "event"]:
+        if k in collection: writer.warnings.append("collection %s not converted" % k)
+    return {"requests": writer.requests, "warnings": writer.warnings}
+
+
+# .apitest -> Postman
+def PostmanString(expr) -> str:
+    """ Postman text of a string expression, $var as {{var}} """
+    from runner import APT
+    if isinstance(expr, APT.Expr.StringLit): expr = expr.deriveType()
+    if isinstance(expr, APT.Expr.Var):      return "{{%s}}" % expr.val.strip()[1:]
+    if isinstance(expr, APT.Expr.BinOp):    return PostmanString(expr.left) + PostmanString(expr.right)
+    if isinstance(expr, APT.Expr.Object):   return PostmanString(APT.Expr.StringLit(expr.val)) if isinstance(expr.val, str) else json.dumps(expr.val)
+    return "" if expr == None or expr.val == None else str(expr.val)
+
+def PostmanVars(val):
+    if isinstance(val, dict):   return {k: PostmanVars(v) for k, v in val.items()}
+    if isinstance(val, list):   return [PostmanVars(v) for v in val]
+    if isinstance(val, str) and val.strip().startswith("$"): return "{{%s}}" % val.strip()[1:]
+    return val
+
+def JSAccess(path: str) -> str:
+    out = ""
+    for part in re.findall(r"[^.\[\]]+|\[\d+\]", path):
+        out += part if part.startswith("[") else ("." + part if re.fullmatch(r"[A-Za-z_]\w*", part) else "[%s]" % json.dumps(part))
+    return out
+
+def ResToScript(expect: dict, warnings: list) -> typing.List[str]:
+    lines = []
+    def check(title, actual, assertion):
+        lines.extend(['pm.test(%s, function () {' % json.dumps(title), "    pm.expect(%s)%s;" % (actual, assertion), "});"])
+    def compare(title, actual, val):
+        ops = {"$lt": "below", "$gt": "above", "$lte": "most", "$gte": "least"}
+        if isinstance(val, dict) and len(val) > 0 and all(k in ops for k in val):
+            for op, bound in val.items(): check(title, actual, ".to.be.at.%s(%s)" % (ops[op], json.dumps(bound)) if op in ["$lte", "$gte"] else ".to.be.%s(%s)" % (ops[op], json.dumps(bound)))
+        elif isinstance(val, dict) and list(val) == ["$unordered"]:
+            check(title, actual, ".to.have.deep.members(%s)" % json.dumps(PostmanVars(val["$unordered"])))
+        elif isinstance(val, dict) and list(val) == ["$subset"]:
+            check(title, actual, ".to.include.deep.members(%s)" % json.dumps(PostmanVars(val["$subset"])))
+        else:
+            check(title, actual, ".to.eql(%s)" % json.dumps(PostmanVars(val)))
+    def fields(obj, prefix):
+        for k, v in obj.items():
+            if isinstance(v, dict) and not any(str(key).startswith("$") for key in v):
+                fields(v, prefix + k + ".")
+            else:
+                compare(prefix + k, "pm.response.json()" + JSAccess(prefix + k), v)
+    for k, v in expect.items():
+        if k == "$status":          lines.append('pm.test("Status is %s", function () { pm.response.to.have.status(%s); });' % (v, json.dumps(v)))
+        elif k == "$elapsed_ms":    compare("Response time", "pm.response.responseTime", v)
+        elif k == "$header" and isinstance(v, dict):
+            for h, hv in v.items(): compare("Header " + h, "pm.response.headers.get(%s)" % json.dumps(h), hv)
+        elif k == "$body":          compare("Body", "pm.response.text()", v)
+        elif k == "$set":
+            for setcmd in v:
+                field, var = [s.strip() for s in setcmd.split("->")]
+                lines.append("pm.collectionVariables.set(%s, pm.response.json()%s);" % (json.dumps(var.lstrip("$")), JSAccess(field)))
+        elif k == "$phases":        warnings.append("$phases not converted")
+        elif isinstance(v, dict) and not any(str(key).startswith("$") for key in v):
+            fields(v, k + ".")
+        else:
+            compare(k, "pm.response.json()" + JSAccess(k), v)
+    return lines
+
+def ConvertFile(path: str) -> str:
+    """ JSON of the Postman items of an .apitest file: a request, or a folder of its requests """
+    from runner import APT
+    name = re.sub(r"^\d+-", "", os.path.splitext(os.path.basename(path))[0])
+    items, warnings, section, pre = [], [], name, []
+    with open(path, "r") as f:
+        statements = list(APT(f))
+    for stmt in APT.Statement.Walk(statements):
+        if isinstance(stmt, str): continue
+        if isinstance(stmt, APT.Statement.Section):
+            section = PostmanString(stmt.name)
+        elif isinstance(stmt, APT.Statement.Set):
+            value = stmt.data.val if isinstance(stmt.data, APT.Expr.Object) else PostmanString(stmt.data)
+            pre.append("pm.collectionVariables.set(%s, %s);" % (json.dumps(stmt.varname.strip().lstrip("$")), json.dumps(PostmanVars(value))))
+        elif isinstance(stmt, APT.Statement.Request):
+            request = {"method": PostmanString(stmt.method), "header": [], "url": {"raw": PostmanString(stmt.url)}}
+            if isinstance(stmt.data, APT.Expr.Object) and isinstance(stmt.data.val, dict):
+                data = dict(stmt.data.val)
+                request["header"] = [{"key": k, "value": PostmanString(APT.Expr.StringLit(str(v)))} for k, v in data.pop("$header", {}).items()]
+                request["body"] = {"mode": "raw", "raw": json.dumps(PostmanVars(data), indent=2), "options": {"raw": {"language": "json"}}}
+            elif stmt.data != None:
+                request["body"] = {"mode": "raw", "raw": PostmanString(stmt.data)}
+            item = {"name": section, "event": [], "request": request}
+            if len(pre) > 0:
+                item["event"].append({"listen": "prerequest", "script": {"type": "text/javascript", "exec": pre}})
+                pre = []
+            items.append(item)
+        elif isinstance(stmt, APT.Statement.Response) and len(items) > 0:
+            if isinstance(stmt.data, APT.Expr.Object) and isinstance(stmt.data.val, dict):
+                items[-1]["event"].append({"listen": "test", "script": {"type": "text/javascript", "exec": ResToScript(stmt.data.val, warnings)}})
+            else:
+                warnings.append("RES %s not converted" % stmt.data)
+        elif isinstance(stmt, APT.Statement.Prereq) and os.path.basename(stmt.filename) == SUBTEST:
+            continue
+        else:
+            warnings.append("%s not converted" % type(stmt).__name__.upper())
+    result = items[0] if len(items) == 1 else {"name": name, "item": items}
+    return json.dumps({"item": result, "warnings": ["%s: %s" % (path, w) for w in warnings]})
+
+def ConvertFiles(paths: typing.List[str]) -> typing.List[str]:
+    return [ConvertFile(path) for path in paths]
+
+def WalkSuite(directory: str, meta: dict) -> typing.Iterator[tuple]:
+    """ ("open", folder meta), ("file", path) and ("close", is root) in collection order """
+    yield "open", meta
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if os.path.isdir(path):
+            folder = {"name": re.sub(r"^\d+-", "", name)}
+            if os.path.exists(os.path.join(path, "_folder.json")):
+                with open(os.path.join(path, "_folder.json"), "r") as f:
+                    folder.update(json.load(f))
+            yield from WalkSuite(path, folder)
+        elif name.endswith(".apitest"):
+            yield "file", path
+    yield "close", meta.get("_root", False)
+
+def ToPostman(inputDir: str, postmanCollectionFile: str, jobs: int = None) -> dict:
+    """ Convert a folder of .apitest files into a collection, written as files are converted. Returns counters and warnings """
+    collection = {"_root": True, "info": {"name": os.path.basename(os.path.abspath(inputDir)), "schema": "https://schema.getpostman.com/json/collection/v2.1.0/collection.json"}}
+    if os.path.exists(os.path.join(inputDir, "_collection.json")):
+        with open(os.path.join(inputDir, "_collection.json"), "r") as f:
+            collection.update(json.load(f))
+    variables = []
+    if os.path.exists(os.path.join(inputDir, SUBTEST)):
+        from runner import APT
+        with open(os.path.join(inputDir, SUBTEST), "r") as f:
+            for stmt in APT(f):
+                if isinstance(stmt, APT.Statement.Set):
+                    value = stmt.data.val if isinstance(stmt.data, APT.Expr.Object) else PostmanString(stmt.data)
+                    variables.append({"key": stmt.varname.strip().lstrip("$"), "value": PostmanVars(value)})
+
+    # The suite is walked twice: ahead to submit files to the workers, a bounded number of batches at a time, and to write them in order
+    ahead, events = itertools.tee(WalkSuite(inputDir, collection))
+    paths = (path for kind, path in ahead if kind == "file")
+    warnings, requests, first = [], 0, True
+    with open(postmanCollectionFile, "w", encoding="utf-8") as out, ProcessPoolExecutor(max_workers=jobs) as pool:
+        window, converted = collections.deque(), collections.deque()
+        def submit():
+            while len(window) < 2 * (jobs or os.cpu_count() or 1):
+                batch = list(itertools.islice(paths, ApitestWriter.BATCH))
+                if len(batch) == 0: return
+                window.append(pool.submit(ConvertFiles, batch))
+        for kind, val in events:
+            if kind == "open":
+                if not val.get("_root"):
+                    out.write("" if first else ",\n")
+                meta = json.dumps({k: v for k, v in val.items() if k not in ["item", "variable", "_root"]}, ensure_ascii=False)
+                out.write(meta[:-1] + (", " if meta != "{}" else "") + '"item": [\n')
+                first = True
+            elif kind == "file":
+                if len(converted) == 0:
+                    submit()
+                    converted.extend(window.popleft().result())
+                result = json.loads(converted.popleft())
+                out.write(("" if first else ",\n") + json.dumps(result["item"], ensure_ascii=False))
+                first = False
+                warnings += result["warnings"]
+                requests += len(result["item"].get("item", [result["item"]]))
+            else:
+                out.write("]" if val else "]}") # The collection is closed after its variables
+                first = False
+        out.write(', "variable": %s}\n' % json.dumps(variables, ensure_ascii=False))
+    return {"requests": requests, "warnings": warnings}
+
+
+def main(argv) -> int:
+    parser = argparse.ArgumentParser(prog=os.path.basename(argv[0]), description="Convert Postman collections")
+    parser.add_argument("command", choices=["to-apitest", "to-postman", "split", "join"])
+    parser.add_argument("source", help="Collection file, or folder for to-postman and join")
+    parser.add_argument("target", help="Output folder, or collection file for to-postman and join")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="Worker processes, default one per CPU")
+    args = parser.parse_args(argv[1:])
+    if args.command == "split":
+        LoadPostmanCollection(args.source, args.target)
+        return 0
+    if args.command == "join":
+        SavePostmanCollection(args.target, args.source)
+        return 0
+    convert = ToApitest if args.command == "to-apitest" else ToPostman
+    result = convert(args.source, args.target, args.jobs)
+    for w in result["warnings"]:
+        print("    " + w)
+    print("%d request(s) converted, %d warning(s)" % (result["requests"], len(result["warnings"])))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -1,23 +1,150 @@
-import sys, os, typing, enum, requests, json, yaml, re, random, time
+import sys, os
+if __name__ == "__main__": # Hand the run to a warm daemon before the slow imports, see daemon.py
+    import daemon
+    exitCode = daemon.forward(sys.argv)
+    if exitCode != None: sys.exit(exitCode)
+
+import typing, enum, requests, json, yaml, re, random, time, io, argparse, contextlib, copy, asyncio, functools, threading, bisect, hashlib, pickle, zlib, collections, itertools, socket, urllib3, math, mmap, struct, operator
+from urllib.parse import urlsplit
+import http.cookiejar
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from datetime import datetime
+try:
+    import fcntl # POSIX only, lets one process run a shared PREREQ while the others wait
+except ImportError:
+    fcntl = None
+
+PATH_ANY = object() # [*] in a path
+PATH_FIELD = re.compile(r"([^\[]*)((?:\[(?:\d+|\*)\])+)$")
+
+@functools.lru_cache(maxsize = 4096)
+def splitPath(accessor: str) -> tuple:
+    """ "items[0].tags[*]" -> ("items", 0, "tags", PATH_ANY) """
+    fields = []
+    for field in accessor.split("."):
+        m = PATH_FIELD.match(field)
+        if m == None:
+            fields.append(field)
+            continue
+        if m.group(1) != "": fields.append(m.group(1))
+        for index in m.group(2)[1:-1].split("]["):
+            fields.append(PATH_ANY if index == "*" else int(index))
+    return tuple(fields)
+
+def accessPath(obj, fields: tuple, start = 0):
+    """ Value at a split path, None if not found. [*] gives the list of values for every item """
+    for i in range(start, len(fields)):
+        field = fields[i]
+        if obj is None:
+            return None
+        if field is PATH_ANY:
+            return [accessPath(item, fields, i + 1) for item in obj] if isinstance(obj, list) else None
+        if isinstance(obj, list):
+            if not isinstance(field, int) or field >= len(obj): return None
+            obj = obj[field]
+            continue
+        try:
+            if field not in obj:    return None
+            obj = obj[field]
+        except TypeError:           return None
+    return obj
 
 def accessObj(obj: dict, accessor: str):
     if accessor == "":              
         return obj
-    def access(obj, fields):
-        if obj == None:             return None
-        if fields[0] not in obj:    return None
-        if len(fields) == 1:        return obj[fields[0]]
-        return access(obj[fields[0]], fields[1:])
-    return access(obj,accessor.split("."))
+    return accessPath(obj, splitPath(accessor))
+
+def cacheDir(name, root = None):
+    """ Folder for a cache. Root defaults to $APT_CACHE_DIR or ~/.cache/apt """
+    if root == None:
+        root = os.environ.get("APT_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "apt"))
+    return os.path.join(root, name)
 
 def normalizeVarname(name):
     return "$" + name if name[0:1] != "$" else name
 
+def findFile(fname, baseDir = None) -> typing.Optional[str]:
+    """ Absolute path of a file used by a test. Relative names are looked up next to the test file first, then in the working directory """
+    candidates = [fname] if os.path.isabs(fname) or baseDir == None else [os.path.join(baseDir, fname), fname]
+    for path in candidates:
+        if os.path.isfile(path):
+            return os.path.abspath(path)
+    return None
+
+class APTTemplateStore():
+    """ Cache of loaded @file templates
+
+    A file is loaded once and reloaded when its mtime or size changes. Least recently used files are
+    dropped when over maxEntries or maxBytes (counted by file size). Data returned by Load is shared, don't modify it.
+    Resolvers compiled from a file's data are kept with it, per accessor, until the file is reloaded or dropped.
+    """
+    Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+    def __init__(self, maxEntries = 256, maxBytes = 256 * 1024 * 1024):
+        self.maxEntries, self.maxBytes = maxEntries, maxBytes
+        self.entries = collections.OrderedDict() # path -> (mtime_ns, size, data, {accessor: resolver})
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "reloads": 0, "evictions": 0, "loadTime": 0.0}
+
+    @staticmethod
+    def Find(fname, baseDir = None) -> typing.Optional[str]:
+        return findFile(fname, baseDir)
+
+    def Load(self, path):
+        st = os.stat(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry != None and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+                self.entries.move_to_end(path)
+                self.stats["hits"] += 1
+                return entry[2]
+        start = time.perf_counter()
+        with open(path, "r") as f:
+            data = APT.Scanner.LoadObject(f.read()) # JSON fixtures load much faster, and smaller, than as YAML
+        with self.lock:
+            self.stats["loadTime"] += time.perf_counter() - start
+            if path in self.entries:
+                self.stats["reloads"] += 1
+                self.bytes -= self.entries.pop(path)[1]
+            else:
+                self.stats["misses"] += 1
+            self.entries[path] = (st.st_mtime_ns, st.st_size, data, {})
+            self.bytes += st.st_size
+            while len(self.entries) > 1 and (len(self.entries) > self.maxEntries or self.bytes > self.maxBytes):
+                _, (_, size, _, _) = self.entries.popitem(last=False)
+                self.bytes -= size
+                self.stats["evictions"] += 1
+        return data
+
+    def Lookup(self, path, accessor):
+        return accessObj(self.Load(path), accessor)
+
+    def Compiled(self, path, accessor, compile) -> typing.Tuple[typing.Any, typing.Callable]:
+        """ Data of the file, and compile(data at accessor) built once per loaded version of the file """
+        data = self.Load(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            resolvers = entry[3] if entry != None and entry[2] is data else {} # Dropped meanwhile, not kept
+            resolver = resolvers.get(accessor)
+        if resolver == None:
+            resolver = compile(accessObj(data, accessor))
+            with self.lock:
+                resolvers[accessor] = resolver
+        return data, resolver
+
+    def Stats(self) -> dict:
+        with self.lock:
+            return dict(self.stats, entries=len(self.entries), bytes=self.bytes)
+
+templateStore = APTTemplateStore() # Shared by every APTEnv of the process
+
 class APTEnv():
     """ Base Environment manager """
     def __init__(self):             
         self.vars, self.at = ({}, None)
+        self.templates = templateStore
+        self.baseDir = None # Folder of the running test file, for relative @file
         self.specialVars = {
             "$_RANDOM": lambda : random.randint(0,999999999),
             "$_TIMESTAMP": lambda : int(time.time()),
@@ -31,6 +158,249 @@ class APTEnv():
             return self.specialVars[normalizeVarname(varname)]()
         return None if normalizeVarname(varname) not in self.vars else self.vars[normalizeVarname(varname)]
 
+NULL_SPAN = contextlib.nullcontext() # Span of runners without a tracer
+
+class APTTracer():
+    """ Timed spans of a run: files, parsing, statements, resolving, HTTP phases, decoding and assertions
+
+    Spans nest per thread, a span opened while another one is open is its child. PREREQ sub-runners share
+    the tracer of their transport, so their spans nest under the PREREQ statement.
+    Events are kept in Chrome trace-event format and can be merged across worker processes.
+    """
+    class Span():
+        __slots__ = ("tracer", "name", "cat", "args", "parent", "id", "start")
+        def __init__(self, tracer:'APTTracer', name:str, cat:str, args:dict, parent):
+            self.tracer, self.name, self.cat, self.args, self.parent = tracer, name, cat, args, parent
+            self.id = "%d.%d" % (tracer.pid, next(tracer.ids))
+        def __enter__(self):
+            stack = self.tracer.Stack()
+            if self.parent == None and len(stack) > 0:
+                self.parent = stack[-1].id
+            stack.append(self)
+            self.start = time.perf_counter_ns()
+            return self
+        def __exit__(self, *exc):
+            end = time.perf_counter_ns()
+            self.tracer.Stack().pop()
+            self.tracer.Record(self.name, self.cat, self.start, end, self.args, self.id, self.parent)
+            return False
+
+    QUANTILES = [0.5, 0.9, 0.99]
+
+    def __init__(self):
+        self.events = []
+        self.local = threading.local()
+        self.ids = itertools.count(1)
+        self.pid = os.getpid()
+        self.origin = time.time_ns() - time.perf_counter_ns() # Wall clock at perf_counter 0, to line up processes
+
+    def Stack(self) -> list:
+        stack = getattr(self.local, "stack", None)
+        if stack == None:
+            stack = self.local.stack = []
+        return stack
+
+    def Current(self) -> typing.Optional[str]:
+        """ Id of the innermost open span of this thread """
+        stack = self.Stack()
+        return stack[-1].id if len(stack) > 0 else None
+
+    def Start(self, name:str, cat:str, parent = None, **args) -> 'APTTracer.Span':
+        return self.Span(self, name, cat, args, parent)
+
+    def Record(self, name:str, cat:str, start:int, end:int, args = None, id = None, parent = None):
+        """ Add a finished span, start and end in perf_counter_ns """
+        args = dict(args) if args else {}
+        args["id"], args["parent"] = id, parent if parent != None or id != None else self.Current()
+        self.events.append({"name": name, "cat": cat, "ph": "X", "ts": (self.origin + start) / 1000, "dur": (end - start) / 1000,
+                            "pid": self.pid, "tid": threading.get_ident(), "args": args})
+
+    def Take(self) -> list:
+        """ Recorded events, cleared from the tracer """
+        events, self.events = self.events, []
+        return events
+
+    @staticmethod
+    def ChromeTrace(events:list) -> str:
+        """ Trace-event JSON for chrome://tracing or Perfetto """
+        return json.dumps({"traceEvents": events, "displayTimeUnit": "ms"})
+
+    @classmethod
+    def Prometheus(cls, events:list) -> str:
+        """ Text exposition format summary of span durations in seconds, by span name """
+        durations = collections.defaultdict(list)
+        for e in events:
+            durations[e["name"]].append(e["dur"] / 1000000)
+        lines = ["# HELP apt_span_seconds Time spent in APT runner spans", "# TYPE apt_span_seconds summary"]
+        for name in sorted(durations):
+            values = sorted(durations[name])
+            label = name.replace("\\", "\\\\").replace("\"", "\\\"")
+            for q in cls.QUANTILES:
+                lines.append('apt_span_seconds{span="%s",quantile="%s"} %.9f' % (label, q, values[max(0, math.ceil(q * len(values)) - 1)]))
+            lines.append('apt_span_seconds_sum{span="%s"} %.9f' % (label, sum(values)))
+            lines.append('apt_span_seconds_count{span="%s"} %d' % (label, len(values)))
+        return "\n".join(lines) + "\n"
+
+
+class APTTracedConnection():
+    """ Connection mixin timing the dns, connect, tls, send and ttfb phases of requests
+
+    Phases of the requests of a thread are kept for $phases until Phases() is called, and recorded as spans when tracing.
+    """
+    PHASES = ["dns", "connect", "tls", "send", "ttfb"]
+    tracer: APTTracer = None
+    local = threading.local()
+
+    def Phase(self, name:str, start:int, end:int):
+        phases = getattr(self.local, "phases", None)
+        if phases == None:
+            phases = self.local.phases = {}
+        phases[name] = phases.get(name, 0) + (end - start) / 1000000
+        if self.tracer != None:
+            self.tracer.Record(name, "http", start, end)
+
+    @classmethod
+    def Phases(cls) -> dict:
+        """ Milliseconds spent in each phase by this thread since the last call. Phases of reused connections are 0 """
+        phases, cls.local.phases = getattr(cls.local, "phases", None) or {}, {}
+        return {name: round(phases.get(name, 0), 3) for name in cls.PHASES}
+
+    def _new_conn(self):
+        """ Resolves, then tries each address in turn like urllib3, so dns is timed apart from connect """
+        start = time.perf_counter_ns()
+        try:
+            addresses = socket.getaddrinfo(self.host.strip("[]"), self.port, urllib3.util.connection.allowed_gai_family(), socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            raise urllib3.exceptions.NameResolutionError(self.host, self, e) from e
+        resolved = time.perf_counter_ns()
+        self.Phase("dns", start, resolved)
+        error = None
+        for address in dict.fromkeys(a[4][0] for a in addresses): # e.g. IPv4 after ::1
+            try:
+                sock = urllib3.util.connection.create_connection((address, self.port), self.timeout,
+                                                                 source_address=self.source_address, socket_options=self.socket_options)
+                break
+            except OSError as e:
+                error = e
+        else:
+            if isinstance(error, socket.timeout):
+                raise urllib3.exceptions.ConnectTimeoutError(self, "Connection to %s timed out. (connect timeout=%s)" % (self.host, self.timeout)) from error
+            raise urllib3.exceptions.NewConnectionError(self, "Failed to establish a new connection: %s" % error) from error
+        self._connected = time.perf_counter_ns()
+        self.Phase("connect", resolved, self._connected)
+        return sock
+
+    def connect(self):
+        super().connect()
+        if isinstance(self, urllib3.connection.HTTPSConnection):
+            self.Phase("tls", self._connected, time.perf_counter_ns())
+
+    def request(self, *args, **kwargs):
+        start = time.perf_counter_ns()
+        super().request(*args, **kwargs)
+        self.Phase("send", start, time.perf_counter_ns())
+
+    def getresponse(self, *args, **kwargs):
+        start = time.perf_counter_ns()
+        res = super().getresponse(*args, **kwargs)
+        self.Phase("ttfb", start, time.perf_counter_ns())
+        return res
+
+    @classmethod
+    def PoolClasses(cls, tracer:APTTracer) -> dict:
+        """ urllib3 pool classes by scheme whose connections record to tracer """
+        classes = {}
+        for scheme, pool in [("http", urllib3.HTTPConnectionPool), ("https", urllib3.HTTPSConnectionPool)]:
+            conn = type("Traced" + pool.ConnectionCls.__name__, (cls, pool.ConnectionCls), {"tracer": tracer})
+            classes[scheme] = type("Traced" + pool.__name__, (pool,), {"ConnectionCls": conn})
+        return classes
+
+
+class APTTransport():
+    """ HTTP transport with a keep-alive connection pool per host
+
+    Owned by a runner and shared with its PREREQ sub-runners. Pools idle for longer than idleTimeout are closed.
+    """
+    class Session(requests.Session):
+        def __init__(self, transport:'APTTransport'):
+            super().__init__()
+            self.transport = transport
+            self.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[])) # Like per-call requests, nothing is kept between requests
+        def get_adapter(self, url):
+            return self.transport.Adapter(url)
+
+    def __init__(self, poolSize = 10, keepAlive = True, idleTimeout = 30.0, maxBodySize = 64 * 1024 * 1024, streamThreshold = 4 * 1024 * 1024, trace = False):
+        self.poolSize, self.keepAlive, self.idleTimeout = poolSize, keepAlive, idleTimeout
+        self.maxBodySize, self.streamThreshold = maxBodySize, streamThreshold # See APTResponse
+        self.tracer = APTTracer() if trace else None # Shared by the runners using this transport
+        self.poolClasses = APTTracedConnection.PoolClasses(self.tracer) if trace else None # Time phases for $phases and traces
+        self.session = self.Session(self)
+        if not keepAlive:
+            self.session.headers["Connection"] = "close"
+        self.hosts = {} # scheme://host:port -> [adapter, last used]
+        self.lock = threading.Lock()
+        self.evictions = 0
+        self.retired = {"requests": 0, "connections": 0} # Counters of evicted pools
+
+    def Adapter(self, url) -> requests.adapters.HTTPAdapter:
+        parts = urlsplit(url)
+        key = "%s://%s" % (parts.scheme.lower(), parts.netloc.lower())
+        now = time.monotonic()
+        with self.lock:
+            for k in [k for k in self.hosts if now - self.hosts[k][1] > self.idleTimeout]:
+                self.Evict(k)
+            if key not in self.hosts:
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.poolSize, pool_block=False)
+                if self.poolClasses != None:
+                    adapter.poolmanager.pool_classes_by_scheme = self.poolClasses
+                self.hosts[key] = [adapter, now]
+            self.hosts[key][1] = now
+            return self.hosts[key][0]
+
+    def Evict(self, key):
+        adapter = self.hosts.pop(key)[0]
+        for k, v in self.PoolCounters(adapter).items():
+            self.retired[k] += v
+        adapter.close()
+        self.evictions += 1
+
+    @staticmethod
+    def PoolCounters(adapter) -> dict:
+        counters = {"requests": 0, "connections": 0}
+        for key in list(adapter.poolmanager.pools.keys()):
+            pool = adapter.poolmanager.pools.get(key)
+            if pool != None:
+                counters["requests"] += pool.num_requests
+                counters["connections"] += pool.num_connections
+        return counters
+
+    def Stats(self) -> dict:
+        """ Pool counters. A hit is a request served on an already open connection """
+        with self.lock:
+            counters = dict(self.retired)
+            for adapter, _ in self.hosts.values():
+                for k, v in self.PoolCounters(adapter).items():
+                    counters[k] += v
+            if not self.keepAlive: # urllib3 counts a closed connection that reconnects as reused
+                counters["connections"] = counters["requests"]
+            return {
+                "hosts": len(self.hosts),
+                "requests": counters["requests"],
+                "hits": counters["requests"] - counters["connections"],
+                "misses": counters["connections"],
+                "evictions": self.evictions
+            }
+
+    def Request(self, method, url, **kwargs) -> requests.Response:
+        return self.session.request(method, url, **kwargs) # Without keepAlive, Connection: close drops each connection after its response
+
+    def Close(self):
+        with self.lock:
+            for k in list(self.hosts):
+                self.Evict(k)
+        self.session.close()
+
+
 class APT() :
     class Token():
         REQ = "REQ"
@@ -40,31 +410,54 @@ class APT() :
         PREREQ = "PREREQ" # PRE Requisite
         ASSERT = "ASSERT"
         PRINT = "PRINT"
+        REPEAT = "REPEAT"
+        END = "END" # Ends a REPEAT block
 
     class Expr():
+        """ Expressions are compiled into a resolver closure on first resolve
+
+        Subtrees without $var/@ references are built once and shared between resolves as constants.
+        Resolved values may be shared, don't modify them.
+        """
         class Base():
             def __init__(self, val):    self.val = val
             def __str__(self):          return str(self.val)
-            def resolve(self, env):     return self.val
+            def resolve(self, env):
+                resolver = self.__dict__.get("_resolver")
+                if resolver == None:
+                    resolver = self._resolver = self.compile()
+                return resolver(env)
+            def compile(self) -> typing.Callable[['APTEnv'], typing.Any]:
+                val = self.val
+                return lambda env: val
+            def isConst(self) -> bool:  return True
+            def __getstate__(self): # Resolvers and other compiled state are rebuilt after unpickling
+                return {k: v for k, v in self.__dict__.items() if not k.startswith("_")}
         class Null(Base): pass
         class Object(Base): 
-            def resolve(self, env):
-                def do(data): # Copy and resolve
-                    nonlocal env
+            @staticmethod
+            def build(data) -> typing.Tuple[bool, typing.Any]:
+                """ (True, value) for a constant subtree, (False, resolver) if it references variables """
+                if isinstance(data, dict) or isinstance(data, list):
+                    items = data.items() if isinstance(data, dict) else enumerate(data)
+                    children = [(k,) + APT.Expr.Object.build(v) for k, v in items]
+                    if all(const for _, const, _ in children):
+                        if all(v is data[k] for k, _, v in children): return True, data # Unchanged, shared instead of copied
+                        if isinstance(data, dict):  return True, {k: v for k, _, v in children}
+                        else:                       return True, [v for _, _, v in children]
                     if isinstance(data, dict):
-                        o = {}
-                        for k in data:
-                            o[k] = do(data[k])
-                        return o
-                    elif isinstance(data, list):
-                        l = []
-                        for d in data:
-                            l.append(do(d))
-                        return l
-                    elif isinstance(data, str):
-                        return APT.Expr.StringLit(data).resolve(env)
-                    return data
-                return do(self.val)
+                        return False, lambda env: {k: (v if const else v(env)) for k, const, v in children}
+                    return False, lambda env: [(v if const else v(env)) for _, const, v in children]
+                elif isinstance(data, str):
+                    expr = APT.Expr.StringLit(data).deriveType()
+                    if expr.isConst():  return True, expr.resolve(None)
+                    else:               return False, expr.compile()
+                return True, data
+            def compile(self):
+                const, val = self.build(self.val)
+                return (lambda env: val) if const else val
+            def isConst(self):
+                return self.build(self.val)[0]
         class String(Base): pass
         class Int(Base): pass
         class Float(Base): pass
@@ -77,43 +470,69 @@ class APT() :
                 elif lit[0] == "@":                     return APT.Expr.AtVar(lit)
                 elif lit[0] == "$":                     return APT.Expr.Var(lit)
                 else:                                   return APT.Expr.String(lit)
-            def resolve(self, env):
-                return self.deriveType().resolve(env)
+            def compile(self):
+                return self.deriveType().compile()
+            def isConst(self):
+                return self.deriveType().isConst()
         class AtVar(Base): # @<file>:<accessor>. Ex: @template:data, @:, 
-            def resolve(self, env:APTEnv):
+            @staticmethod
+            def template(val) -> typing.Callable[['APTEnv'], typing.Any]:
+                if isinstance(val, dict):       return APT.Expr.Object(val).compile()
+                elif isinstance(val, str):      return APT.Expr.String(val).compile()
+                elif isinstance(val, int):      return APT.Expr.Int(val).compile()
+                elif isinstance(val, float):    return APT.Expr.Float(val).compile()
+                else:                           return lambda env: copy.deepcopy(val) # Cached template data is shared
+            def compile(self):
                 fname, accessor = self.val[1:].strip().split(":")
-                # TODO: Resolve filename and path smarter, cache file, add loaded data to env
-                def do(data):
-                    val = accessObj(data, accessor)
-                    if isinstance(val, dict):       return APT.Expr.Object(val).resolve(env)
-                    elif isinstance(val, str):      return APT.Expr.String(val).resolve(env)
-                    elif isinstance(val, int):      return APT.Expr.Int(val).resolve(env)
-                    elif isinstance(val, float):    return APT.Expr.Float(val).resolve(env)
-                    else:                           return APT.Expr.Base(val).resolve(env)
-                if fname == "":
-                    return do(env.getAtVar())
-                if not os.path.exists(fname) or not os.path.isfile(fname):
-                    print("File not exists:" + fname)
-                    return None
-                with open(fname, "r") as f:
-                    data = yaml.safe_load(f)
+                template = APT.Expr.AtVar.template
+                def resolve(env:APTEnv):
+                    if fname == "":
+                        return template(accessObj(env.getAtVar(), accessor))(env)
+                    path = env.templates.Find(fname, env.baseDir)
+                    if path == None:
+                        print("File not exists:" + fname)
+                        return None
+                    data, resolver = env.templates.Compiled(path, accessor, template) # Compiled once per file version
                     env.setAtVar(data)
-                    return do(data)
-        class Var(Base):
+                    return resolver(env)
+                return resolve
+            def isConst(self):  return False
+        class Var(Base): # $var, or $var.field.path into its value
             def __init__(self, val):        self.val = val
-            def resolve(self, env:APTEnv):  return env.getVar(self.val)
+            def compile(self):
+                varname = self.val
+                head, _, path = varname.partition(".")
+                if path == "":
+                    return lambda env: env.getVar(varname)
+                def resolve(env):
+                    if normalizeVarname(varname) in env.vars: # Set with a dotted name
+                        return env.getVar(varname)
+                    return accessObj(env.getVar(head), path)
+                return resolve
+            def names(self) -> typing.List[str]:
+                """ Names of the $vars it may read """
+                varname = normalizeVarname(self.val.strip())
+                return [varname, varname.partition(".")[0]] if "." in varname else [varname]
+            def isConst(self):              return False
         class BinOp(Base):
             def __str__(self):                      return "%s %s %s" % (self.left, self.op, self.right)
             def __init__(self, op, left, right):    self.op, self.left, self.right = op, left, right
-            def resolve(self, env): 
-                self.left = self.left.resolve(env)
-                self.right = self.right.resolve(env)
-                if self.op == "+": # TODO: Move to env
-                    if isinstance(self.left, dict) and isinstance(self.right, dict):
-                        data = self.left
-                        data.update(self.right)
-                        return data
-                    return self.left + self.right
+            def compile(self):
+                left, right, op = self.left.compile(), self.right.compile(), self.op
+                def resolve(env):
+                    l, r = left(env), right(env)
+                    if op == "+": # TODO: Move to env
+                        if isinstance(l, dict) and isinstance(r, dict):
+                            data = dict(l) # Don't modify the operands, they may be stored in a $var
+                            data.update(r)
+                            return data
+                        return l + r
+                if self.isConst(): # Fold constants
+                    val = resolve(None)
+                    return lambda env: val
+                return resolve
+            def isConst(self):
+                return self.left.isConst() and self.right.isConst()
 
     class Statement():
         class Section():
@@ -129,106 +548,138 @@ class APT() :
             def __init__(self, varname:str, data:'APT.Expr.Base'):          self.varname, self.data = varname, data
             def __str__(self):                                              return "SET <%s> <%s>" % (self.varname, self.data)
         class Prereq():
-            def __init__(self, filename:str):                               self.filename = filename
-            def __str__(self):                                              return "PREREQ <%s>" % (self.filename)
-        class Assert():
-            def __init__(self, data:'APT.Expr.Base', a:'APT.Expr.Base'):    self.data, self.assertion = data, a
-            def __str__(self):                                              return "ASSERT <%s> <%s>" % (self.data, self.assertion)
+            def __init__(self, filename:str, ttl:'APT.Expr.Base' = None):   self.filename, self.ttl = filename, ttl
+            def __str__(self):                                              return "PREREQ <%s> <%s>" % (self.filename, self.ttl)
+        class Assert(): # op compares data with the assertion, see APTMatcher.OPERATORS. Equality if None
+            def __init__(self, data:'APT.Expr.Base', a:'APT.Expr.Base', op:str = None):
+                self.data, self.assertion, self.op = data, a, op
+            def __str__(self):                                              return "ASSERT <%s> %s <%s>" % (self.data, self.op or "", self.assertion)
         class Print():
             def __init__(self, data:'APT.Expr.Base'):                       self.data = data
             def __str__(self):                                              return "PRINT <%s> <%s>" % (self.data)
+        class Repeat(): # Runs body count times, at most concurrency iterations at once
+            def __init__(self, count:'APT.Expr.Base', concurrency:'APT.Expr.Base', body:list):
+                self.count, self.concurrency, self.body = count, concurrency, body
+            def __str__(self):                                              return "REPEAT <%s> <%s> [%d]" % (self.count, self.concurrency, len(self.body))
+
+        @staticmethod
+        def Walk(statements):
+            """ Statements including those inside REPEAT blocks """
+            for stmt in statements:
+                yield stmt
+                if isinstance(stmt, APT.Statement.Repeat):
+                    yield from APT.Statement.Walk(stmt.body)
     
     class Scanner():
+        """ Single pass lexer. Tokens are matched with precompiled patterns and sliced from the source """
+        WHITESPACE = re.compile(r"(?:\n\.\.\.|[ \t\n\r])*")                      # "\n..." = continue param symbol
+        COMMENT = re.compile(r"/(?=\*)(?:.*?\*/|.*)", re.DOTALL)               # "/*/" closes itself, unterminated runs to EOF
+        NONCODE = re.compile(r"(?:\n\.\.\.|[ \t\n\r]|/(?=\*)(?:.*?\*/|.*))*", re.DOTALL)
+        STRING = re.compile(r"(?:[^ \t\n\r]| (?![ \t\n\r]))*")                  # Ends at tab/newline or 2 whitespaces
+        OPTIONAL = re.compile(r"(?:[ \t\r]|\n\.\.\.)*")
+        OBJECT = re.compile(r"[{}\\]")
+        COMPARISON = re.compile(r"([^ \t\n\r]+)[ \t]+(<=|>=|==|!=|<|>)[ \t]+")  # ASSERT $latency.p99 < 200
+
         def ExpectComment(self, pos: int) -> typing.Tuple[bool, int, str]:
-            _, pos, _ = self.ExpectWhitespace(pos)
-            if self.data[pos:pos+2] == "/*":
-                spos = pos
-                while pos < len(self.data):
-                    if self.data[pos:pos+2] == "*/": 
-                        pos += 2
-                        break
-                    pos += 1
-                return True, pos, self.data[spos:pos]
+            pos = self.WHITESPACE.match(self.data, pos).end()
+            if self.data.startswith("/*", pos):
+                end = self.COMMENT.match(self.data, pos).end()
+                return True, end, self.data[pos:end]
             return False, pos, ""
 
         def ExpectWhitespace(self, pos: int) -> typing.Tuple[bool, int, str]:
-            spos = pos
-            while pos < len(self.data):
-                if self.data[pos:pos+4] == "\n...": # Skip over continue param symbol
-                    pos += 4
-                    continue
-                if self.data[pos] not in [" ", "\t", "\n", "\r"]: break
-                pos += 1
-            return True, pos, self.data[spos:pos]
+            end = self.WHITESPACE.match(self.data, pos).end()
+            return True, end, self.data[pos:end]
 
         def ExpectNonCode(self, pos: int) -> typing.Tuple[bool, int, str]:
             """ Expect whitespace or comment part until reach next code"""
-            while pos < len(self.data):
-                spos = pos
-                _, pos, _ = self.ExpectComment(pos)
-                _, pos, _ = self.ExpectWhitespace(pos)
-                if pos == spos: break
-            return True, pos, ""
+            return True, self.NONCODE.match(self.data, pos).end(), ""
 
         def ExpectOptionalParam(self, pos:int) -> typing.Tuple[bool, int, str]: # Some param can be optional.
-            while pos < len(self.data):
-                if self.data[pos] == "\n":
-                    if self.data[pos+1:pos+4] == "...": pos += 4; continue
-                    else                              : return False, pos+1, "" # Next line doesn't has continue param symbol, treat as no optional parameter
-                if self.data[pos] not in [" ", "\t", "\r"]:
-                    return True, pos, "" # Found non whitespace character
-                pos += 1
-            return False, pos, "" # No optional param because EOF reached
+            pos = self.OPTIONAL.match(self.data, pos).end()
+            if pos >= len(self.data):   return False, pos, ""   # No optional param because EOF reached
+            if self.data[pos] == "\n":  return False, pos+1, "" # Next line doesn't has continue param symbol, treat as no optional parameter
+            return True, pos, ""                                # Found non whitespace character
+
+        def ExpectTrailingParam(self, pos:int) -> typing.Tuple[bool, int, str]: # Optional param, a trailing comment ends the statement
+            found, pos, _ = self.ExpectOptionalParam(pos)
+            return found and not self.data.startswith("/*", pos), pos, ""
 
         def ExpectEOF(self, pos: int) -> typing.Tuple[bool, int, str]:
             return pos >= len(self.data), pos, ""
 
         def ExpectString(self, pos: int) -> typing.Tuple[bool, int, str]: # REQ, https://x.y, 123.45, 
-            _, pos, _ = self.ExpectNonCode(pos)
-            res = ""
-            while pos < len(self.data):
-                if self.data[pos] in ["\t", "\n", "\r"]: 
-                    break # Separator whitespace
-                if self.data[pos:pos+2] in ["  ", " \t", " \n", " \r"]: 
-                    pos += 1
-                    break # 2 whitespace = Seperate
-                res += self.data[pos]
-                pos += 1
-            return True, pos, res
+            pos = self.NONCODE.match(self.data, pos).end()
+            end = self.STRING.match(self.data, pos).end()
+            res = self.data[pos:end]
+            if self.data.startswith(" ", end):
+                end += 1 # 2 whitespace = Seperate
+            return True, end, res
 
         def ExpectOp(self, pos: int) -> typing.Tuple[bool, int, str]: # TODO:
-            _, pos, _ = self.ExpectNonCode(pos)
-            if self.data[pos:pos+1] == "+": # Add operator
+            pos = self.NONCODE.match(self.data, pos).end()
+            if self.data.startswith("+", pos): # Add operator
                 return True, pos+1, "+"
 
             return False, pos, None
 
+        def ExpectObject(self, pos: int) -> typing.Tuple[bool, int, str]: # {<YAML>} with nested brackets, \ escapes the next character
+            pos += 1
+            bracket, parts, spos = 0, [], pos
+            for m in self.OBJECT.finditer(self.data, pos):
+                c = m.start()
+                if c < spos: continue # Escaped character
+                if self.data[c] == '{':
+                    bracket += 1
+                elif self.data[c] == '}':
+                    if bracket == 0:
+                        parts.append(self.data[spos:c])
+                        return True, c+1, "".join(parts)
+                    bracket -= 1
+                else:
+                    parts.append(self.data[spos:c])
+                    spos = c+1 # Keep the escaped character as is
+                    if c+1 < len(self.data): # Escaped character is taken literally
+                        parts.append(self.data[c+1])
+                        spos = c+2
+            parts.append(self.data[spos:])
+            return True, len(self.data), "".join(parts)
+
+        @staticmethod
+        def JSONFloat(text: str) -> float:
+            if "e" in text or "E" in text: raise ValueError("Exponent") # YAML reads 1e5 or 1.5e3 as strings
+            return float(text)
+
+        @staticmethod
+        def JSONConstant(text: str):
+            raise ValueError(text) # NaN and Infinity are strings in YAML
+
+        @staticmethod
+        def LoadObject(text: str):
+            """ Object literal. {{...}} is usually JSON, parsed much faster than as YAML when it means the same """
+            if text.lstrip()[:1] in ("{", "["):
+                try:                return json.loads(text, parse_float=APT.Scanner.JSONFloat, parse_constant=APT.Scanner.JSONConstant)
+                except ValueError:  pass
+            return yaml.load(text, Loader=APTTemplateStore.Loader)
+
         def ScanExpr(self, pos: int) -> typing.Tuple[bool, int, typing.Any]: # 1, {"x": "json"}, YML{x: json}, asdf, 1 + 2, 1    +     2
-            _, pos, _ = self.ExpectNonCode(pos)
+            pos = self.NONCODE.match(self.data, pos).end()
             res = None 
             if pos >= len(self.data): return False, pos, None
             if self.data[pos] == '{': # Object lit
-                pos += 1
-                bracket = 0
-                yamlData = ""
-                while pos < len(self.data):
-                    if self.data[pos] == '{': bracket += 1
-                    if self.data[pos] == '}':
-                        if bracket == 0: pos += 1; break
-                        bracket -= 1
-                    if self.data[pos] == '\\': pos += 1 # Escaping
-                    yamlData += self.data[pos:pos+1]
-                    pos += 1
-                res = APT.Expr.Object(yaml.safe_load(yamlData))
+                _, pos, yamlData = self.ExpectObject(pos)
+                res = APT.Expr.Object(self.LoadObject(yamlData))
+                self.pos = pos
+            else: # String data as generic lit
                 self.pos = pos
-            elif self.Peek(self.ExpectString): # String data as generic lit
                 res = APT.Expr.StringLit(self.Scan(self.ExpectString)).deriveType()
                 pos = self.pos
-                
-            if not self.Peek(self.ExpectOp): # No operation comes after this so the expression ends here
+
+            ok, opPos, op = self.ExpectOp(pos)
+            if not ok: # No operation comes after this so the expression ends here
                 return True, pos, res
 
-            op = self.Scan(self.ExpectOp)
+            self.pos = opPos
             if op in ["+"]: # If is in binary op
                 ok, pos, rightExpr = self.ScanExpr(self.pos)
                 if not ok :
@@ -250,16 +701,34 @@ class APT() :
             self.lastStatementPos = 0
             self.error = None
             self.eof = False
+            self.lineOffsets = None
 
         def GetLastStatementLineNumber(self):
-            return self.data.count("\n", 0, self.lastStatementPos)+1
+            return self.GetLineNumber(self.lastStatementPos)
+        def GetLineNumber(self, pos: int):
+            if self.lineOffsets == None: # Offsets of every newline, built on first use
+                self.lineOffsets = [m.start() for m in re.finditer("\n", self.data)]
+            return bisect.bisect_left(self.lineOffsets, pos)+1
+        def StatementLineNumber(self, stmt):
+            return stmt.line if hasattr(stmt, "line") else self.GetLineNumber(stmt.pos) # Statements cached before lines were kept
         def Next(self):
-            if self.Peek(self.ExpectEOF):
-                self.eof = True
-                return None
-            if self.Peek(self.ExpectComment): # Read comment between statement
-                self.Scan(self.ExpectComment) 
-                return self.Next()
+            stmt = self.NextStatement()
+            if stmt != None and not isinstance(stmt, str):
+                stmt.pos = self.lastStatementPos
+                stmt.line = self.GetLineNumber(stmt.pos)
+            if isinstance(stmt, APT.Statement.Repeat):
+                while True: # Unterminated block runs to EOF
+                    inner = self.Next()
+                    if inner == None or inner == APT.Token.END: break
+                    stmt.body.append(inner)
+            return stmt
+        def NextStatement(self):
+            while True:
+                if self.Peek(self.ExpectEOF):
+                    self.eof = True
+                    return None
+                if not self.Peek(self.ExpectComment): break
+                self.Scan(self.ExpectComment) # Read comment between statement
             
             val = self.Scan(self.ExpectString)
             self.lastStatementPos = self.pos
@@ -278,160 +747,1612 @@ class APT() :
                 varname = self.Scan(self.ExpectString)
                 data = self.Scan(self.ScanExpr)
                 return APT.Statement.Set(varname, data)
-            if val == APT.Token.PREREQ: # PREREQ  [filename]
+            if val == APT.Token.PREREQ: # PREREQ  [filename]  [ttl?]
                 filename = self.Scan(self.ExpectString)
-                return APT.Statement.Prereq(filename)
-            if val == APT.Token.ASSERT: # ASSERT  [data]  [assertion]
+                ttl = self.Scan(self.ScanExpr) if self.Peek(self.ExpectTrailingParam) else None
+                return APT.Statement.Prereq(filename, ttl)
+            if val == APT.Token.ASSERT: # ASSERT  [data]  [assertion]  or  ASSERT [data] <op> [value]
+                comparison = self.COMPARISON.match(self.data, self.NONCODE.match(self.data, self.pos).end())
+                if comparison != None:
+                    self.pos = comparison.end()
+                    assertion = self.Scan(self.ScanExpr)
+                    return APT.Statement.Assert(APT.Expr.StringLit(comparison.group(1)).deriveType(), assertion, comparison.group(2))
                 data = self.Scan(self.ScanExpr)
                 assertion = self.Scan(self.ScanExpr)
                 return APT.Statement.Assert(data, assertion)
             if val == APT.Token.PRINT: # PRINT  [data]
                 data = self.Scan(self.ScanExpr)
                 return APT.Statement.Print(data)
+            if val == APT.Token.REPEAT: # REPEAT  [count]  [concurrency?]  ...  END. The body is read by Next
+                count = self.Scan(self.ScanExpr)
+                concurrency = self.Scan(self.ScanExpr) if self.Peek(self.ExpectTrailingParam) else None
+                return APT.Statement.Repeat(count, concurrency, [])
+            if val == APT.Token.END:
+                return APT.Token.END
             else: return "UNKNOWN STATEMENT: "+val
 
+    class StreamScanner(Scanner):
+        """ Scanner over a window of a file too large to read whole
+
+        The window is filled in chunks and the text before the current statement is dropped once a chunk has been
+        scanned, so memory is bounded by the largest statement. A statement reaching the end of the window is scanned
+        again with a larger one. Line numbers are counted incrementally as the window moves.
+        """
+        class Truncated(Exception): pass
+        CHUNK = 1024 * 1024     # Characters
+        MARGIN = 64 * 1024      # Kept past a statement, for optional params on its next line
+
+        def __init__(self, f: typing.TextIO):
+            self.f = f
+            self.data = ""
+            self.pos = 0
+            self.lastStatementPos = 0
+            self.error = None
+            self.eof = False
+            self.exhausted = False              # Whole file read
+            self.lineCursor, self.line = 0, 1   # Line number at lineCursor in the window
+            self.lookahead = self.CHUNK
+
+        def Advance(self):
+            """ Drop the scanned text once a chunk of it has built up, and read ahead """
+            if self.pos >= self.CHUNK:
+                self.GetLineNumber(self.pos)
+                self.data = self.data[self.pos:]
+                self.lastStatementPos -= self.pos
+                self.lineCursor, self.pos = 0, 0
+            chunks = []
+            ahead = len(self.data) - self.pos
+            while ahead < self.lookahead and not self.exhausted:
+                chunk = self.f.read(max(self.CHUNK, self.lookahead - ahead))
+                self.exhausted = chunk == ""
+                chunks.append(chunk)
+                ahead += len(chunk)
+            if len(chunks) > 0:
+                self.data += "".join(chunks)
+
+        def GetLineNumber(self, pos: int):
+            if pos >= self.lineCursor:  self.line += self.data.count("\n", self.lineCursor, pos)
+            else:                       self.line -= self.data.count("\n", pos, self.lineCursor)
+            self.lineCursor = pos
+            return self.line
+
+        def ExpectEOF(self, pos: int) -> typing.Tuple[bool, int, str]:
+            return self.exhausted and pos >= len(self.data), pos, ""
+
+        def ExpectObject(self, pos: int) -> typing.Tuple[bool, int, str]:
+            ok, end, val = super().ExpectObject(pos)
+            if end >= len(self.data) and not self.exhausted: # Closing bracket may be past the window
+                raise self.Truncated()
+            return ok, end, val
+
+        def NextStatement(self):
+            while True:
+                self.Advance()
+                start = self.pos
+                try:
+                    stmt = super().NextStatement()
+                    if self.exhausted or self.pos + self.MARGIN <= len(self.data):
+                        return stmt
+                except self.Truncated: pass
+                self.pos = start # May continue past the window
+                self.lookahead *= 2
+
 
     # AMC class
-    def __init__(self, f: typing.TextIO):
+    STREAM_SIZE = 32 * 1024 * 1024 # Larger files are scanned as they run, without the parse cache
+
+    def __init__(self, f: typing.TextIO, cache: 'APTParseCache' = None):
         self.f = f
-        self.scanner = self.Scanner(f)
+        self.cache = cache
+        self.statements = None # Parsed statements, kept unless streaming
+        self.streaming = self.Size(f) > self.STREAM_SIZE
+        if self.streaming:
+            self.scanner = self.StreamScanner(f)
+            return
+        if cache == None:
+            self.scanner = self.Scanner(f)
+            return
+        data = f.read()
+        self.scanner = self.Scanner(io.StringIO(data)) # Still used for line numbers
+        key = cache.Key(data)
+        self.statements = cache.Load(key)
+        if self.statements == None:
+            self.statements = list(self.Parse())
+            cache.Store(key, self.statements)
+        self.scanner.eof = True
 
     def Next(self):
         return self.scanner.Next()
 
+    def Parse(self):
+        while self.scanner.error == None and not self.scanner.eof:
+            stmt = self.Next()
+            if stmt != None:
+                yield stmt
+
+    @staticmethod
+    def Size(f) -> int:
+        try:    return os.fstat(f.fileno()).st_size - f.tell()
+        except (AttributeError, OSError, io.UnsupportedOperation): return 0 # In-memory
+
+    def __iter__(self):
+        """ Statements. A streamed file yields each statement once, as it is scanned """
+        if self.statements == None and not self.streaming:
+            self.statements = list(self.Parse())
+        if self.statements != None:
+            return iter(self.statements)
+        return self.Parse()
+
+
+class APTParseCache():
+    """ On-disk cache of parsed statements
+
+    Entries are keyed by the hash of the file content and GRAMMAR_VERSION, stored as compressed pickles.
+    When the cache grows over maxBytes, least recently used entries are removed.
+    """
+    GRAMMAR_VERSION = "6" # Bump when the Scanner or the Statement/Expr classes change
+
+    def __init__(self, directory = None, maxBytes = 256 * 1024 * 1024, memoryEntries = 256):
+        self.directory = cacheDir("parse") if directory == None else directory
+        self.maxBytes = maxBytes
+        self.memory = collections.OrderedDict() # key -> statements, most recent last. Keeps a daemon's files parsed
+        self.memoryEntries = memoryEntries
+        self.lock = threading.Lock()
+
+    def Key(self, data: str) -> str:
+        return hashlib.sha256((self.GRAMMAR_VERSION + "\0" + data).encode("utf-8")).hexdigest()
+
+    def Path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".pickle.z")
+
+    def __getstate__(self): # Sent to worker processes without the in-memory entries
+        return {k: v for k, v in self.__dict__.items() if k not in ["memory", "lock"]}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.memory, self.lock = collections.OrderedDict(), threading.Lock()
+
+    def Remember(self, key: str, statements: list):
+        with self.lock:
+            self.memory[key] = statements
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.memoryEntries:
+                self.memory.popitem(last=False)
+
+    def Load(self, key: str) -> typing.Optional[list]:
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+        path = self.Path(key)
+        try:
+            with open(path, "rb") as f:
+                statements = pickle.loads(zlib.decompress(f.read()))
+            os.utime(path) # Mark as recently used
+            self.Remember(key, statements)
+            return statements
+        except Exception: # Missing or unreadable entry is a miss
+            return None
+
+    def Store(self, key: str, statements: list):
+        self.Remember(key, statements)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = "%s.%d.tmp" % (self.Path(key), os.getpid())
+            with open(tmp, "wb") as f:
+                f.write(zlib.compress(pickle.dumps(statements, pickle.HIGHEST_PROTOCOL), 1))
+            os.replace(tmp, self.Path(key))
+            self.Evict()
+        except OSError as e:
+            print("Parse cache not written: %s" % e)
+
+    def Evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".pickle.z"): continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+                entries.append((st.st_mtime, st.st_size, name))
+            except OSError: pass
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.maxBytes: break
+            try: os.remove(os.path.join(self.directory, name))
+            except OSError: pass
+            total -= size
+
+
+class APTPrereqCache():
+    """ On-disk results of PREREQ files run with a TTL, shared by worker processes
+
+    Entries are keyed by the path and content of the prerequisite, the values of the $vars it reads and the mtime
+    and size of its nested PREREQ and @file template files, and hold the $vars it set. Only passing runs are stored,
+    a failing run or an expired entry removes the entry. Keys share 256 lock files.
+    """
+    def __init__(self, directory = None):
+        self.directory = cacheDir("prereq") if directory == None else directory
+        self.hits, self.misses = 0, 0
+
+    def Key(self, path: str, data: str, inputs: dict) -> str:
+        inputs = json.dumps(inputs, sort_keys=True, default=repr)
+        return hashlib.sha256(("\0".join([os.path.abspath(path), data, inputs])).encode("utf-8")).hexdigest()
+
+    def Path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".pickle")
+
+    def Load(self, key: str) -> typing.Optional[dict]:
+        try:
+            with open(self.Path(key), "rb") as f:
+                entry = pickle.load(f)
+        except Exception: # Missing or unreadable entry is a miss
+            return None
+        if entry["expires"] <= time.time():
+            self.Invalidate(key) # Expired, called under Lock
+            return None
+        return entry
+
+    def Store(self, key: str, entry: dict):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = "%s.%d.tmp" % (self.Path(key), os.getpid())
+            with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as f: # $vars often hold tokens
+                pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.Path(key))
+        except (OSError, pickle.PicklingError, TypeError, AttributeError) as e:
+            print("Prerequisite cache not written: %s" % e)
+
+    def Invalidate(self, key: str):
+        try: os.remove(self.Path(key))
+        except OSError: pass
+
+    @contextlib.contextmanager
+    def Lock(self, key: str):
+        """ Held while checking and running a prerequisite, so it runs once when files start together """
+        if fcntl == None:
+            yield
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, "lock-" + key[:2]), "a") as f: # 256 lock files at most, shared by keys
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:     yield
+            finally: fcntl.flock(f, fcntl.LOCK_UN)
+
+    @staticmethod
+    def Templates(expr) -> typing.List[str]:
+        """ File names of the @file: references of an expression, including those inside object literals """
+        names = []
+        def lit(val):
+            if isinstance(val, dict):
+                for k in val: lit(val[k])
+            elif isinstance(val, list):
+                for v in val: lit(v)
+            elif isinstance(val, str):
+                walk(APT.Expr.StringLit(val).deriveType())
+        def walk(expr):
+            if isinstance(expr, APT.Expr.AtVar):
+                fname = expr.val[1:].strip().split(":")[0]
+                if fname != "": names.append(fname)
+            elif isinstance(expr, APT.Expr.BinOp):
+                walk(expr.left), walk(expr.right)
+            elif isinstance(expr, APT.Expr.StringLit):
+                walk(expr.deriveType())
+            elif isinstance(expr, APT.Expr.Object):
+                lit(expr.val)
+        walk(expr)
+        return names
+
+    @staticmethod
+    def Inputs(runner: 'APTRunner') -> dict:
+        """ Values of the $vars the prerequisite reads, and the mtime and size of the files it uses:
+        its @file templates and nested PREREQs, recursively """
+        reads, files = set(), {}
+        def version(path: str) -> bool:
+            if path in files: return False
+            try:
+                st = os.stat(path)
+                files[path] = [st.st_mtime_ns, st.st_size]
+            except OSError:
+                files[path] = None # Missing, fails when run
+            return files[path] != None
+        def walk(statements, baseDir):
+            for stmt in APT.Statement.Walk(statements):
+                for expr in [getattr(stmt, k, None) for k in ["name", "method", "url", "data", "assertion", "ttl", "count", "concurrency"]]:
+                    reads.update(APTSectionScheduler.ExprVars(expr)[0])
+                    for fname in APTPrereqCache.Templates(expr):
+                        version(findFile(fname, baseDir) or fname)
+                if isinstance(stmt, APT.Statement.Prereq):
+                    path = findFile(stmt.filename, baseDir) or stmt.filename
+                    if version(path):
+                        try:
+                            with open(path, "r") as f:
+                                walk(list(APT(f, runner.APT.cache)), os.path.dirname(os.path.abspath(path)))
+                        except Exception: # Unreadable or invalid, fails when run
+                            pass
+        walk(runner.APT, runner.baseDir)
+        inputs = {k: runner.env.vars[k] for k in sorted(reads) if k in runner.env.vars}
+        if len(files) > 0: inputs[APTSectionScheduler.ANY] = files
+        return inputs
+
+    def Run(self, runner: 'APTRunner', path: str, ttl: float) -> bool:
+        """ Run a PREREQ sub-runner, or apply the $vars of a stored run. Returns True if it passed """
+        env = runner.env
+        key = self.Key(path, runner.APT.scanner.data, self.Inputs(runner))
+        with self.Lock(key):
+            entry = self.Load(key)
+            if entry != None:
+                self.hits += 1
+                for k, v in entry["vars"].items():
+                    env.setVar(k, v)
+                if "at" in entry:
+                    env.setAtVar(entry["at"])
+                runner.Log("    Prerequisite %s cached, expires in %ds" % (os.path.basename(path), entry["expires"] - time.time()))
+                return True
+            self.misses += 1
+            before, at = dict(env.vars), env.at
+            runner.Run()
+            if runner.testFailed:
+                self.Invalidate(key)
+                return False
+            entry = {"expires": time.time() + ttl, "vars": {k: v for k, v in env.vars.items() if k not in before or before[k] is not v}}
+            if env.at is not at:
+                entry["at"] = env.at
+            self.Store(key, entry)
+            return True
+
+
+class APTHistory():
+    """ Durations and outcomes of past runs of each file and section, in SQLite
+
+    Used to run likely failures first and to pick the files that fit a time budget.
+    """
+    KEEP_RUNS = 50 # Per file
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS runs (path TEXT, started REAL, duration REAL, passed INTEGER);
+        CREATE INDEX IF NOT EXISTS runs_path ON runs (path, started);
+        CREATE TABLE IF NOT EXISTS sections (path TEXT, started REAL, name TEXT, duration REAL, passed INTEGER);
+        CREATE INDEX IF NOT EXISTS sections_path ON sections (path, started);
+    """
+
+    def __init__(self, path = None):
+        import sqlite3
+        self.path = os.path.join(cacheDir("history"), "history.sqlite") if path == None else path
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.db = sqlite3.connect(self.path, timeout=10)
+        self.db.executescript(self.SCHEMA)
+
+    def Record(self, results: typing.List[dict]):
+        """ Store the results of a run, as returned by runCaptured """
+        with self.db:
+            for r in results:
+                path, started = os.path.abspath(r["file"]), r.get("started", time.time() - r["duration"])
+                self.db.execute("INSERT INTO runs VALUES (?, ?, ?, ?)", (path, started, r["duration"], int(r["passed"])))
+                self.db.executemany("INSERT INTO sections VALUES (?, ?, ?, ?, ?)",
+                                    [(path, started, s["name"], s["duration"], int(s["passed"])) for s in r.get("sections", [])])
+                for table in ["runs", "sections"]:
+                    self.db.execute("DELETE FROM %s WHERE path = ? AND started < (SELECT MIN(started) FROM "
+                                    "(SELECT started FROM runs WHERE path = ? ORDER BY started DESC LIMIT ?))" % table,
+                                    (path, path, self.KEEP_RUNS))
+
+    def Stats(self, files: typing.List[str]) -> typing.Dict[str, dict]:
+        """ file -> {"duration": mean of recent runs, "passed": last outcome, "last": start of last run}. Files never run are left out """
+        stats = {}
+        for f in files:
+            rows = self.db.execute("SELECT started, duration, passed FROM runs WHERE path = ? ORDER BY started DESC LIMIT 5",
+                                   (os.path.abspath(f),)).fetchall()
+            if len(rows) > 0:
+                stats[f] = {"duration": sum(r[1] for r in rows) / len(rows), "passed": bool(rows[0][2]), "last": rows[0][0]}
+        return stats
+
+    @staticmethod
+    def Changed(f: str, stat: typing.Optional[dict]) -> bool:
+        try:
+            return stat == None or os.path.getmtime(f) >= stat["last"]
+        except OSError:
+            return True
+
+    def Order(self, files: typing.List[str]) -> typing.List[str]:
+        """ Files that failed last time first, then new or changed since their last run, then the rest. Shortest first within each """
+        stats = self.Stats(files)
+        def key(f):
+            stat = stats.get(f)
+            tier = 0 if stat != None and not stat["passed"] else (1 if self.Changed(f, stat) else 2)
+            return (tier, stat["duration"] if stat != None else 0)
+        return sorted(files, key=key)
+
+    def Longest(self, files: typing.List[str]) -> typing.List[str]:
+        """ Longest known duration first, files never run before them. Shortens a run spread over several workers """
+        stats = self.Stats(files)
+        return sorted(files, key=lambda f: (0, 0) if f not in stats else (1, -stats[f]["duration"]))
+
+    def Select(self, files: typing.List[str], budget: float) -> typing.Tuple[typing.List[str], float]:
+        """ Files worth the most that fit in budget seconds, and their estimated duration. Keeps the order of files
+
+        A file is worth more if it failed last time, or is new or changed, or has not run for a while. Files never run
+        are estimated at the mean duration of the others. Picks the best value per second first.
+        """
+        stats = self.Stats(files)
+        known = [s["duration"] for s in stats.values()]
+        guess = sum(known) / len(known) if len(known) > 0 else 1.0
+        def value(f):
+            stat = stats.get(f)
+            if stat != None and not stat["passed"]: return 100.0
+            if self.Changed(f, stat):               return 50.0
+            return 1.0 + min(24.0, (time.time() - stat["last"]) / 3600) # Rotate through the rest
+        duration = {f: stats[f]["duration"] if f in stats else guess for f in files}
+        chosen, total = set(), 0.0
+        for f in sorted(files, key=lambda f: value(f) / max(duration[f], 0.001), reverse=True):
+            if total + duration[f] <= budget:
+                chosen.add(f)
+                total += duration[f]
+        return [f for f in files if f in chosen], total
+
+    def Close(self):
+        self.db.close()
+
+
+class APTResponse():
+    """ Lazy view of a response for RES matching
+
+    Acts as the dict RES expectations are matched against: $status, $header, $body, the JSON body fields,
+    and the timings $elapsed_ms (request sent to headers received) and $phases (milliseconds by phase when tracing, see APTTracedConnection).
+    The body is only read and decoded when a body field or $body is accessed. Bodies larger than streamThreshold
+    are stream-parsed (with the optional ijson package) keeping only the top level fields the expectation uses.
+    Bodies that have to be read whole are limited to maxBodySize.
+    """
+    class TooLarge(Exception): pass
+    SPECIAL = ["$status", "$header", "$body", "$elapsed_ms", "$phases"]
+    REUSE_SIZE = 64 * 1024 # Unread bodies up to this size are drained to keep the connection
+
+    def __init__(self, res: typing.Optional[requests.Response], maxBodySize = 64 * 1024 * 1024, streamThreshold = 4 * 1024 * 1024,
+                 elapsed: float = None, phases: dict = None):
+        self.res, self.maxBodySize, self.streamThreshold = res, maxBodySize, streamThreshold
+        self.elapsed, self.phases = elapsed, phases # Milliseconds
+        self.headers = None
+        self.content = None     # Body, once read whole
+        self.consumed = False   # Body stream read, whole or stream-parsed
+        self.fields = None      # Parsed JSON body, or the streamed top level fields
+        self.partial = False    # fields only holds streamed fields
+        self.streamed = set()   # Top level fields looked for while streaming
+
+    def Length(self) -> typing.Optional[int]:
+        try:    return int(self.res.headers.get("Content-Length"))
+        except (TypeError, ValueError): return None
+
+    def Content(self) -> bytes:
+        """ Read the whole body, up to maxBodySize """
+        if self.content != None:
+            return self.content
+        length = self.Length()
+        if length != None and length > self.maxBodySize:
+            raise self.TooLarge("Response body of %d bytes exceeds max body size %d" % (length, self.maxBodySize))
+        chunks, size = [], 0
+        self.consumed = True
+        for chunk in self.res.iter_content(64 * 1024):
+            size += len(chunk)
+            if size > self.maxBodySize:
+                self.res.close()
+                raise self.TooLarge("Response body exceeds max body size %d" % self.maxBodySize)
+            chunks.append(chunk)
+        self.content = b"".join(chunks)
+        return self.content
+
+    def Text(self) -> str:
+        """ Body decoded with the charset of the response, else as UTF-8/16/32 JSON """
+        content = self.Content()
+        try:                                return str(content, self.res.encoding or requests.utils.guess_json_utf(content) or "utf-8", errors="replace")
+        except (LookupError, TypeError):    return str(content, "utf-8", errors="replace")
+
+    def Prefetch(self, paths: typing.List[str]):
+        """ Read the body for the fields used by paths, stream-parsing only those fields when the body is large """
+        if self.res == None:
+            return
+        keys = set(re.split(r"[.\[]", p)[0] for p in paths) - set(self.SPECIAL) - {"$set"}
+        if self.partial and (len(keys - self.streamed) > 0 or "$body" in paths):
+            raise self.TooLarge("Response body was stream-parsed for an earlier RES, %s not kept" % ", ".join(sorted(keys - self.streamed) or ["$body"]))
+        if self.fields != None:
+            return
+        length = self.Length()
+        if len(keys) == 0 and "$body" not in paths:
+            return # Status and headers only, the body is never read
+        ijson = None
+        if "$body" not in paths and length != None and length > self.streamThreshold and not self.consumed and self.res.raw is not None:
+            try:                import ijson
+            except ImportError: pass
+        if ijson == None:
+            self.Fields() # Read whole, limited by maxBodySize
+            return
+        self.fields, self.partial, self.streamed, self.consumed = {}, True, keys, True
+        builders = {}
+        self.res.raw.decode_content = True
+        try:
+            for prefix, event, value in ijson.parse(self.res.raw):
+                top = prefix.split(".")[0]
+                if top not in keys or top in self.fields: continue
+                if top not in builders:
+                    builders[top] = ijson.ObjectBuilder()
+                builders[top].event(event, value)
+                if prefix == top and event not in ["start_map", "start_array", "map_key"]: # Field done
+                    self.fields[top] = builders.pop(top).value
+                if len(self.fields) == len(keys): break
+        except Exception:
+            pass # Not JSON, fields not found
+        self.res.close()
+
+    def Fields(self) -> dict:
+        if self.fields == None:
+            try:
+                fields = json.loads(self.Content())
+                self.fields = fields if isinstance(fields, dict) else {}
+            except self.TooLarge:
+                raise
+            except Exception:
+                self.fields = {}
+        return self.fields
+
+    def Headers(self) -> dict:
+        if self.headers == None:
+            self.headers = {} if self.res == None else {k: self.res.headers[k] for k in self.res.headers}
+        return self.headers
+
+    def __contains__(self, key):
+        if key in ["$status", "$header"]:   return True
+        if key == "$elapsed_ms":            return self.elapsed != None
+        if key == "$phases":                return self.phases != None
+        if self.res == None:                return False
+        if key == "$body":                  return True
+        try:                                return key in self.Fields()
+        except self.TooLarge:               return False
+
+    def __getitem__(self, key):
+        if key == "$status":    return None if self.res == None else self.res.status_code
+        if key == "$header":    return self.Headers()
+        if key == "$elapsed_ms":return self.elapsed
+        if key == "$phases":    return self.phases
+        if key == "$body":      return None if self.res == None or self.partial else self.Text()
+        return self.Fields()[key]
+
+    def Materialize(self) -> dict:
+        """ Everything but the timings as a plain dict """
+        data = {"$status": self["$status"], "$header": self.Headers()}
+        if self.res != None:
+            try:
+                data["$body"] = self["$body"]
+                data.update(self.Fields())
+            except self.TooLarge: pass
+        return data
+
+    def __eq__(self, other):    return self.Materialize() == other
+    def __repr__(self):         return repr(self.Materialize())
+
+    @property
+    def status_code(self):      return None if self.res == None else self.res.status_code
+
+    def Release(self):
+        if self.res == None or self.consumed:
+            return
+        length = self.Length()
+        if length != None and length <= self.REUSE_SIZE:
+            try: self.Content() # Drain so the connection can be reused
+            except Exception: pass
+        self.res.close()
+
+
+class APTCassette():
+    """ Recorded responses of a test file, for replaying it without network access
+
+    <file>.cassette holds the records, appended while recording: lengths, JSON metadata and the body.
+    <file>.cassette.idx is a sorted table of (16 byte request hash, record offset), written when recording ends.
+    Both are memory-mapped when replaying, so lookups are a binary search and only matched bodies are read.
+
+    Requests are keyed by method, normalized url and body, plus how many times the same request was made before.
+    A second key without the body is used when the body differs, e.g. because of $_RANDOM or $_UID.
+    """
+    class Miss(Exception): pass
+    MAGIC = b"APTCAS01"
+    ENTRY = struct.Struct(">16sQ")
+    RECORD = struct.Struct(">II") # Metadata and body length
+
+    def __init__(self, path:str, mode:str):
+        self.path, self.mode = path, mode # "record" or "replay"
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+        if mode == "record":
+            self.entries = []
+            self.data = open(path + ".tmp", "wb")
+            self.size = 0
+        else:
+            self.index = self.data = None
+            if os.path.isfile(path) and os.path.isfile(path + ".idx"):
+                self.index, self.data = self.Map(path + ".idx"), self.Map(path)
+            if self.index != None and self.index[:len(self.MAGIC)] != self.MAGIC:
+                raise ValueError("%s.idx is not a cassette index" % path)
+
+    @staticmethod
+    def Map(path:str) -> typing.Optional[mmap.mmap]:
+        with open(path, "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size > 0 else None
+
+    @staticmethod
+    def Normalize(method:str, url:str) -> bytes:
+        parts = urlsplit(url)
+        query = "&".join(sorted(parts.query.split("&"))) if parts.query != "" else ""
+        return ("%s %s://%s%s?%s" % (method.upper(), parts.scheme.lower(), parts.netloc.lower(), parts.path or "/", query)).encode("utf-8")
+
+    @staticmethod
+    def Body(body) -> bytes:
+        if body == None: return b""
+        if isinstance(body, str): body = body.encode("utf-8")
+        try:    return json.dumps(json.loads(body), sort_keys=True).encode("utf-8")
+        except ValueError: return body
+
+    def Keys(self, method:str, url:str, body) -> typing.List[bytes]:
+        """ Exact and body-less hash of the request, counting earlier identical requests """
+        request = self.Normalize(method, url)
+        keys = []
+        for key in [request + b"\0" + self.Body(body), b"*\0" + request]:
+            with self.lock:
+                n = self.counts[key]
+                self.counts[key] += 1
+            keys.append(hashlib.sha256(key + b"\0" + str(n).encode()).digest()[:16])
+        return keys
+
+    def Request(self, transport:'APTTransport', method:str, url:str, **kwargs) -> requests.Response:
+        keys = self.Keys(method, url, kwargs.get("data"))
+        if self.mode == "replay":
+            for key in keys:
+                offset = self.Find(key)
+                if offset != None:
+                    return self.Load(offset)
+            raise self.Miss("No recorded response for %s %s in %s" % (method, url, self.path))
+        res = transport.Request(method, url, **kwargs)
+        self.Append(keys, method, url, kwargs.get("data"), res)
+        return self.Response(res.status_code, res.reason, res.url, res.headers, res.content) # Read like a replayed one
+
+    def Append(self, keys:list, method:str, url:str, body, res:requests.Response):
+        content = res.content
+        meta = json.dumps({"method": method, "url": url, "request": self.Body(body).decode("utf-8", "replace"),
+                           "status": res.status_code, "reason": res.reason, "headers": dict(res.headers)}).encode("utf-8")
+        with self.lock:
+            offset = self.size
+            self.data.write(self.RECORD.pack(len(meta), len(content)) + meta + content)
+            self.size += self.RECORD.size + len(meta) + len(content)
+            self.entries += [(key, offset) for key in keys]
+
+    def Find(self, key:bytes) -> typing.Optional[int]:
+        if self.index == None: return None
+        lo, hi = 0, (len(self.index) - len(self.MAGIC)) // self.ENTRY.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            k, offset = self.ENTRY.unpack_from(self.index, len(self.MAGIC) + mid * self.ENTRY.size)
+            if k == key:    return offset
+            if k < key:     lo = mid + 1
+            else:           hi = mid
+        return None
+
+    def Load(self, offset:int) -> requests.Response:
+        metaSize, bodySize = self.RECORD.unpack_from(self.data, offset)
+        start = offset + self.RECORD.size
+        meta = json.loads(self.data[start:start + metaSize])
+        return self.Response(meta["status"], meta["reason"], meta["url"], meta["headers"], self.data[start + metaSize:start + metaSize + bodySize])
+
+    @staticmethod
+    def Response(status:int, reason:str, url:str, headers:dict, body:bytes) -> requests.Response:
+        """ Response whose body is read from memory """
+        res = requests.Response()
+        res.status_code, res.reason, res.url = status, reason, url
+        res.headers = requests.structures.CaseInsensitiveDict(headers)
+        res.encoding = requests.utils.get_encoding_from_headers(res.headers)
+        res.raw = io.BytesIO(body)
+        return res
+
+    def Close(self, completed = True):
+        """ Finish a recording. An interrupted recording is dropped, keeping the previous cassette """
+        if self.mode == "record":
+            self.data.close()
+            if not completed:
+                os.unlink(self.path + ".tmp")
+                return
+            entries = {}
+            for key, offset in self.entries: # Keep the first record of a key
+                entries.setdefault(key, offset)
+            with open(self.path + ".idx.tmp", "wb") as f:
+                f.write(self.MAGIC)
+                for key in sorted(entries):
+                    f.write(self.ENTRY.pack(key, entries[key]))
+            os.replace(self.path + ".tmp", self.path)
+            os.replace(self.path + ".idx.tmp", self.path + ".idx")
+        else:
+            for m in [self.index, self.data]:
+                if m != None: m.close()
+
+
+class APTRequestBody():
+    """ Request body of a REQ, compiled to pre-encoded JSON segments and slots for the variable parts
+
+    Built once per object literal. Encoding a resolved body only encodes the slots and joins the segments,
+    the output is the same as json.dumps(data) without $header. $header is extracted once when constant.
+    """
+    class Slot():
+        def __init__(self, path:tuple): self.path = path
+
+    def __init__(self, expr: 'APT.Expr.Base'):
+        self.segments, self.headers = None, None # None = no template, encode the whole body
+        if not isinstance(expr, APT.Expr.Object) or not isinstance(expr.val, dict):
+            return
+        try:
+            segments = []
+            body = {k: v for k, v in expr.val.items() if k != "$header"}
+            self.Build(body, (), segments)
+            if "$header" in expr.val:
+                const, header = APT.Expr.Object.build(expr.val["$header"])
+                if const:
+                    self.headers = self.Headers(header)
+            self.segments = self.Merge(segments)
+        except (TypeError, ValueError): # Not encodable ahead of time
+            self.segments = None
+
+    @classmethod
+    def For(cls, expr: 'APT.Expr.Base') -> 'APTRequestBody':
+        body = expr.__dict__.get("_body")
+        if body == None:
+            body = expr._body = cls(expr)
+        return body
+
+    @staticmethod
+    def Headers(header) -> dict:
+        return {k: str(header[k]) for k in header}
+
+    @classmethod
+    def Build(cls, data, path:tuple, segments:list):
+        const, val = APT.Expr.Object.build(data)
+        if const:
+            segments.append(json.dumps(val).encode("utf-8"))
+        elif isinstance(data, dict):
+            segments.append(b"{")
+            for i, k in enumerate(data):
+                if i > 0: segments.append(b", ")
+                segments.append(json.dumps({k: 0})[1:-2].encode("utf-8")) # "key": 
+                cls.Build(data[k], path + (k,), segments)
+            segments.append(b"}")
+        elif isinstance(data, list):
+            segments.append(b"[")
+            for i, v in enumerate(data):
+                if i > 0: segments.append(b", ")
+                cls.Build(v, path + (i,), segments)
+            segments.append(b"]")
+        else:
+            segments.append(cls.Slot(path))
+
+    @staticmethod
+    def Merge(segments:list) -> list:
+        merged = []
+        for seg in segments:
+            if isinstance(seg, bytes) and len(merged) > 0 and isinstance(merged[-1], bytes):
+                merged[-1] += seg
+            else:
+                merged.append(seg)
+        return merged
+
+    def Encode(self, data) -> typing.Tuple[dict, typing.Union[bytes, str]]:
+        """ (headers, body) for resolved data """
+        if self.segments == None or not isinstance(data, dict):
+            headers = {}
+            if "$header" in data:
+                headers = self.Headers(data["$header"])
+                data = {k: data[k] for k in data if k != "$header"} # Resolved data may be shared
+            return headers, json.dumps(data)
+        headers = self.headers if self.headers != None else self.Headers(data["$header"]) if "$header" in data else {}
+        parts = []
+        for seg in self.segments:
+            if isinstance(seg, bytes):
+                parts.append(seg)
+            else:
+                val = data
+                for k in seg.path:
+                    val = val[k]
+                parts.append(json.dumps(val).encode("utf-8"))
+        return dict(headers), b"".join(parts)
+
 
 # APT Runner
+class APTMatcher():
+    """ Expectation compiled to a flat list of checks on pre-split paths
+
+    {key: value} checks equality, {key: {...}} checks the listed fields of the nested object,
+    and with a [*] path ({"items[*]": {...}}) of every item. Arrays can be matched ignoring order
+    with {key: {$unordered: [...]}} or for contained items with {key: {$subset: [...]}}, both with hashed counts.
+    Values are compared with {key: {$lt: 200}}, $lte, $gt, $gte and $ne, several at once for a range.
+    Match returns every mismatch as (path, expected, actual).
+    """
+    EQUAL, OBJECT, UNORDERED, SUBSET, COMPARE = range(5)
+    ARRAY_OPS = {"$unordered": UNORDERED, "$subset": SUBSET}
+    COMPARE_OPS = {"$lt": "<", "$lte": "<=", "$gt": ">", "$gte": ">=", "$ne": "!="}
+    OPERATORS = {"<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge, "==": operator.eq, "!=": operator.ne}
+
+    def __init__(self, expect: dict):
+        self.checks = []
+        for k, v in expect.items():
+            fields = splitPath(k) if isinstance(k, str) else (k,)
+            if isinstance(v, dict) and len(v) == 1 and next(iter(v)) in self.ARRAY_OPS and isinstance(next(iter(v.values())), list):
+                op = next(iter(v))
+                self.checks.append((k, fields, self.ARRAY_OPS[op], (v, self.Counts(v[op]))))
+            elif isinstance(v, dict) and len(v) > 0 and all(op in self.COMPARE_OPS for op in v):
+                self.checks.append((k, fields, self.COMPARE, (v, [(self.COMPARE_OPS[op], bound) for op, bound in v.items()])))
+            elif isinstance(v, dict):
+                self.checks.append((k, fields, self.OBJECT, APTMatcher(v)))
+            else:
+                self.checks.append((k, fields, self.EQUAL, v))
+
+    @classmethod
+    def For(cls, expr: 'APT.Expr.Base', expect: dict) -> 'APTMatcher':
+        """ Matcher for a resolved expectation, kept on the expression when it is constant """
+        cached = expr.__dict__.get("_matcher") if expr is not None else False
+        if cached:
+            return cached
+        matcher = cls(expect)
+        if cached is None: # Not known yet if the expression is constant
+            expr._matcher = matcher if expr.isConst() else False
+        return matcher
+
+    @staticmethod
+    def Key(v):
+        """ Hashable stand-in for a value """
+        if isinstance(v, (dict, list)):
+            try:                return ("json", json.dumps(v, sort_keys=True))
+            except TypeError:   return ("repr", repr(v))
+        return v
+
+    @classmethod
+    def Counts(cls, items: list) -> collections.Counter:
+        return collections.Counter(cls.Key(v) for v in items)
+
+    @staticmethod
+    def Number(v):
+        """ Numeric value of a number or a numeric string, e.g. 200 in ASSERT $latency.p99 < 200. None otherwise """
+        if isinstance(v, (int, float)) and not isinstance(v, bool): return v
+        try:                            return float(v) if isinstance(v, str) else None
+        except ValueError:              return None
+
+    @classmethod
+    def Compare(cls, actual, op: str, expect) -> bool:
+        """ actual <op> expect, numerically if one of them is a number. False if the values can't be compared """
+        if isinstance(actual, str) != isinstance(expect, str):
+            a, e = cls.Number(actual), cls.Number(expect)
+            if a != None and e != None:
+                actual, expect = a, e
+        try:                return bool(cls.OPERATORS[op](actual, expect))
+        except TypeError:   return False
+
+    def Match(self, obj, prefix = "", mismatches = None) -> list:
+        if mismatches == None: mismatches = []
+        for k, fields, kind, expect in self.checks:
+            actual = accessPath(obj, fields)
+            if kind == self.EQUAL:
+                if actual != expect:
+                    mismatches.append((prefix + str(k), expect, actual))
+            elif kind == self.OBJECT:
+                if fields[-1] is PATH_ANY and isinstance(actual, list):
+                    base = prefix + str(k)[:-3]
+                    for i, item in enumerate(actual):
+                        expect.Match(item, "%s[%d]." % (base, i), mismatches)
+                else:
+                    expect.Match(actual, prefix + str(k) + ".", mismatches)
+            elif kind == self.COMPARE:
+                literal, bounds = expect
+                if not all(self.Compare(actual, op, bound) for op, bound in bounds):
+                    mismatches.append((prefix + str(k), literal, actual))
+            else:
+                literal, counts = expect
+                if not isinstance(actual, list):
+                    mismatches.append((prefix + str(k), literal, actual))
+                    continue
+                actualCounts = self.Counts(actual)
+                if (actualCounts != counts) if kind == self.UNORDERED else len(counts - actualCounts) > 0:
+                    mismatches.append((prefix + str(k), literal, actual))
+        return mismatches
+
+
 class APTRunner():
-    def __init__(self, f: typing.TextIO, isSubtest = False, env = None):
-        self.APT = APT(f)
+    def __init__(self, f: typing.TextIO, isSubtest = False, env = None, out = None, transport = None, parseCache = None, cassette = None, prereqCache = None):
+        self.transport = APTTransport() if transport == None else transport
+        self.cassette, self.prereqCache = cassette, prereqCache
+        self.tracer = self.transport.tracer
+        with self.Span("parse", "parse", file=getattr(f, "name", None)):
+            self.APT = APT(f, parseCache)
         self.lastRes = None
+        self.timings = None # Elapsed ms of the requests of the running REPEAT block
+        self.stmt = None
         self.testFailed = False
+        self.failures = []
+        self.sections = []  # {"name", "duration", "passed"} of each finished SECT
+        self.section = None # (name, start, failure count) of the current SECT
         self.isSubtest = isSubtest
         self.env = APTEnv() if env == None else env
-    def Fail(self, msg):
+        self.out = sys.stdout if out == None else out
+        self.baseDir = os.path.dirname(os.path.abspath(f.name)) if isinstance(getattr(f, "name", None), str) else None
+    def Log(self, *args):
+        print(*args, file=self.out)
+    def Send(self, method, url, **kwargs) -> requests.Response:
+        """ Request through the transport, or the cassette when recording or replaying """
+        if self.cassette is None:
+            return self.transport.Request(method, url, **kwargs)
+        return self.cassette.Request(self.transport, method, url, **kwargs)
+    def Span(self, name, cat, **args):
+        """ Timed span when tracing, see APTTracer """
+        return NULL_SPAN if self.tracer is None else self.tracer.Start(name, cat, **args)
+    def LineNumber(self):
+        if hasattr(self.stmt, "pos"):
+            return self.APT.scanner.StatementLineNumber(self.stmt)
+        return self.APT.scanner.GetLastStatementLineNumber()
+    def Fail(self, msg, kind = "assert"):
+        """ Record a failure. kind is one of assert, status, request, expect, prereq """
         self.testFailed = True
-        print("    [FAILED] at line %d: %s" % (self.APT.scanner.GetLastStatementLineNumber(), msg))
-    def DoAssert(self, data, assertion):
-        def check(obj, expect, kPrefix):    
-            for k in expect:
-                actual = accessObj(obj,k)
-                if isinstance(expect[k], dict):
-                    check(actual, expect[k], kPrefix + k + ".")
-                else:
-                    if actual != expect[k]:
-                        self.Fail("response not matched at [%s]. Expected=%s, Actual=%s" % (kPrefix + k, expect[k], actual))
+        line = "[FAILED] at line %d: %s" % (self.LineNumber(), msg)
+        self.failures.append(line)
+        self.Log("    " + line)
+    def Fork(self, out) -> 'APTRunner':
+        """ Runner sharing this runner's script and environment, with its own last response and output """
+        runner = copy.copy(self)
+        runner.lastRes, runner.stmt, runner.out = None, None, out
+        runner.testFailed, runner.failures = False, []
+        runner.sections, runner.section = [], None
+        return runner
+    def DoAssert(self, data, assertion, expr = None):
+        with self.Span("assert", "assert"):
+            self.Assert(data, assertion, expr)
+
+    def Assert(self, data, assertion, expr = None):
         if isinstance(assertion, dict):
-            check(data, assertion, "")
+            for path, expect, actual in APTMatcher.For(expr, assertion).Match(data):
+                self.Fail("response not matched at [%s]. Expected=%s, Actual=%s" % (path, expect, actual),
+                          "status" if path == "$status" else "assert")
         else:
             if data != assertion:
                 self.Fail("Assertion failed. Expected=%s, Actual=%s" % (assertion, data))
-            
-    def Run(self):
-        while self.APT.scanner.error == None and not self.APT.scanner.eof:
-            stmt = self.APT.Next()
 
-            if isinstance(stmt, APT.Statement.Section): # Section
-                stmt:APT.Statement.Section
-                print(stmt.name.resolve(self.env))
+    KEYWORDS = {APT.Statement.Section: "SECT", APT.Statement.Request: "REQ", APT.Statement.Response: "RES", APT.Statement.Set: "SET",
+                APT.Statement.Prereq: "PREREQ", APT.Statement.Assert: "ASSERT", APT.Statement.Print: "PRINT", APT.Statement.Repeat: "REPEAT"}
 
-            if isinstance(stmt, APT.Statement.Request): # Request
-                stmt:APT.Statement.Request
+    def Exec(self, stmt) -> bool:
+        """ Execute a single statement. Returns False if the test should stop """
+        if self.tracer is None:
+            return self.ExecStatement(stmt)
+        self.stmt = stmt
+        with self.tracer.Start(self.KEYWORDS.get(type(stmt), "UNKNOWN"), "statement", line=self.LineNumber()):
+            return self.ExecStatement(stmt)
+
+    def ExecStatement(self, stmt) -> bool:
+        self.stmt = stmt
+        self.env.baseDir = self.baseDir # Env may be shared with PREREQ runners of other folders
+
+        if isinstance(stmt, APT.Statement.Section): # Section
+            stmt:APT.Statement.Section
+            name = stmt.name.resolve(self.env)
+            self.Log(name)
+            self.EndSection()
+            self.section = (str(name), time.perf_counter(), len(self.failures))
+
+        if isinstance(stmt, APT.Statement.Request): # Request
+            stmt:APT.Statement.Request
+            with self.Span("resolve", "resolve"):
                 method = stmt.method.resolve(self.env)
                 url = stmt.url.resolve(self.env)
-                try :
-                    if stmt.data == None:
-                        self.lastRes = requests.request(method, url, verify=False)
-                    else:
+            try :
+                self.ReleaseResponse()
+                APTTracedConnection.Phases() # Drop the phases of earlier requests
+                if stmt.data == None:
+                    start = time.perf_counter()
+                    with self.Span("http", "http", method=method, url=url):
+                        res = self.Send(method, url, verify=False, stream=True)
+                else:
+                    with self.Span("resolve", "resolve"):
                         data = stmt.data.resolve(self.env)
-                        print("    Requesting", data)
-                        headers = {}
-                        if "$header" in data:
-                            for k in data["$header"]:
-                                headers[k] = str(data["$header"][k])
-                            del data["$header"]
-                        self.lastRes = requests.request(method, url, data=json.dumps(data), headers=headers, timeout=1, verify=False)
-                except Exception as e:
-                    self.Fail("Request error: %s" % e)
-
-            if isinstance(stmt, APT.Statement.Response): # Response
-                stmt:APT.Statement.Response
+                    self.Log("    Requesting", data)
+                    with self.Span("encode", "resolve"):
+                        headers, body = APTRequestBody.For(stmt.data).Encode(data)
+                    start = time.perf_counter()
+                    with self.Span("http", "http", method=method, url=url):
+                        res = self.Send(method, url, data=body, headers=headers, timeout=1, verify=False, stream=True)
+                elapsed = (time.perf_counter() - start) * 1000
+                if self.timings is not None:
+                    self.timings.append(elapsed)
+                self.lastRes = APTResponse(res, self.transport.maxBodySize, self.transport.streamThreshold, round(elapsed, 3),
+                                           APTTracedConnection.Phases() if self.transport.tracer != None else None)
+            except Exception as e:
+                self.Fail("Request error: %s" % e, "request")
+
+        if isinstance(stmt, APT.Statement.Response): # Response
+            stmt:APT.Statement.Response
+            with self.Span("resolve", "resolve"):
                 expect = stmt.data.resolve(self.env)
-                if expect == None:
-                    self.Fail("Expecting 'None' is not allowed")
-                    return
-                print("    Expecting", expect)
-
-                res = {
-                    "$status": None,
-                    "$header": {}
-                }
-                try: 
-                    if self.lastRes != None:
-                        res["$status"] = self.lastRes.status_code
-                        for k in self.lastRes.headers:
-                            res["$header"][k] = self.lastRes.headers[k]
-                        res["$body"] = self.lastRes.text
-                        res.update(self.lastRes.json())
-                except: pass
-
-                # Extract var with {$set: ["field.field -> $aaa"]}
-                if "$set" in expect:
-                    for setcmd in expect["$set"]:
-                        field, var = setcmd.split("->")
-                        self.env.setVar(var.strip(), accessObj(res, field.strip()))
-                    del expect["$set"]
-                    
-                self.DoAssert(res, expect)
-
-            if isinstance(stmt, APT.Statement.Set): # Set
-                stmt:APT.Statement.Set
+            if expect == None:
+                self.Fail("Expecting 'None' is not allowed", "expect")
+                return False
+            self.Log("    Expecting", expect)
+
+            res = self.lastRes if self.lastRes is not None else APTResponse(None)
+            try:
+                if isinstance(expect, dict):
+                    with self.Span("decode", "decode"):
+                        res.Prefetch(list(expect) + [setcmd.split("->")[0].strip() for setcmd in expect.get("$set", [])])
+            except APTResponse.TooLarge as e:
+                self.Fail(str(e), "request")
+
+            # Extract var with {$set: ["field.field -> $aaa"]}
+            if "$set" in expect:
+                for setcmd in expect["$set"]:
+                    field, var = setcmd.split("->")
+                    self.env.setVar(var.strip(), accessObj(res, field.strip()))
+                expect = {k: expect[k] for k in expect if k != "$set"} # Resolved data may be shared
+                
+            self.DoAssert(res, expect, stmt.data)
+
+        if isinstance(stmt, APT.Statement.Set): # Set
+            stmt:APT.Statement.Set
+            with self.Span("resolve", "resolve"):
                 self.env.setVar(stmt.varname, stmt.data.resolve(self.env))
-            if isinstance(stmt, APT.Statement.Prereq): # Prerequisite
-                stmt:APT.Statement.Prereq
-                with open(stmt.filename, "r") as f:
-                    subrunner = APTRunner(f, True, self.env)
+        if isinstance(stmt, APT.Statement.Prereq): # Prerequisite
+            stmt:APT.Statement.Prereq
+            path = findFile(stmt.filename, self.baseDir) or stmt.filename
+            with open(path, "r") as f: # Kept open while a streamed file runs
+                subrunner = APTRunner(f, True, self.env, self.out, self.transport, self.APT.cache, self.cassette, self.prereqCache)
+                ttl = stmt.ttl.resolve(self.env) if stmt.ttl != None else None
+                if ttl and self.prereqCache != None and not subrunner.APT.streaming:
+                    passed = self.prereqCache.Run(subrunner, path, float(ttl))
+                else:
                     subrunner.Run()
-                    if subrunner.testFailed:
-                        self.Fail("Prerequisite failed")
+                    passed = not subrunner.testFailed
+            if not passed:
+                self.Fail("Prerequisite failed", "prereq")
 
-            if isinstance(stmt, APT.Statement.Assert): # Assert
-                stmt:APT.Statement.Assert
+        if isinstance(stmt, APT.Statement.Assert): # Assert
+            stmt:APT.Statement.Assert
+            with self.Span("resolve", "resolve"):
                 data = stmt.data.resolve(self.env)
                 assertion = stmt.assertion.resolve(self.env)
-                self.DoAssert(data, assertion)
+            if stmt.op != None:
+                if not APTMatcher.Compare(data, stmt.op, assertion):
+                    self.Fail("Assertion failed. Expected %s %s, Actual=%s" % (stmt.op, assertion, data))
+            else:
+                self.DoAssert(data, assertion, stmt.assertion)
 
-            if isinstance(stmt, APT.Statement.Print): # Print
-                stmt:APT.Statement.Print
-                data = stmt.data.resolve(self.env)
-                print("    [PRINT] at line %d: %s" % (self.APT.scanner.GetLastStatementLineNumber(), str(data)))
+        if isinstance(stmt, APT.Statement.Repeat): # Repeat
+            stmt:APT.Statement.Repeat
+            self.Repeat(stmt)
+
+        if isinstance(stmt, APT.Statement.Print): # Print
+            stmt:APT.Statement.Print
+            data = stmt.data.resolve(self.env)
+            self.Log("    [PRINT] at line %d: %s" % (self.LineNumber(), str(data)))
+        return True
+
+    @staticmethod
+    def Latency(timings: typing.List[float]) -> dict:
+        """ Count, min, mean, max and nearest-rank percentiles of request durations in ms """
+        values = sorted(timings)
+        if len(values) == 0:
+            return {"count": 0}
+        stats = {"count": len(values), "min": values[0], "mean": sum(values) / len(values), "max": values[-1]}
+        for name, q in [("p50", 0.5), ("p90", 0.9), ("p95", 0.95), ("p99", 0.99), ("p999", 0.999)]:
+            stats[name] = values[max(0, math.ceil(q * len(values)) - 1)]
+        return {k: round(v, 3) for k, v in stats.items()}
+
+    def Repeat(self, stmt: 'APT.Statement.Repeat'):
+        """ Run a REPEAT block, then set $latency to the statistics of the requests made in it
+
+        Iterations run on forks of this runner sharing its $vars. The output of the first iteration is shown,
+        the failures of all iterations are reported once with their count.
+        """
+        count = int(stmt.count.resolve(self.env))
+        concurrency = max(1, int(stmt.concurrency.resolve(self.env))) if stmt.concurrency != None else 1
+        timings = []
+        parent = self.tracer.Current() if self.tracer != None else None # Iteration threads start with no open span
+
+        def iteration(index: int) -> APTRunner:
+            child = self.Fork(io.StringIO())
+            child.timings = timings
+            with child.tracer.Start("iteration", "repeat", parent, index=index) if child.tracer != None else NULL_SPAN:
+                try:
+                    for s in stmt.body:
+                        if not child.Exec(s):
+                            break
+                finally:
+                    child.ReleaseResponse()
+            return child
+
+        failures, failed, shown = collections.Counter(), 0, set()
+        with ThreadPoolExecutor(max_workers=concurrency) if concurrency > 1 else contextlib.nullcontext() as executor:
+            children = executor.map(iteration, range(count)) if executor != None else map(iteration, range(count))
+            for index, child in enumerate(children):
+                if index == 0:
+                    self.out.write(child.out.getvalue())
+                    shown.update(child.failures)
+                failures.update(child.failures)
+                failed += child.testFailed
+        latency = self.Latency(timings)
+        if self.timings is not None: # Nested REPEAT
+            self.timings.extend(timings)
+        self.env.setVar("latency", latency)
+        self.Log("    REPEAT %d x %d: %d request(s), %d failed iteration(s), p50=%sms p90=%sms p99=%sms max=%sms" % (count, concurrency,
+                 latency["count"], failed, latency.get("p50"), latency.get("p90"), latency.get("p99"), latency.get("max")))
+        for line, n in failures.items():
+            self.testFailed = True
+            line = line if n == 1 else "%s (%d of %d iterations)" % (line, n, count)
+            self.failures.append(line)
+            if n > 1 or line not in shown:
+                self.Log("    " + line)
+
+    def EndSection(self):
+        """ Record the duration and outcome of the current SECT """
+        if self.section != None:
+            name, start, failures = self.section
+            self.sections.append({"name": name, "duration": time.perf_counter() - start, "passed": len(self.failures) == failures})
+            self.section = None
+
+    def ReleaseResponse(self):
+        """ Give the last response's connection back to the pool """
+        if self.lastRes is not None:
+            self.lastRes.Release()
+
+    def Run(self, concurrency = 0):
+        """ Run the script. With concurrency > 0, independent sections run concurrently """
+        try:
+            if concurrency > 0:
+                APTSectionScheduler(self, concurrency).Run()
+            else:
+                for stmt in self.APT:
+                    if not self.Exec(stmt):
+                        return
+        finally:
+            self.EndSection()
+            self.ReleaseResponse()
 
         if not self.isSubtest:
             if not self.testFailed:
-                print("All test passed!")
+                self.Log("All test passed!")
             else:
-                print("Test failed. See logs for error")
+                self.Log("Test failed. See logs for error")
+
+
+class APTSectionScheduler():
+    """ Run independent SECT blocks of a script concurrently on an asyncio event loop
+
+    Sections are ordered by the variables they read and write. A section waits for every earlier
+    section it conflicts with, so the result matches sequential execution. Output is reported in source order.
+    """
+    ANY = "*"           # Reads/writes everything (PREREQ, unknown $set)
+    AT = "@"            # Last loaded @file, reused by @:
+
+    class Section():
+        def __init__(self, index:int):
+            self.index, self.stmts = index, []
+            self.reads, self.writes = set(), set()
+            self.deps = []
+            self.hasRequest = False
+
+    def __init__(self, runner: APTRunner, concurrency: int):
+        self.runner, self.concurrency = runner, concurrency
+        self.literals = {}  # Object literals assigned with SET, used to find $set of RES $var
+        self.lastAtFile = None
+
+    @classmethod
+    def ExprVars(cls, expr) -> typing.Tuple[set, set]:
+        """ (reads, writes) of an expression """
+        reads, writes = set(), set()
+        def lit(val):
+            if isinstance(val, dict):
+                for k in val: lit(val[k])
+            elif isinstance(val, list):
+                for v in val: lit(v)
+            elif isinstance(val, str):
+                walk(APT.Expr.StringLit(val).deriveType())
+        def walk(expr):
+            if isinstance(expr, APT.Expr.Var):
+                reads.update(expr.names())
+            elif isinstance(expr, APT.Expr.AtVar):
+                fname = expr.val[1:].strip().split(":")[0]
+                (reads if fname == "" else writes).add(cls.AT)
+            elif isinstance(expr, APT.Expr.BinOp):
+                walk(expr.left), walk(expr.right)
+            elif isinstance(expr, APT.Expr.StringLit):
+                walk(expr.deriveType())
+            elif isinstance(expr, APT.Expr.Object):
+                lit(expr.val)
+        walk(expr)
+        return reads, writes
+
+    def ExpectedVal(self, expr):
+        """ Best effort static value of a RES expectation, or ANY if it can't be known before running """
+        if isinstance(expr, APT.Expr.Object):
+            return expr.val
+        if isinstance(expr, APT.Expr.Var):
+            return self.literals.get(normalizeVarname(expr.val.strip()), self.ANY)
+        if isinstance(expr, APT.Expr.AtVar):
+            fname, accessor = expr.val[1:].strip().split(":")
+            path = self.lastAtFile if fname == "" else self.runner.env.templates.Find(fname, self.runner.baseDir)
+            try:
+                return self.runner.env.templates.Lookup(path, accessor)
+            except Exception:
+                return self.ANY
+        return self.ANY
+
+    def StatementVars(self, stmt) -> typing.Tuple[set, set]:
+        """ (reads, writes) of a statement """
+        reads, writes = set(), set()
+        def read(*exprs):
+            for expr in exprs:
+                r, w = self.ExprVars(expr)
+                reads.update(r), writes.update(w)
+        if isinstance(stmt, APT.Statement.Section):     read(stmt.name)
+        elif isinstance(stmt, APT.Statement.Request):   read(stmt.method, stmt.url, stmt.data)
+        elif isinstance(stmt, APT.Statement.Assert):    read(stmt.data, stmt.assertion)
+        elif isinstance(stmt, APT.Statement.Print):     read(stmt.data)
+        elif isinstance(stmt, APT.Statement.Set):
+            read(stmt.data)
+            varname = normalizeVarname(stmt.varname.strip())
+            writes.add(varname)
+            if isinstance(stmt.data, APT.Expr.Object): self.literals[varname] = stmt.data.val
+            else:                                      self.literals.pop(varname, None)
+        elif isinstance(stmt, APT.Statement.Response):
+            read(stmt.data)
+            expect = self.ExpectedVal(stmt.data)
+            if isinstance(expect, dict):
+                for setcmd in expect.get("$set", []):
+                    if isinstance(setcmd, str) and "->" in setcmd:
+                        writes.add(normalizeVarname(setcmd.split("->")[1].strip()))
+            elif expect == self.ANY:
+                writes.add(self.ANY)
+        elif isinstance(stmt, APT.Statement.Prereq):
+            reads.add(self.ANY), writes.add(self.ANY)
+        elif isinstance(stmt, APT.Statement.Repeat):
+            read(stmt.count, stmt.concurrency)
+            for s in stmt.body:
+                r, w = self.StatementVars(s)
+                reads.update(r), writes.update(w)
+            writes.add("$latency")
+
+        for expr in [getattr(stmt, k, None) for k in ["name", "method", "url", "data", "assertion"]]: # Track @file for @:
+            for at in self.AtFiles(expr):
+                self.lastAtFile = self.runner.env.templates.Find(at, self.runner.baseDir)
+        return reads, writes
 
-def run(filepath):
-    _, ext = os.path.splitext(filepath)
+    @classmethod
+    def AtFiles(cls, expr) -> typing.List[str]:
+        if isinstance(expr, APT.Expr.AtVar):
+            fname = expr.val[1:].strip().split(":")[0]
+            return [fname] if fname != "" else []
+        if isinstance(expr, APT.Expr.BinOp):
+            return cls.AtFiles(expr.left) + cls.AtFiles(expr.right)
+        return []
+
+    def Split(self) -> typing.List['APTSectionScheduler.Section']:
+        """ Split the script into sections. Statements before the first SECT form their own section.
+        A section that checks a RES before its first REQ needs the previous section's response, so it is merged into it """
+        sections = [self.Section(0)]
+        for stmt in self.runner.APT:
+            if isinstance(stmt, APT.Statement.Section):
+                sections.append(self.Section(len(sections)))
+            section = sections[-1]
+            if isinstance(stmt, APT.Statement.Response) and not section.hasRequest and len(sections) > 1:
+                prev = sections[-2]
+                prev.stmts += section.stmts
+                prev.reads.update(section.reads - prev.writes), prev.writes.update(section.writes)
+                sections.pop()
+                section = prev
+            section.stmts.append(stmt)
+            section.hasRequest = section.hasRequest or any(isinstance(s, APT.Statement.Request) for s in APT.Statement.Walk([stmt]))
+            reads, writes = self.StatementVars(stmt)
+            section.reads.update(reads - section.writes) # Values set earlier in the same section are internal
+            section.writes.update(writes)
+        sections = [s for s in sections if len(s.stmts) > 0]
+        for i, section in enumerate(sections):
+            section.index = i
+        return sections
+
+    def Conflicts(self, a:'APTSectionScheduler.Section', b:'APTSectionScheduler.Section') -> bool:
+        def overlap(x, y):
+            return len(x & y) > 0 or (self.ANY in x and len(y) > 0) or (self.ANY in y and len(x) > 0)
+        return overlap(a.writes, b.reads | b.writes) or overlap(a.reads, b.writes)
+
+    def Graph(self) -> typing.List['APTSectionScheduler.Section']:
+        sections = self.Split()
+        for i, section in enumerate(sections):
+            section.deps = [prev for prev in sections[:i] if self.Conflicts(prev, section)]
+        return sections
+
+    def Run(self):
+        asyncio.run(self.RunSections(self.Graph()))
+
+    async def RunSections(self, sections):
+        loop = asyncio.get_running_loop()
+        limit = asyncio.Semaphore(self.concurrency)
+        tasks, results = {}, {}
+
+        parent = self.runner.tracer.Current() if self.runner.tracer != None else None # Worker threads start with no open span
+
+        def execSection(section) -> APTRunner:
+            runner = self.runner.Fork(io.StringIO())
+            with runner.tracer.Start("section", "section", parent, index=section.index) if runner.tracer != None else NULL_SPAN:
+                for stmt in section.stmts:
+                    if not runner.Exec(stmt):
+                        break
+            runner.EndSection()
+            runner.ReleaseResponse()
+            return runner
+
+        async def runSection(section):
+            await asyncio.gather(*[tasks[dep.index] for dep in section.deps])
+            async with limit:
+                results[section.index] = await loop.run_in_executor(executor, execSection, section)
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for section in sections:
+                tasks[section.index] = asyncio.ensure_future(runSection(section))
+            for section in sections: # Report in source order
+                await tasks[section.index]
+                runner = results[section.index]
+                self.runner.out.write(runner.out.getvalue())
+                self.runner.failures += runner.failures
+                self.runner.sections += runner.sections
+                self.runner.testFailed = self.runner.testFailed or runner.testFailed
+
+def run(filepath, sectionConcurrency = 0, transport = None, parseCache = None, cassetteMode = None, prereqCache = None) -> typing.Optional[APTRunner]:
+    base, ext = os.path.splitext(filepath)
     if ext != ".apitest":
-        return
+        return None
     print("\n\n%s" % filepath)
     print("===========================")
-    with open(filepath, "r") as f:
-        runner = APTRunner(f)
-        runner.Run()
+    tracer = transport.tracer if transport != None else None
+    cassette = APTCassette(base + ".cassette", cassetteMode) if cassetteMode != None else None
+    completed = False
+    try:
+        with open(filepath, "r") as f, tracer.Start("file", "file", file=filepath) if tracer != None else NULL_SPAN:
+            runner = APTRunner(f, transport=transport, parseCache=parseCache, cassette=cassette, prereqCache=prereqCache)
+            runner.Run(sectionConcurrency)
+            completed = True
+            return runner
+    finally:
+        if cassette != None: cassette.Close(completed)
 
-def main(argv):
-    # python runner.py tests/
+workerTransport = None
+
+def runCaptured(filepath, transportOptions = {}, **options) -> dict:
+    """ Run a single file with its output captured. Used by the worker pool """
+    global workerTransport
+    if workerTransport == None: # One transport per worker process, reused across its files
+        workerTransport = APTTransport(**transportOptions)
+    options["transport"] = workerTransport
+    out = io.StringIO()
+    start = time.time()
+    with contextlib.redirect_stdout(out):
+        try:
+            runner = run(filepath, **options)
+            failures = runner.failures if runner != None else []
+            passed = runner == None or not runner.testFailed
+            sections = runner.sections if runner != None else []
+        except Exception as e:
+            print("    [ERROR] %s" % e)
+            failures, passed, sections = ["[ERROR] %s" % e], False, []
+    return {
+        "file": filepath,
+        "passed": passed,
+        "failures": failures,
+        "sections": sections,
+        "started": start,
+        "duration": time.time() - start,
+        "output": out.getvalue(),
+        "trace": workerTransport.tracer.Take() if workerTransport.tracer != None else []
+    }
 
-    # Loop in folders
-    for target in argv[1:]:
+def collectFiles(targets) -> typing.List[str]:
+    """ Expand target files and folders into .apitest files, in the order main() runs them """
+    files = []
+    for target in targets:
         if os.path.isfile(target):
-            run(target)
+            files.append(target)
         for (dirpath, _, filenames) in os.walk(target):
             for f in filenames:
-                run(os.path.join(dirpath, f))
+                files.append(os.path.join(dirpath, f))
+    return [f for f in files if os.path.splitext(f)[1] == ".apitest"]
+
+def printSummary(results):
+    failed = [r for r in results if not r["passed"]]
+    print("\n\n===========================")
+    for r in results:
+        print("%s  %6.2fs  %s" % ("PASS" if r["passed"] else "FAIL", r["duration"], r["file"]))
+        for line in r["failures"]:
+            print("    " + line)
+    print("%d file(s), %d passed, %d failed" % (len(results), len(results) - len(failed), len(failed)))
+
+def runParallel(files, jobs, failFast = False, **options) -> typing.List[dict]:
+    """ Run files in a process pool, each with its own APTEnv. Output is printed in file order.
+    With failFast, files not started yet are cancelled as soon as any file fails """
+    results = []
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(runCaptured, f, **options) for f in files]
+        pending, shown = set(futures), 0
+        while shown < len(futures):
+            if failFast: # Woken by any file finishing, not only the next one to print
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                if any(not f.cancelled() and not f.result()["passed"] for f in done):
+                    for f in pending: f.cancel()
+            while shown < len(futures) and (not failFast or futures[shown].done()):
+                future = futures[shown]
+                shown += 1
+                if future.cancelled(): continue
+                result = future.result()
+                sys.stdout.write(result["output"])
+                sys.stdout.flush()
+                results.append(result)
+    return results
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(prog=os.path.basename(argv[0]), description="APT: api-tester runner")
+    parser.add_argument("targets", nargs="*", help=".apitest files or folders")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Run files in N worker processes")
+    parser.add_argument("--pool-size", type=int, default=10, help="Max kept-alive connections per host")
+    parser.add_argument("--idle-timeout", type=float, default=30.0, help="Close a host's connections after idling for this many seconds")
+    parser.add_argument("--no-keep-alive", action="store_true", help="Open a new connection for every request")
+    parser.add_argument("--pool-stats", action="store_true", help="Print connection pool counters at the end")
+    parser.add_argument("--template-stats", action="store_true", help="Print @file template cache counters at the end")
+    parser.add_argument("--no-parse-cache", action="store_true", help="Always parse files instead of using cached statements")
+    parser.add_argument("--cache-dir", default=None, help="Cache folder. Defaults to $APT_CACHE_DIR or ~/.cache/apt")
+    parser.add_argument("--parse-cache-size", type=int, default=256, metavar="MB", help="Max size of the parse cache")
+    parser.add_argument("--no-prereq-cache", action="store_true", help="Run every PREREQ, even those with a TTL")
+    parser.add_argument("--daemon", action="store_true", help="Serve runs from a warm process on a Unix socket, see daemon.py")
+    parser.add_argument("--no-daemon", action="store_true", help="Run in this process even if a daemon is running")
+    parser.add_argument("--fail-fast", action="store_true", help="Stop running files after the first failing one")
+    parser.add_argument("--budget", type=float, default=None, metavar="SECONDS",
+                        help="Only run the files most likely to fail that fit in this time, from past durations")
+    parser.add_argument("--no-history", action="store_true", help="Don't record durations or reorder files by past runs")
+    parser.add_argument("--coordinator", default=None, metavar="HOST:PORT", help="Serve the files to --worker processes, see distributed.py")
+    parser.add_argument("--worker", default=None, metavar="HOST:PORT", help="Run files from a coordinator")
+    parser.add_argument("--watch", action="store_true", help="Re-run the files affected by each change to a test, PREREQ or template file")
+    parser.add_argument("--watch-interval", type=float, default=0.5, help="Watch: seconds between scans when inotify is not available")
+    parser.add_argument("--load", action="store_true", help="Run each file as a load scenario, see loadtest.py")
+    parser.add_argument("--users", type=int, default=10, help="Load: number of virtual users")
+    parser.add_argument("--duration", type=float, default=10.0, help="Load: seconds to run after ramp-up")
+    parser.add_argument("--ramp-up", type=float, default=0.0, help="Load: seconds over which users are started")
+    parser.add_argument("--rate", type=float, default=0.0, help="Load: target scenario iterations per second. Closed loop if 0")
+    parser.add_argument("--data", default=None, metavar="FILE", help="Run each file once per row of a .csv or .jsonl dataset, see dataset.py")
+    parser.add_argument("--data-concurrency", type=int, default=10, metavar="N", help="Data: rows run at the same time")
+    parser.add_argument("--traffic", action="store_true", help="Replay each target as a JSON-lines traffic capture, see traffic.py")
+    parser.add_argument("--speed", type=float, default=1.0, help="Traffic: replay N times faster than recorded")
+    parser.add_argument("--base-url", default=None, help="Traffic: send to this scheme://host:port instead of the recorded one")
+    parser.add_argument("--max-in-flight", type=int, default=256, help="Traffic: max requests waiting for a response")
+    parser.add_argument("--max-body-size", type=int, default=64, metavar="MB", help="Fail responses with a larger body, unless stream-parsed")
+    parser.add_argument("--stream-threshold", type=int, default=4, metavar="MB", help="Stream-parse larger JSON bodies for the fields RES uses (needs ijson)")
+    cassette = parser.add_mutually_exclusive_group()
+    cassette.add_argument("--record", action="store_const", const="record", dest="cassette", help="Record responses to a .cassette next to each file")
+    cassette.add_argument("--replay", action="store_const", const="replay", dest="cassette", help="Answer requests from the recorded .cassette, without network access")
+    parser.add_argument("--trace", default=None, metavar="FILE", help="Write per-statement and HTTP phase timings as Chrome trace-event JSON")
+    parser.add_argument("--metrics", default=None, metavar="FILE", help="Write a Prometheus text format summary of the timings")
+    parser.add_argument("--concurrent-sections", type=int, default=0, metavar="N",
+                        help="Run independent SECT blocks of a file concurrently, at most N at a time")
+    args = parser.parse_args(argv[1:])
+    if args.speed <= 0:
+        parser.error("--speed must be greater than 0")
+    if args.max_in_flight < 1:
+        parser.error("--max-in-flight must be at least 1")
+    if args.data_concurrency < 1:
+        parser.error("--data-concurrency must be at least 1")
+    return args
+
+warmObjects = {} # Transports and caches kept between the runs of a daemon
+
+def keepWarm(key: tuple, factory):
+    if key not in warmObjects:
+        warmObjects[key] = factory()
+    return warmObjects[key]
+
+def main(argv, warm = False) -> int:
+    """ Run a command line. With warm, transports and caches are kept for the next run of this process """
+    # python runner.py tests/
+    # python runner.py --jobs 8 tests/
+    args = parseArgs(argv)
+    files = collectFiles(args.targets)
+    newHistory = lambda: None if args.no_history else APTHistory(os.path.join(cacheDir("history", args.cache_dir), "history.sqlite"))
+    options = {"sectionConcurrency": args.concurrent_sections, "cassetteMode": args.cassette}
+    if not args.no_parse_cache:
+        parseCache = lambda: APTParseCache(cacheDir("parse", args.cache_dir), args.parse_cache_size * 1024 * 1024)
+        options["parseCache"] = keepWarm(("parse", args.cache_dir, args.parse_cache_size), parseCache) if warm else parseCache()
+    if not args.no_prereq_cache:
+        options["prereqCache"] = APTPrereqCache(cacheDir("prereq", args.cache_dir))
+    transportOptions = {"poolSize": args.pool_size, "keepAlive": not args.no_keep_alive, "idleTimeout": args.idle_timeout,
+                        "maxBodySize": args.max_body_size * 1024 * 1024, "streamThreshold": args.stream_threshold * 1024 * 1024}
+
+    tracing = args.trace != None or args.metrics != None # Not recorded for --load
+    def writeTrace(events):
+        if args.trace:
+            with open(args.trace, "w") as f: f.write(APTTracer.ChromeTrace(events))
+        if args.metrics:
+            with open(args.metrics, "w") as f: f.write(APTTracer.Prometheus(events))
+
+    if args.daemon:
+        from daemon import serve
+        return serve()
+
+    if args.coordinator:
+        from distributed import coordinate
+        return coordinate(args.coordinator, files, newHistory(), args.fail_fast)
+
+    if args.worker:
+        from distributed import work
+        return work(args.worker, options, transportOptions)
+
+    if args.watch:
+        from watch import watch
+        return watch(args.targets, options, transportOptions, args.watch_interval)
+
+    if args.load:
+        from loadtest import runLoad
+        transportOptions["poolSize"] = max(args.pool_size, args.users)
+        passed = [runLoad(f, args.users, args.duration, args.ramp_up, args.rate, APTTransport(**transportOptions)) for f in files]
+        return 0 if all(passed) else 1
+
+    if args.data:
+        from dataset import runDataset
+        transportOptions["poolSize"] = max(args.pool_size, args.data_concurrency)
+        transport = APTTransport(**transportOptions)
+        passed = [runDataset(f, args.data, args.data_concurrency, transport, options.get("parseCache"), options.get("prereqCache")) for f in files]
+        transport.Close()
+        return 0 if all(passed) else 1
+
+    if args.traffic:
+        from traffic import runTraffic
+        transportOptions["poolSize"] = max(args.pool_size, args.max_in_flight)
+        passed = [runTraffic(f, args.speed, args.base_url, args.max_in_flight, APTTransport(**transportOptions)) for f in args.targets]
+        return 0 if all(passed) else 1
+
+    history = newHistory()
+    if history != None:
+        files = history.Order(files)
+        if args.budget != None:
+            selected, estimate = history.Select(files, args.budget * max(1, args.jobs))
+            print("Budget %gs: running %d of %d file(s), estimated %.2fs" % (args.budget, len(selected), len(files), estimate / max(1, args.jobs)))
+            files = selected
+    elif args.budget != None:
+        print("--budget needs the run history, ignored with --no-history")
+
+    if args.jobs > 1:
+        results = runParallel(files, args.jobs, args.fail_fast, transportOptions=dict(transportOptions, trace=tracing), **options)
+        printSummary(results)
+        writeTrace([e for r in results for e in r["trace"]])
+    else:
+        results = []
+        newTransport = lambda: APTTransport(trace=tracing, **transportOptions)
+        transport = keepWarm(("transport", tracing, json.dumps(transportOptions, sort_keys=True)), newTransport) if warm else newTransport()
+        options["transport"] = transport
+        for f in files:
+            start = time.time()
+            try:
+                runner = run(f, **options)
+                failures = runner.failures if runner != None else []
+                passed = runner == None or not runner.testFailed
+                sections = runner.sections if runner != None else []
+            except Exception as e: # Like runCaptured, the file fails and the others still run
+                print("    [ERROR] %s" % e)
+                failures, passed, sections = ["[ERROR] %s" % e], False, []
+            results.append({"file": f, "passed": passed, "failures": failures, "sections": sections,
+                            "started": start, "duration": time.time() - start})
+            if args.fail_fast and not passed:
+                break
+        if args.pool_stats:
+            print("\nConnection pool: %s" % json.dumps(transport.Stats()))
+        if args.template_stats:
+            print("\nTemplates: %s" % json.dumps(templateStore.Stats()))
+        if not warm:
+            transport.Close()
+        if tracing:
+            writeTrace(transport.tracer.Take())
+    if len(results) < len(files):
+        print("Stopped after the first failure, %d file(s) not run" % (len(files) - len(results)))
+    if history != None:
+        history.Record(results)
+        history.Close()
+    return 0 if all(r["passed"] for r in results) else 1
 
 
 if __name__ == "__main__":
-    main(sys.argv)
\ No newline at end of file
+    import runner # Run as the runner module, so pickled statements and the loadtest/watch modules share its classes
+    sys.exit(runner.main(sys.argv))
@@ -9,14 +9,25 @@ import requests
 HOST = "0.0.0.0"
 PORT = 8080
 
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Keep-alive, every response has a Content-Length
+    disable_nagle_algorithm = True  # Headers and body are written separately
+    quiet = False # No request logs, for benchmarks
+    def log_message(self, format, *args):
+        if not self.quiet:
+            super().log_message(format, *args)
     def readBody(self):
         contentLength = self.headers.get('content-length')
         return None if contentLength == None or contentLength == "0" else json.loads(self.rfile.read(int(contentLength)))
     def respJSON(self, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    def respEmpty(self):
+        self.send_header("Content-Length", "0")
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode("utf-8"))
 
     def doAny(self, method, path):
         data = self.readBody()
@@ -26,30 +37,42 @@ class RequestHandler(BaseHTTPRequestHandler):
         elif method == "POST" and path == "/echo": # {"data": "ANYTHING"}
             if data == None:
                 self.send_response(400)
-                self.end_headers()
+                self.respEmpty()
                 return
             self.send_response(200)
             self.respJSON({'echo': data["data"]})
         elif method == "POST" and path == "/full-echo":
             self.send_response(200)
             for h in self.headers.keys():
-                print("Header %s: %s" % (h, self.headers.get(h)))
-                self.send_header(h, self.headers.get(h))
-            print("Data:", str(data))
+                if not self.quiet: print("Header %s: %s" % (h, self.headers.get(h)))
+                if h.lower() not in ["content-length", "connection", "transfer-encoding"]:
+                    self.send_header(h, self.headers.get(h))
+            if not self.quiet: print("Data:", str(data))
             self.respJSON(data)
         else :
             self.send_response(404)
-            self.end_headers()
+            self.respEmpty()
             
     def do_GET(self):
         self.doAny("GET", self.path)
     def do_POST(self):
         self.doAny("POST", self.path)
 
-server = HTTPServer((HOST, PORT), RequestHandler)
-print("Server started http://%s:%d" % (HOST, PORT))
-try:
-    server.serve_forever()
-except KeyboardInterrupt:
-    pass
-server.server_close()
\ No newline at end of file
+class QuietRequestHandler(RequestHandler):
+    quiet = True
+
+def start(host = "127.0.0.1", port = 0, quiet = True) -> ThreadingHTTPServer:
+    """ Serve on a daemon thread, e.g. for benchmarks. Port 0 picks a free port, see server.server_address """
+    server = ThreadingHTTPServer((host, port), QuietRequestHandler if quiet else RequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    server = ThreadingHTTPServer((HOST, PORT), RequestHandler)
+    print("Server started http://%s:%d" % (HOST, PORT))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
\ No newline at end of file
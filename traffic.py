@@ -0,0 +1,163 @@
+""" Traffic replay
+
+Send the requests of a JSON-lines capture at their recorded times, scaled by --speed
+
+Each line is a request: {"timestamp": 1718000000.25, "method": "POST", "url": "https://api/x", "headers": {...}, "body": {...}, "status": 200}
+timestamp is in seconds or an ISO 8601 string, body is JSON or a string, status (or response.status) is the recorded status.
+Lines without a string method and url, or with a malformed timestamp, are skipped.
+
+Scheduling is open loop: requests are sent at their time by a pool of up to --max-in-flight threads, whatever the
+earlier ones are waiting for. If the pool is full, sending lags behind schedule, the lag is reported.
+The file is read as it is replayed. Latencies are recorded per endpoint, with ids in the path replaced by {id}.
+
+python runner.py --traffic capture.jsonl
+python runner.py --traffic --speed 10 --base-url http://127.0.0.1:8080 capture.jsonl
+
+"""
+
+import json
+import re
+import threading
+import time
+import typing
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import urlsplit
+
+from runner import APTTransport
+from loadtest import LatencyHistogram
+
+DROP_HEADERS = {"host", "content-length", "connection", "transfer-encoding"} # Set by the transport for the target
+
+def Timestamp(val) -> typing.Optional[float]:
+    if isinstance(val, (int, float)):   return float(val)
+    if isinstance(val, str):            return datetime.fromisoformat(val.replace("Z", "+00:00")).timestamp()
+    return None
+
+def Endpoint(method:str, url:str) -> str:
+    """ POST /users/{id}/orders for POST https://host/users/42/orders?x=1 """
+    segments = [re.sub(r"^(?:\d+|[0-9a-fA-F]{8}-[0-9a-fA-F-]{27}|[0-9a-fA-F]{16,})$", "{id}", s) for s in urlsplit(url).path.split("/")]
+    return "%s %s" % (method, "/".join(segments) or "/")
+
+def Records(f:typing.TextIO, baseUrl:str = None) -> typing.Iterator[dict]:
+    """ Requests of a capture, one line at a time. Yields None for skipped lines """
+    for line in f:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield None
+            continue
+        if not isinstance(record, dict) or not isinstance(record.get("method"), str) or not isinstance(record.get("url"), str) \
+                or not isinstance(record.get("headers") or {}, dict):
+            yield None
+            continue
+        try:
+            timestamp = Timestamp(record.get("timestamp"))
+        except ValueError: # Not an ISO 8601 time
+            yield None
+            continue
+        url = record["url"]
+        if baseUrl != None:
+            parts = urlsplit(url)
+            url = baseUrl.rstrip("/") + parts.path + ("?" + parts.query if parts.query else "")
+        response = record.get("response") if isinstance(record.get("response"), dict) else {}
+        yield {"time": timestamp, "method": record["method"].upper(), "url": url,
+               "headers": record.get("headers") or {}, "body": record.get("body"),
+               "status": record.get("status", record.get("status_code", response.get("status")))}
+
+
+class TrafficReplay():
+    """ Replays records open loop through a transport and collects latencies and status mismatches """
+    def __init__(self, transport:APTTransport, speed:float = 1.0, maxInFlight:int = 256, timeout:float = 30.0):
+        self.transport, self.speed, self.timeout = transport, speed, timeout
+        self.pool = ThreadPoolExecutor(max_workers=maxInFlight, thread_name_prefix="traffic")
+        self.slots = threading.Semaphore(maxInFlight) # Records waiting for a thread are not read ahead
+        self.lock = threading.Lock()
+        self.latencies = {}         # endpoint -> LatencyHistogram
+        self.lag = LatencyHistogram()
+        self.mismatches = Counter() # (endpoint, recorded, actual) -> count
+        self.errors = Counter()     # endpoint -> failed requests
+        self.sent, self.skipped = 0, 0
+
+    def Send(self, record:dict, due:float):
+        endpoint = Endpoint(record["method"], record["url"])
+        headers = {k: v for k, v in record["headers"].items() if k.lower() not in DROP_HEADERS}
+        body = record["body"]
+        if body != None and not isinstance(body, str):
+            body = json.dumps(body)
+            if not any(k.lower() == "content-type" for k in headers):
+                headers["Content-Type"] = "application/json"
+        start = time.perf_counter()
+        lag = max(0.0, time.monotonic() - due)
+        status = None
+        try:
+            res = self.transport.Request(record["method"], record["url"], data=body.encode("utf-8") if body != None else None,
+                                         headers=headers, timeout=self.timeout, verify=False, stream=True)
+            elapsed = time.perf_counter() - start # Until the headers, like $elapsed_ms
+            status = res.status_code
+            res.content # Read the body so the connection goes back to the pool
+            res.close()
+        except Exception as e:
+            elapsed = time.perf_counter() - start
+            status = type(e).__name__
+        with self.lock:
+            self.lag.Record(lag)
+            if not isinstance(status, int):
+                self.errors[endpoint] += 1
+            else:
+                self.latencies.setdefault(endpoint, LatencyHistogram()).Record(elapsed)
+            if record["status"] != None and status != record["status"]:
+                self.mismatches[(endpoint, record["status"], status)] += 1
+
+    def Done(self, _):
+        self.slots.release()
+
+    def Run(self, records:typing.Iterable[dict]) -> float:
+        """ Send the records at their recorded times. Returns the seconds it took """
+        start = time.monotonic()
+        first = None
+        for record in records:
+            if record == None:
+                self.skipped += 1
+                continue
+            if record["time"] != None and first == None:
+                first = record["time"]
+            due = start + (record["time"] - first) / self.speed if record["time"] != None else time.monotonic()
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.slots.acquire()
+            self.pool.submit(self.Send, record, due).add_done_callback(self.Done)
+            self.sent += 1
+        self.pool.shutdown(wait=True)
+        return time.monotonic() - start
+
+    def Report(self, filepath:str, elapsed:float, speed:float):
+        print("\n\n%s" % filepath)
+        print("===========================")
+        print("Requests: %d in %.1fs (%.1f req/s) at %gx speed, %d line(s) skipped" % (self.sent, elapsed, self.sent / max(elapsed, 1e-9), speed, self.skipped))
+        print("Send lag: p50 %.2fms, p99 %.2fms, max %.2fms" % (self.lag.Percentile(50), self.lag.Percentile(99), self.lag.max / 1000))
+        print("\n%-50s %8s %7s %9s %9s %9s %9s %9s %9s" % ("Endpoint", "count", "errors", "mean", "p50", "p90", "p99", "p999", "max"))
+        for endpoint in sorted(set(self.latencies) | set(self.errors)):
+            h = self.latencies.get(endpoint, LatencyHistogram())
+            print("%-50s %8d %7d %8.2fms %8.2fms %8.2fms %8.2fms %8.2fms %8.2fms" % (
+                endpoint[:50], h.count, self.errors[endpoint], h.Mean(),
+                h.Percentile(50), h.Percentile(90), h.Percentile(99), h.Percentile(99.9), h.max / 1000))
+        if len(self.mismatches) > 0:
+            print("\nStatus mismatches:")
+            for (endpoint, recorded, actual), count in sorted(self.mismatches.items(), key=lambda m: -m[1]):
+                print("    %-50s recorded %s, got %s: %d" % (endpoint[:50], recorded, actual, count))
+        else:
+            print("\nStatus mismatches: none")
+
+
+def runTraffic(filepath:str, speed:float = 1.0, baseUrl:str = None, maxInFlight:int = 256, transport:APTTransport = None) -> bool:
+    """ Replay a capture and print a report. Returns False on any request error or status mismatch """
+    if transport == None:
+        transport = APTTransport(poolSize=maxInFlight)
+    replay = TrafficReplay(transport, speed, maxInFlight)
+    with open(filepath, "r") as f:
+        elapsed = replay.Run(Records(f, baseUrl))
+    replay.Report(filepath, elapsed, speed)
+    return len(replay.mismatches) == 0 and len(replay.errors) == 0
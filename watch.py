@@ -0,0 +1,219 @@
+""" Watch mode
+
+Run the targets, then re-run only the .apitest files affected by each change.
+
+A file depends on its PREREQ files (and theirs) and on the @file: templates they use. When a file changes,
+the .apitest files that depend on it are re-run and the last results of the others are reused.
+Changes are picked up with inotify when available, otherwise folders are polled.
+
+python runner.py --watch tests/
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+import typing
+
+from runner import APT, APTTransport, collectFiles, findFile, printSummary, run
+
+def atFiles(expr) -> typing.List[str]:
+    """ File names of the @file: references of an expression, including those inside object literals """
+    names = []
+    def lit(val):
+        if isinstance(val, dict):
+            for k in val: lit(val[k])
+        elif isinstance(val, list):
+            for v in val: lit(v)
+        elif isinstance(val, str):
+            walk(APT.Expr.StringLit(val).deriveType())
+    def walk(expr):
+        if isinstance(expr, APT.Expr.AtVar):
+            fname = expr.val[1:].strip().split(":")[0]
+            if fname != "": names.append(fname)
+        elif isinstance(expr, APT.Expr.BinOp):
+            walk(expr.left), walk(expr.right)
+        elif isinstance(expr, APT.Expr.StringLit):
+            walk(expr.deriveType())
+        elif isinstance(expr, APT.Expr.Object):
+            lit(expr.val)
+    walk(expr)
+    return names
+
+def resolve(fname:str, baseDir:str) -> str:
+    """ Path a reference resolves to, or where it would be created next to the test file """
+    return findFile(fname, baseDir) or os.path.abspath(os.path.join(baseDir, fname))
+
+def dependencies(path:str, parseCache = None, seen:set = None) -> typing.Set[str]:
+    """ Files a test file reads: PREREQ files, recursively, and @file: templates """
+    seen = set() if seen == None else seen
+    path = os.path.abspath(path)
+    if path in seen: return set()
+    seen.add(path)
+    deps, baseDir = set(), os.path.dirname(path)
+    try:
+        with open(path, "r") as f:
+            statements = list(APT(f, parseCache))
+    except Exception: # Missing or unparsable, re-run when it changes
+        return deps
+    for stmt in APT.Statement.Walk(statements):
+        for expr in [getattr(stmt, k, None) for k in ["name", "method", "url", "data", "assertion", "ttl", "count", "concurrency"]]:
+            deps.update(resolve(fname, baseDir) for fname in atFiles(expr))
+        if isinstance(stmt, APT.Statement.Prereq):
+            prereq = resolve(stmt.filename, baseDir)
+            deps.add(prereq)
+            deps.update(dependencies(prereq, parseCache, seen))
+    return deps
+
+
+class InotifyWatcher():
+    """ Folder watcher on Linux inotify, through libc with ctypes """
+    IN_MODIFY, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x2, 0x8, 0x40, 0x80, 0x100, 0x200
+    IN_ISDIR, IN_CLOEXEC = 0x40000000, 0o2000000
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    EVENT = struct.Struct("iIII") # wd, mask, cookie, name length
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = {} # wd -> folder
+
+    def Watch(self, folder:str):
+        if folder in self.dirs.values(): return
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), self.MASK)
+        if wd >= 0: self.dirs[wd] = folder
+
+    def Wait(self, timeout:float) -> typing.Set[str]:
+        """ Paths changed within timeout seconds """
+        changed = set()
+        if len(select.select([self.fd], [], [], timeout)[0]) == 0:
+            return changed
+        data = os.read(self.fd, 64 * 1024)
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, pos)
+            name = data[pos + self.EVENT.size:pos + self.EVENT.size + length].rstrip(b"\0")
+            pos += self.EVENT.size + length
+            if wd not in self.dirs: continue
+            path = os.path.join(self.dirs[wd], os.fsdecode(name))
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO): self.Watch(path)
+                continue
+            changed.add(path)
+        return changed
+
+    def Close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher():
+    """ Folder watcher comparing mtimes and sizes every interval seconds """
+    def __init__(self, interval:float = 0.5):
+        self.interval = interval
+        self.dirs, self.files = set(), {}
+
+    def Scan(self, folder:str) -> dict:
+        files = {}
+        try:
+            for entry in os.scandir(folder):
+                if entry.is_file():
+                    st = entry.stat()
+                    files[entry.path] = (st.st_mtime_ns, st.st_size)
+        except OSError: pass
+        return files
+
+    def Watch(self, folder:str):
+        if folder in self.dirs: return
+        self.dirs.add(folder)
+        self.files.update(self.Scan(folder))
+
+    def Wait(self, timeout:float) -> typing.Set[str]:
+        time.sleep(min(timeout, self.interval))
+        files = {}
+        for folder in self.dirs:
+            files.update(self.Scan(folder))
+        changed = set(k for k in files.keys() | self.files.keys() if files.get(k) != self.files.get(k))
+        self.files = files
+        return changed
+
+    def Close(self): pass
+
+
+def newWatcher(interval:float):
+    try:
+        return InotifyWatcher()
+    except (OSError, AttributeError): # No inotify on this platform
+        return PollingWatcher(interval)
+
+
+class Watch():
+    def __init__(self, targets:list, options:dict, transportOptions:dict, interval:float = 0.5):
+        self.targets, self.options = targets, options
+        self.options["transport"] = APTTransport(**transportOptions)
+        self.watcher = newWatcher(interval)
+        self.results = {}   # file -> result of its last run
+        self.deps = {}      # file -> files it depends on
+
+    def Folders(self) -> typing.Set[str]:
+        folders = set()
+        for target in self.targets:
+            if os.path.isdir(target):
+                folders.update(os.path.abspath(dirpath) for dirpath, _, _ in os.walk(target))
+            else:
+                folders.add(os.path.dirname(os.path.abspath(target)))
+        for deps in self.deps.values():
+            folders.update(os.path.dirname(d) for d in deps if os.path.isdir(os.path.dirname(d)))
+        return folders
+
+    def Affected(self, changed:typing.Set[str], files:typing.List[str]) -> typing.List[str]:
+        return [f for f in files if f not in self.results or os.path.abspath(f) in changed or len(self.deps.get(f, set()) & changed) > 0]
+
+    def Run(self, files:typing.List[str]):
+        for f in files:
+            start = time.time()
+            try:
+                runner = run(f, **self.options)
+                self.results[f] = {"file": f, "passed": not runner.testFailed, "failures": runner.failures, "duration": time.time() - start}
+            except Exception as e: # E.g. a missing PREREQ or a half-saved file, wait for the next change like runCaptured reports it
+                print("    [ERROR] %s" % e)
+                self.results[f] = {"file": f, "passed": False, "failures": ["[ERROR] %s" % e], "duration": time.time() - start}
+            try:
+                self.deps[f] = dependencies(f, self.options.get("parseCache"))
+            except Exception:
+                self.deps.setdefault(f, set()) # Found again once the file parses
+        sys.stdout.flush()
+
+    def Loop(self) -> int:
+        files = collectFiles(self.targets)
+        self.Run(files)
+        while True:
+            for folder in self.Folders():
+                self.watcher.Watch(folder)
+            printSummary([self.results[f] for f in files])
+            print("Watching for changes (%s), Ctrl+C to stop" % type(self.watcher).__name__)
+            changed = set()
+            while len(changed) == 0:
+                changed = self.watcher.Wait(3600)
+            time.sleep(0.1) # Editors write in several steps
+            changed.update(self.watcher.Wait(0))
+            files = collectFiles(self.targets)
+            for f in [f for f in self.results if f not in files]: # Deleted
+                self.results.pop(f), self.deps.pop(f, None)
+            affected = self.Affected(changed, files)
+            print("\n%d file(s) changed, re-running %d of %d test file(s)" % (len(changed), len(affected), len(files)))
+            self.Run(affected)
+
+def watch(targets:list, options:dict, transportOptions:dict, interval:float = 0.5) -> int:
+    w = Watch(targets, options, transportOptions, interval)
+    try:
+        return w.Loop()
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        w.watcher.Close()
+        w.options["transport"].Close()